@@ -0,0 +1,262 @@
+#!/usr/bin/python
+"""
+Benchmarks the interpreter on tests/*.tcps and on generated workloads.
+
+Every workload is timed phase by phase: parsing (SExpGrammer.parse), conversion
+(convert_parse_to_cps), compilation (Prog.compile), linking for the engine and
+execution. Each phase is run --repeat times and the fastest run is kept. Instruction
+counts come from the budget of the bytecode vm, so they are the same for both engines.
+Each workload runs in a child process of its own, so the peak resident memory it
+reports is its own.
+
+Results can be written as JSON and compared against an earlier result, in which case
+any phase that got slower by more than the threshold is reported as a regression and
+the exit status is 1.
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import time
+
+import tinycps.sexp_parser as sexp_parser
+import tinycps.sexp_to_cps as sexp_to_cps
+import tinycps.expression_tree as expression_tree
+import tinycps.vm as vm
+import tinycps.bytecode as bytecode
+import tinycps.peephole as peephole
+import tinycps.verifier as verifier
+
+TESTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests")
+PHASES = ["parse", "convert", "compile", "link", "execute"]
+RESULT_VERSION = 1
+
+# Phases faster than this are too noisy to be compared against a baseline.
+MIN_COMPARED_TIME = 0.005
+
+def read_test(name):
+    with open(os.path.join(TESTS_DIRECTORY, name + ".tcps")) as f:
+        return f.read()
+
+# The definitions of a test program with its main replaced by main.
+def with_main(name, main):
+    return main + "\n" + re.sub(r"\(def main \(ret\)[^\n]*\n", "", read_test(name))
+
+def fib_source(n):
+    return with_main("fib", "(def main (ret) (fib ret %i))" % n)
+
+# The total number of hailstone steps for every start from 1 to n.
+def hailstone_range_source(n):
+    return with_main("hailstone", """(def main (ret) (range ret 1 %i 0))
+(def range (ret i limit acc)
+    (< (lambda (more)
+        (if ret more
+            (lambda (ret) (hailstone (lambda (steps)
+                (+ (lambda (total)
+                    (+ (lambda (next) (range ret next limit total)) i 1))
+                acc steps)) i 0))
+            (lambda (ret) (ret acc))))
+    i limit))""" % (n + 1))
+
+# A function whose body is depth nested continuation lambdas, called count times.
+def nested_lambdas_source(depth, count=100):
+    body = "(ret a%i)" % depth
+    for level in range(depth, 0, -1):
+        body = "(+ (lambda (a%i) %s) a%i %i)" % (level, body, level - 1, level)
+    return """(def main (ret) (loop ret %i 0))
+(def loop (ret i acc)
+    (= (lambda (done)
+        (if ret done
+            (lambda (ret) (ret acc))
+            (lambda (ret) (nest (lambda (value)
+                (- (lambda (next) (loop ret next value)) i 1)) i))))
+    i 0))
+(def nest (ret a0) %s)""" % (count, body)
+
+# Fills a vector with the squares of 0 to n - 1, doubles every element in place with
+# assoc and sums them with nth.
+def vector_source(n):
+    return """(def main (ret) (vector (lambda (v) (fill (lambda (full) (double (lambda (doubled) (sum ret doubled 0 0)) full 0)) v 0))))
+(def fill (ret v i)
+    (< (lambda (more)
+        (if ret more
+            (lambda (ret) (* (lambda (square)
+                (push (lambda (w) (+ (lambda (next) (fill ret w next)) i 1)) v square)) i i))
+            (lambda (ret) (ret v))))
+    i %i))
+(def double (ret v i)
+    (length (lambda (n) (< (lambda (more)
+        (if ret more
+            (lambda (ret) (nth (lambda (x) (* (lambda (twice)
+                (assoc (lambda (w) (+ (lambda (next) (double ret w next)) i 1)) v i twice)) x 2)) v i))
+            (lambda (ret) (ret v))))
+    i n)) v))
+(def sum (ret v i acc)
+    (length (lambda (n) (< (lambda (more)
+        (if ret more
+            (lambda (ret) (nth (lambda (x) (+ (lambda (total)
+                (+ (lambda (next) (sum ret v next total)) i 1)) acc x)) v i))
+            (lambda (ret) (ret acc))))
+    i n)) v))""" % n
+
+# name -> source of every workload.
+def workloads(options):
+    programs = {}
+    for path in sorted(glob.glob(os.path.join(TESTS_DIRECTORY, "*.tcps"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            programs[name] = f.read()
+    programs["fib-%i" % options.fib] = fib_source(options.fib)
+    programs["hailstone-range-%i" % options.hailstone] = hailstone_range_source(options.hailstone)
+    programs["nested-lambdas-%i" % options.depth] = nested_lambdas_source(options.depth)
+    programs["vector-%i" % options.vector] = vector_source(options.vector)
+    return programs
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        value = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return value, best
+
+# Returns the results of one workload as a dictionary.
+def measure(source, options):
+    times = {}
+    (stream, matched, parse), times["parse"] = timed(lambda: sexp_parser.SExpGrammer().parse(source), options.repeat)
+    if not matched or stream.position != len(source):
+        raise Exception("Parse error at position: %i" % stream.position)
+    module, times["convert"] = timed(lambda: sexp_to_cps.convert_parse_to_cps(parse, False), options.repeat)
+    (instrs, jumps), times["compile"] = timed(lambda: expression_tree.Prog(module).compile(), options.repeat)
+
+    def link():
+        linked = (instrs, jumps)
+        if options.peephole:
+            linked = peephole.optimize(instrs, jumps)[:2]
+        if options.engine == "debug":
+            return linked
+        program = bytecode.assemble(*linked)
+        if options.verify:
+            verifier.try_verify(program)
+        return program
+    program, times["link"] = timed(link, options.repeat)
+
+    def execute():
+        if options.engine == "debug":
+            return vm.run_program(*program)
+        return bytecode.run_bytecode(program)
+    result, times["execute"] = timed(execute, options.repeat)
+
+    # the vm charges every instruction it runs against its budget
+    counted = program if options.engine == "vm" else bytecode.assemble(*program)
+    stack = bytecode.ValueStack([bytecode.FINISH_CLOSURE])
+    ip, stack, left = bytecode.execute(counted, stack, counted.entry)
+    instructions = sys.maxint - left
+
+    times["total"] = sum([times[phase] for phase in PHASES])
+    return {"times": times, "instructions": instructions, "result": result,
+            "instructions_per_second": instructions / times["execute"] if times["execute"] else 0.0,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def measure_in_child(source, options, results):
+    try:
+        results.put(measure(source, options))
+    except Exception as e:
+        results.put({"error": str(e)})
+
+def measure_isolated(source, options):
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=measure_in_child, args=(source, options, results))
+    child.start()
+    result = results.get()
+    child.join()
+    return result
+
+def format_results(results):
+    width = max([len(name) for name in results] + [8])
+    lines = ["%-*s %9s %9s %9s %9s %9s %9s %12s %11s %9s" % ((width, "workload") + tuple(PHASES) + ("total", "instrs", "instrs/s", "peak KB"))]
+    for name in sorted(results):
+        result = results[name]
+        if "error" in result:
+            lines.append("%-*s error: %s" % (width, name, result["error"]))
+            continue
+        times = result["times"]
+        lines.append("%-*s %s %12i %11.0f %9i" % (width, name, " ".join(["%9.4f" % times[phase] for phase in PHASES + ["total"]]),
+                     result["instructions"], result["instructions_per_second"], result["peak_rss_kb"]))
+    return "\n".join(lines)
+
+# Returns a line for every phase of every workload that is more than threshold slower
+# than in baseline.
+def regressions(results, baseline, threshold):
+    lines = []
+    for name in sorted(results):
+        old = baseline.get("workloads", {}).get(name)
+        new = results[name]
+        if old is None or "error" in old or "error" in new:
+            continue
+        for phase in PHASES + ["total"]:
+            before = old["times"][phase]
+            after = new["times"][phase]
+            if max(before, after) >= MIN_COMPARED_TIME and after > before * (1 + threshold):
+                lines.append("%s %s: %.4fs -> %.4fs (+%.0f%%)" % (name, phase, before, after, 100 * (after / before - 1)))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmark", description="Time the phases of the interpreter on a set of workloads.")
+    parser.add_argument("--engine", choices=["vm", "debug"], default="vm",
+                        help="run the assembled bytecode or the object-per-instruction vm")
+    parser.add_argument("--no-peephole", dest="peephole", action="store_false",
+                        help="do not rewrite instruction sequences into superinstructions")
+    parser.add_argument("--no-verify", dest="verify", action="store_false",
+                        help="run the vm engine on the checked loop instead of verifying the bytecode when it is linked")
+    parser.add_argument("--repeat", type=int, default=3, metavar="N", help="run every phase N times and keep the fastest")
+    parser.add_argument("--fib", type=int, default=18, metavar="N", help="the workload computing fib(N)")
+    parser.add_argument("--hailstone", type=int, default=100, metavar="N", help="the workload summing the hailstone steps from 1 to N")
+    parser.add_argument("--vector", type=int, default=1000, metavar="N", help="the workload filling, updating and summing a vector of N elements")
+    parser.add_argument("--depth", type=int, default=40, metavar="N", help="the workload calling N nested lambdas")
+    parser.add_argument("--only", metavar="PATTERN", help="only run the workloads whose name matches the regular expression PATTERN")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results to those written to FILE by an earlier --json")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="with --baseline, the fraction by which a phase may get slower before it counts as a regression")
+    options = parser.parse_args()
+    if options.repeat < 1:
+        parser.error("--repeat needs to be at least one")
+
+    baseline = None
+    if options.baseline:
+        try:
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+        except (IOError, ValueError) as e:
+            parser.error("could not read %s: %s" % (options.baseline, str(e)))
+
+    programs = workloads(options)
+    results = {}
+    for name in sorted(programs):
+        if options.only and not re.search(options.only, name):
+            continue
+        results[name] = measure_isolated(programs[name], options)
+    print format_results(results)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump({"version": RESULT_VERSION, "engine": options.engine, "peephole": options.peephole,
+                       "verify": options.verify, "workloads": results}, f, indent=2, sort_keys=True)
+    if baseline is not None:
+        slower = regressions(results, baseline, options.threshold)
+        if slower:
+            print "\nRegressions over %.0f%%:" % (100 * options.threshold)
+            print "\n".join(slower)
+            sys.exit(1)
+        print "\nNo regressions over %.0f%%." % (100 * options.threshold)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,35 @@
 #!/usr/bin/python
 
+import argparse
+import os
 import sys
+import time
 from copy import copy
 
 import tinycps.sexp_parser as sexp_parser
 import tinycps.sexp_to_cps as sexp_to_cps
 import tinycps.expression_tree as expression_tree
 import tinycps.vm as vm
+import tinycps.bytecode as bytecode
+import tinycps.peephole as peephole
+import tinycps.bytecode_file as bytecode_file
+import tinycps.pycodegen as pycodegen
+import tinycps.batch as batch
+import tinycps.jobs as jobs
+import tinycps.records as records
+import tinycps.profiler as profiler
+import tinycps.cps_optimizer as cps_optimizer
+import tinycps.register_vm as register_vm
+import tinycps.linker as linker
+import tinycps.streaming as streaming
+import tinycps.grammer_compiler as grammer_compiler
+import tinycps.tree_walker as tree_walker
+import tinycps.tracing as tracing
+import tinycps.type_inference as type_inference
+import tinycps.verifier as verifier
 
 INTERACTIVE_MAIN = "__main__"
+ENGINES = ["vm", "debug", "python", "register", "tree"]
 
 def convert_def(parse, module):
     new_module = copy(module)
@@ -45,14 +66,20 @@ def add_parse_to_module(parse, module):
         return None, error_text
 
 
-def interactive_eval(txt, module):
-    stream, result, parse = sexp_parser.SExpGrammer().parse(txt)
+# Evaluates one line of the REPL. Definitions are compiled and linked incrementally by
+# the session's IncrementalLinker.
+def interactive_eval(txt, module, session=None):
+    if session is None:
+        session = linker.IncrementalLinker()
+    with tracing.span("parse", length=len(txt)):
+        stream, result, parse = sexp_parser.SExpGrammer().parse(txt)
     if not result or stream.position != len(txt):
         print " " * (stream.position + 2) + "^"
         print "Parse error at position: %i" % stream.position
         return None
 
-    module, error_text = add_parse_to_module(parse, module)
+    with tracing.span("convert"):
+        module, error_text = add_parse_to_module(parse, module)
     if not module:
         print "Could not interpret syntax:"
         print error_text
@@ -62,17 +89,21 @@ def interactive_eval(txt, module):
         return module
     
     try:
-        prog = expression_tree.Prog(module, main=INTERACTIVE_MAIN)
-        instrs, jumps = prog.compile()
+        with tracing.span("link"):
+            entry = session.link(module, INTERACTIVE_MAIN)
     except Exception as e:
         print "Compile error: " + str(e)
         return None
     
     try:
-        print vm.run_program(instrs, jumps)
+        with tracing.span("execute", engine="debug"):
+            result = vm.run_program(session.instructions, session.jump_table, entry=entry)
+        print result
     except vm.RuntimeException as e:
         print "Runtime error: " + str(e)
         return None
+    finally:
+        session.unlink()
     
     del module[INTERACTIVE_MAIN]
     return module
@@ -80,10 +111,12 @@ def interactive_eval(txt, module):
 
 def repl():
     module = {}
+    session = linker.IncrementalLinker()
     while True:
         try:
             txt = raw_input("> ")
-            new_module = interactive_eval(txt, module)
+            with tracing.span("repl-eval", line=txt):
+                new_module = interactive_eval(txt, module, session)
             if new_module:
                 module = new_module
         except EOFError:
@@ -91,41 +124,403 @@ def repl():
             return
 
 
-def static_eval(txt):
-    stream, result, parse = sexp_parser.SExpGrammer().parse(txt)
+def optimize(instrs, jumps, options):
+    if options.peephole:
+        count = len(instrs)
+        with tracing.span("peephole", instructions=count):
+            instrs, jumps, report = peephole.optimize(instrs, jumps)
+        if options.peephole_report:
+            print peephole.format_report(report, count, len(instrs))
+    return instrs, jumps
+
+# Prepares the output of Prog.compile for the selected engine.
+def link(instrs, jumps, options):
+    with tracing.span("link", engine=options.engine, instructions=len(instrs)):
+        # superinstructions only pay off on a stack machine
+        if options.engine == "register":
+            return register_vm.translate(instrs, jumps)
+        instrs, jumps = optimize(instrs, jumps, options)
+        if options.engine == "debug":
+            return instrs, jumps
+        if options.engine == "python":
+            return pycodegen.translate(instrs, jumps)
+        return bytecode.assemble(instrs, jumps)
+
+def execute(program, options):
+    with tracing.span("execute", engine=options.engine):
+        return run_engine(program, options)
+
+def run_engine(program, options):
+    if options.engine == "debug":
+        result = vm.run_program(*program)
+        memo = [instr.cache for instr in program[0] if isinstance(instr, vm.MemoReturn)]
+        if options.memo_stats and memo:
+            print memo[0].format_stats()
+        return result
+    if options.engine in ["python", "register", "tree"]:
+        return program.run()
+    # the peak depth is only tracked by the checked loop
+    if options.verify and not options.stack_depth:
+        with tracing.span("verify", instructions=len(program)):
+            verifier.try_verify(program)
+    stack = bytecode.ValueStack()
+    result = bytecode.run_bytecode(program, stack=stack)
+    if options.stack_depth:
+        print "Peak stack depth: %i (%i slots allocated)" % (stack.peak, len(stack.values))
+    if options.memo_stats and program.memo is not None:
+        print program.memo.format_stats(program.label_at)
+    return result
+
+# The cache for --memoize, for the functions named by --memo-functions or all of them.
+def memo_cache(options):
+    if not options.memoize:
+        return None
+    if options.memo_functions is None:
+        return vm.MemoCache(options.memo_size)
+    return vm.MemoCache(options.memo_size, set([name for name in options.memo_functions.split(",") if name]))
+
+
+# The s-expression parser selected by the options.
+def make_grammer(options):
+    grammer = sexp_parser.SExpGrammer(packrat=options.packrat, parse_stats=options.parse_stats)
+    if options.compiled_parser:
+        return grammer_compiler.compile_grammer(grammer)
+    return grammer
+
+# Parses and converts a module, optimizes it and reports its operand types if asked to. Returns the module, or
+# None after reporting an error.
+def read_module(txt, options):
+    grammer = make_grammer(options)
+    with tracing.span("parse", length=len(txt)):
+        stream, result, parse = grammer.parse(txt)
+    if options.parse_stats:
+        print "Parser: %s" % repr(grammer.stats)
     if not result or stream.position != len(txt):
         print " " * (stream.position + 2) + "^"
         print "Parse error at position: %i" % stream.position
-        return
+        return None
     
     try:
-        module = sexp_to_cps.convert_parse_to_cps(parse, False)
+        with tracing.span("convert"):
+            module = sexp_to_cps.convert_parse_to_cps(parse, False)
     except Exception as e:
         print "Could not interpret syntax: " + str(e)
-        return
+        return None
+
+    if options.optimize:
+        before = cps_optimizer.module_size(module)
+        with tracing.span("optimize", nodes=before):
+            module, report = cps_optimizer.optimize(module)
+        if options.optimize_report:
+            print cps_optimizer.format_report(report, before, cps_optimizer.module_size(module))
+
+    if options.specialize_report:
+        try:
+            with tracing.span("infer"):
+                report = type_inference.infer(module)
+        except Exception as e:
+            print "Compile error: " + str(e)
+            return None
+        print type_inference.format_report(report)
+    return module
 
+# Runs the front end and returns the output of Prog.compile, or None after
+# reporting an error.
+def compile_module(txt, options):
+    module = read_module(txt, options)
+    if module is None:
+        return None
     try:
-        prog = expression_tree.Prog(module)
-        instrs, jumps = prog.compile()
+        with tracing.span("compile", functions=len(module)):
+            prog = expression_tree.Prog(module, memo=memo_cache(options))
+            return prog.compile()
     except Exception as e:
         print "Compile error: " + str(e)
+        return None
+
+# Runs the front end and returns a program for the selected engine, or None after
+# reporting an error.
+def compile_source(txt, options):
+    if options.engine == "tree":
+        module = read_module(txt, options)
+        if module is None:
+            return None
+        try:
+            with tracing.span("resolve", functions=len(module)):
+                return tree_walker.TreeProgram(module)
+        except Exception as e:
+            print "Compile error: " + str(e)
+            return None
+    compiled = compile_module(txt, options)
+    if compiled is None:
+        return None
+    try:
+        return link(compiled[0], compiled[1], options)
+    except Exception as e:
+        print "Compile error: " + str(e)
+        return None
+
+# Everything besides the source text that changes the compiled bytecode.
+def cache_tag(options):
+    return "peephole=%s optimize=%s memoize=%s memo_functions=%s memo_size=%i" % (
+        options.peephole, options.optimize, options.memoize, options.memo_functions, options.memo_size)
+
+def run_and_print(program, options):
+    try:
+        print "Program output: " + str(execute(program, options))
+    except vm.RuntimeException as e:
+        print "Runtime error: " + str(e)
+
+
+# Compiles and runs a module. When path is given and the bytecode engine is used,
+# compiled programs are cached next to it, keyed by the hash of the source.
+def static_eval(txt, options, path=None):
+    program = None
+    cached = None
+    if path is not None and options.cache and options.engine == "vm":
+        cached = bytecode_file.cache_path(path, txt, cache_tag(options))
+        with tracing.span("cache-load"):
+            program = bytecode_file.load_cached(cached)
+    if program is None:
+        program = compile_source(txt, options)
+        if program is None:
+            return
+        if cached is not None:
+            with tracing.span("cache-store"):
+                bytecode_file.store_cached(program, cached)
+    run_and_print(program, options)
+
+# Compiles a module while it is read, one definition at a time, and runs it.
+def stream_eval(path, options):
+    try:
+        with open(path) as f:
+            with tracing.span("stream-compile"):
+                instrs, jumps = streaming.compile_file(f, grammer=make_grammer(options))
+    except streaming.ParseException as e:
+        print str(e)
         return
-    
+    except streaming.SyntaxException as e:
+        print "Could not interpret syntax: " + str(e)
+        return
+    except Exception as e:
+        print "Compile error: " + str(e)
+        return
+    try:
+        program = link(instrs, jumps, options)
+    except Exception as e:
+        print "Compile error: " + str(e)
+        return
+    run_and_print(program, options)
+
+# Runs a module on the debug vm, counting where its instructions and time go.
+def profile_eval(txt, options):
+    compiled = compile_module(txt, options)
+    if compiled is None:
+        return
+    instrs, jumps = optimize(compiled[0], compiled[1], options)
     try:
-        print "Program output: " + str(vm.run_program(instrs, jumps))
+        with tracing.span("execute", engine="profile"):
+            result, profile = profiler.run_profiled(instrs, jumps)
     except vm.RuntimeException as e:
         print "Runtime error: " + str(e)
         return
+    print "Program output: " + str(result)
+    if options.profile_json:
+        try:
+            profile.dump(options.profile_json)
+        except (IOError, OSError) as e:
+            print "Could not write %s: %s" % (options.profile_json, str(e))
+    if options.profile:
+        print profile.format_report()
 
+def compile_only(txt, options, output):
+    program = compile_source(txt, options)
+    if program is None:
+        return
+    try:
+        bytecode_file.save(program, output)
+    except (IOError, OSError) as e:
+        print "Could not write %s: %s" % (output, str(e))
+        return
+    except bytecode_file.BytecodeFileException as e:
+        print "Compile error: " + str(e)
+        return
+    print "Wrote %s" % output
 
-def main():
-    if len(sys.argv) == 1:
+def run_bytecode_file(path, options):
+    try:
+        with tracing.span("load", path=path):
+            program = bytecode_file.load(path)
+    except (IOError, bytecode_file.BytecodeFileException) as e:
+        print "Could not load %s: %s" % (path, str(e))
+        return
+    run_and_print(program, options)
+
+
+# Runs main once for every record of the inputs file, in blocks of options.batch_size
+# records side by side in numpy lanes, or spread over a pool of worker processes when
+# options.workers is set. The records are read lazily (see records.py), and each result
+# is written to options.output, or printed, as soon as it is known.
+def batch_eval(txt, options):
+    if options.workers:
+        program = compile_source(txt, options)
+        if program is None:
+            return
+        with jobs.JobRunner(program, options.workers, verify=options.verify) as runner:
+            write_results(runner.map(records.records(options.batch)), "workers", options)
+            print runner.format_stats()
+        return
+    compiled = compile_module(txt, options)
+    if compiled is None:
+        return
+    write_results(lane_results(compiled[0], compiled[1], options), "batch", options)
+
+def lane_results(instrs, jumps, options):
+    for block in records.blocks(options.batch, options.batch_size):
+        for result in batch.run_batch(instrs, jumps, block):
+            yield result
+
+# Writes every result to a line of its own as soon as it is known, then prints how many
+# records were run per second.
+def write_results(results, engine, options):
+    try:
+        out = open(options.output, "w") if options.output else sys.stdout
+    except IOError as e:
+        print "Could not write %s: %s" % (options.output, str(e))
+        return
+    count = 0
+    start = time.time()
+    try:
+        with tracing.span("execute", engine=engine, inputs=options.batch):
+            for result in results:
+                out.write("%s\n" % result)
+                count += 1
+        out.flush()
+    except records.RecordException as e:
+        print "Could not read inputs: " + str(e)
+    except vm.RuntimeException as e:
+        print "Runtime error: " + str(e)
+    except IOError as e:
+        if out is sys.stdout:
+            raise
+        print "Could not write %s: %s" % (options.output, str(e))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.time() - start
+    print "Records: %i, wall time: %.3fs, %.1f records/s" % (count, elapsed, count / elapsed if elapsed else 0.0)
+
+
+# Runs the file or REPL the options ask for.
+def evaluate(options, is_bytecode, profiling):
+    if options.filename is None:
         repl()
-    elif len(sys.argv) == 2:
-        with open(sys.argv[1]) as f:
-            static_eval(f.read())
+    elif is_bytecode:
+        run_bytecode_file(options.filename, options)
     else:
-        print "Usage: tinycps [filename]"
+        if options.stream:
+            stream_eval(options.filename, options)
+            return
+        with open(options.filename) as f:
+            txt = f.read()
+        if options.batch:
+            batch_eval(txt, options)
+        elif profiling:
+            profile_eval(txt, options)
+        elif options.compile_only:
+            output = options.output or os.path.splitext(options.filename)[0] + bytecode_file.EXTENSION
+            compile_only(txt, options, output)
+        else:
+            static_eval(txt, options, options.filename)
+
+def main():
+    parser = argparse.ArgumentParser(prog="tinycps", description="Evaluate a tinycps module, or start a REPL if no file is given.")
+    parser.add_argument("filename", nargs="?")
+    parser.add_argument("--engine", choices=ENGINES, default="vm",
+                        help="vm runs the assembled bytecode, debug runs the object-per-instruction vm, "
+                             "python translates every function to python code ahead of time, "
+                             "register runs a register machine translated from the same instructions, "
+                             "tree walks the expression tree without compiling it, which starts fastest")
+    parser.add_argument("--no-peephole", dest="peephole", action="store_false",
+                        help="do not rewrite instruction sequences into superinstructions")
+    parser.add_argument("--peephole-report", action="store_true",
+                        help="print which peephole rewrites fired")
+    parser.add_argument("--packrat", action="store_true",
+                        help="remember the result of every grammer rule at every position while parsing")
+    parser.add_argument("--parse-stats", action="store_true",
+                        help="print how often grammer rules were applied, hit the packrat table or were parsed again")
+    parser.add_argument("--compiled-parser", action="store_true",
+                        help="parse with python code generated from the grammer instead of the combinators")
+    parser.add_argument("--stream", action="store_true",
+                        help="read the file in chunks and compile each definition as soon as it has been read, "
+                             "without the bytecode cache")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="eta reduce continuations, inline functions that are called once and fold constants before compiling")
+    parser.add_argument("--optimize-report", action="store_true",
+                        help="print how many nodes each of the --optimize rules removed")
+    parser.add_argument("--specialize-report", action="store_true",
+                        help="infer the operand types of arithmetic and print how many call sites were proven int, float or could only be guarded")
+    parser.add_argument("-c", "--compile-only", action="store_true",
+                        help="write the compiled bytecode to a .tcpsc file instead of running it")
+    parser.add_argument("-o", "--output",
+                        help="the .tcpsc file written by --compile-only, or the file --batch writes its results to instead of printing them")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="do not read or write the compiled bytecode cache")
+    parser.add_argument("--batch", metavar="INPUTS",
+                        help="run main once per record of INPUTS, read lazily from a .npy array (memory mapped), "
+                             "a .csv file or lines of whitespace separated arguments, running blocks of records together as numpy lanes")
+    parser.add_argument("--batch-size", type=int, default=1024, metavar="N",
+                        help="with --batch, the number of records run side by side in numpy lanes at a time")
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="with --batch, run the inputs on N worker processes instead of numpy lanes")
+    parser.add_argument("--stack-depth", action="store_true",
+                        help="print the deepest the value stack of the vm engine got")
+    parser.add_argument("--no-verify", dest="verify", action="store_false",
+                        help="run the vm engine on the checked loop instead of verifying the bytecode and running it without checks")
+    parser.add_argument("--profile", action="store_true",
+                        help="run on the debug vm and print instruction counts and time per opcode, function and jump")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="run on the debug vm and write the profile to FILE as JSON")
+    parser.add_argument("--memoize", action="store_true",
+                        help="cache the results of direct calls to named functions and skip repeated calls")
+    parser.add_argument("--memo-functions", metavar="NAMES",
+                        help="with --memoize, only memoize these functions (comma separated) instead of all but main")
+    parser.add_argument("--memo-size", type=int, default=vm.DEFAULT_MEMO_SIZE, metavar="N",
+                        help="the most results --memoize keeps, least recently used ones are evicted first")
+    parser.add_argument("--memo-stats", action="store_true",
+                        help="print the hits and misses of the --memoize cache for each function")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write how long each stage took to FILE in the Chrome trace event format (chrome://tracing, Perfetto)")
+    options = parser.parse_args()
+    is_bytecode = options.filename is not None and options.filename.endswith(bytecode_file.EXTENSION)
+    if (options.compile_only or is_bytecode or options.workers or options.stack_depth) and options.engine != "vm":
+        parser.error("bytecode files, worker processes and --stack-depth can only be used with the vm engine")
+    if options.workers is not None and (not options.batch or options.workers < 1):
+        parser.error("--workers needs --batch and at least one worker")
+    if options.batch_size < 1:
+        parser.error("--batch-size needs to be at least one")
+    if options.memoize and (options.engine not in ["vm", "debug"] or (options.batch and not options.workers) or options.memo_size < 1):
+        parser.error("--memoize can only be used with the vm and debug engines, not with numpy --batch lanes, and needs a --memo-size of at least one")
+    if options.compiled_parser and (options.packrat or options.parse_stats):
+        parser.error("the compiled parser has no packrat table or parse stats")
+    profiling = options.profile or options.profile_json
+    if options.stream and (options.engine == "tree" or options.filename is None or is_bytecode or options.batch or options.compile_only or
+                           profiling or options.optimize or options.specialize_report or options.memoize):
+        parser.error("--stream needs a source file and cannot be combined with the tree engine, --batch, --compile-only, --profile, "
+                     "--optimize, --specialize-report or --memoize")
+    if profiling and (options.filename is None or is_bytecode or options.batch or options.compile_only):
+        parser.error("--profile needs a source file and cannot be combined with --batch or --compile-only")
+    if options.trace:
+        tracing.install(tracing.ChromeTraceSink(options.trace))
+    try:
+        with tracing.span("tinycps", file=options.filename or "<repl>", engine=options.engine):
+            evaluate(options, is_bytecode, profiling)
+    finally:
+        sink = tracing.install(None)
+        try:
+            sink.close()
+        except (IOError, OSError) as e:
+            print "Could not write %s: %s" % (options.trace, str(e))
 
             
 if __name__ == "__main__":
@@ -0,0 +1,298 @@
+"""
+Runs one compiled program over many inputs at once, SIMD style, using numpy.
+
+Every input is a lane. Lanes at the same instruction are kept together in a group,
+and since the stack shape at each instruction is fixed, the stack of a group is a
+list of columns: a numpy array holding that stack slot for every lane, or a
+ClosureColumn when the slot holds closures of the same lambda in every lane.
+Pushes, arithmetic and comparisons then operate on whole columns. CondBranch
+splits a group when its lanes disagree, and groups that meet at the same
+instruction with the same stack shape are merged again.
+
+Instructions without a columnar implementation are evaluated lane by lane with the
+ordinary vm, after which the lanes are regrouped. So is column arithmetic that numpy
+reports an error for, such as a division by zero, so that exactly the lanes a single
+run would fail on fail. A lane that raises a runtime error gets a LaneFailure as its
+result and the other lanes carry on.
+
+Numbers are held in numpy arrays. Integer arithmetic whose result could leave the
+range of a fixed width column is done again on object columns of python ints, so
+results are exact like those of a single run, and every result is returned as the
+python value a single run would give.
+"""
+
+import vm
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COLUMN_OPERATIONS = {
+    vm.AddInst: lambda lhs, rhs: numpy.add(lhs, rhs),
+    vm.SubInst: lambda lhs, rhs: numpy.subtract(lhs, rhs),
+    vm.MulInst: lambda lhs, rhs: numpy.multiply(lhs, rhs),
+    vm.LessInst: lambda lhs, rhs: numpy.less(lhs, rhs),
+    vm.EqInst: lambda lhs, rhs: numpy.equal(lhs, rhs),
+    vm.ModInst: lambda lhs, rhs: numpy.mod(lhs, rhs),
+    vm.DivInst: lambda lhs, rhs: numpy.floor_divide(lhs, rhs),
+}
+
+# The largest magnitude an int64 column holds exactly.
+INT_LIMIT = 2 ** 63 - 1
+
+# The largest magnitude of any value in an integer column, as a python int. The
+# absolute value of the smallest int64 wraps around to itself.
+def magnitude(column):
+    largest = int(numpy.maximum.reduce(numpy.abs(column)))
+    return largest if largest >= 0 else INT_LIMIT + 1
+
+# Bounds the magnitude of the result of instr from those of its operands.
+RESULT_BOUNDS = {
+    vm.AddInst: lambda lhs, rhs: lhs + rhs,
+    vm.SubInst: lambda lhs, rhs: lhs + rhs,
+    vm.MulInst: lambda lhs, rhs: lhs * rhs,
+    # floor division rounds away from zero for negative quotients
+    vm.DivInst: lambda lhs, rhs: lhs + 1,
+}
+
+# Applies the arithmetic instruction instr to two columns. When the result is an
+# integer column that might have wrapped around in some lane, the operation is done
+# again on python ints.
+def column_arithmetic(instr, lhs, rhs):
+    result = COLUMN_OPERATIONS[type(instr)](lhs, rhs)
+    bound = RESULT_BOUNDS.get(type(instr))
+    if bound is None or result.dtype.kind not in "iu" or bound(magnitude(lhs), magnitude(rhs)) <= INT_LIMIT:
+        return result
+    return COLUMN_OPERATIONS[type(instr)](lhs.astype(object), rhs.astype(object))
+
+# The closures of one lambda across the lanes of a group. env holds one column per
+# captured value.
+class ClosureColumn(object):
+    def __init__(self, label, arg_count, env):
+        super(ClosureColumn, self).__init__()
+        self.label = label
+        self.arg_count = arg_count
+        self.env = env
+
+    def __repr__(self):
+        return "ClosureColumn(%s, %i, %i)" % (self.label, self.arg_count, len(self.env))
+
+FINISH_COLUMN = ClosureColumn(vm.FINISH, 1, [])
+
+# A lane whose run raised a runtime error. It takes the place of the result.
+class LaneFailure(object):
+    def __init__(self, description):
+        super(LaneFailure, self).__init__()
+        self.description = description
+
+    def __repr__(self):
+        return "LaneFailure(%s)" % repr(self.description)
+
+    def __str__(self):
+        return "Runtime error: " + self.description
+
+# A set of lanes at the same instruction. lanes holds the input index of every lane.
+class Group(object):
+    def __init__(self, ip, lanes, columns):
+        super(Group, self).__init__()
+        self.ip = ip
+        self.lanes = lanes
+        self.columns = columns
+
+    def signature(self):
+        return (self.ip, tuple([column_signature(column) for column in self.columns]))
+
+def column_signature(column):
+    if isinstance(column, ClosureColumn):
+        return (column.label, column.arg_count, tuple([column_signature(env) for env in column.env]))
+    return column.dtype.str
+
+def take(column, indices):
+    if isinstance(column, ClosureColumn):
+        return ClosureColumn(column.label, column.arg_count, [take(env, indices) for env in column.env])
+    return column[indices]
+
+def concatenate(columns):
+    first = columns[0]
+    if isinstance(first, ClosureColumn):
+        env = [concatenate([column.env[idx] for column in columns]) for idx in range(len(first.env))]
+        return ClosureColumn(first.label, first.arg_count, env)
+    return numpy.concatenate(columns)
+
+def merge(groups):
+    if len(groups) == 1:
+        return groups[0]
+    columns = [concatenate([group.columns[idx] for group in groups]) for idx in range(len(groups[0].columns))]
+    return Group(groups[0].ip, numpy.concatenate([group.lanes for group in groups]), columns)
+
+# Converts between columns and the values of a single lane in the vm's representation.
+def lane_value(column, lane):
+    if isinstance(column, ClosureColumn):
+        if column.label == vm.FINISH:
+            return [vm.FINISH]
+        return [column.label, column.arg_count] + [lane_value(env, lane) for env in column.env]
+    value = column[lane]
+    # lists and vectors are held in object columns as they are, numbers become python
+    # numbers again
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+def value_signature(value):
+    if isinstance(value, list):
+        if value[0] == vm.FINISH:
+            return (vm.FINISH, 1, ())
+        return (value[0], value[1], tuple([value_signature(env) for env in value[2:]]))
+    return type(value)
+
+def column_from_values(values):
+    first = values[0]
+    if isinstance(first, list):
+        if first[0] == vm.FINISH:
+            return FINISH_COLUMN
+        env = [column_from_values([value[idx] for value in values]) for idx in range(2, len(first))]
+        return ClosureColumn(first[0], first[1], env)
+    return numpy.array(values)
+
+# Leaves a group at the start of the lambda in closure, called with args.
+def enter_closure(group, closure, args, jump_table, finished):
+    if closure.label == vm.FINISH:
+        finished.append((group.lanes, args[-1]))
+        return []
+    return [Group(jump_table[closure.label], group.lanes, closure.env + args)]
+
+# Finishes lanes with a LaneFailure for error, raised at ip.
+def fail(lanes, error, ip, instructions, jump_table, finished):
+    error.ip = ip
+    error.jump_table = jump_table
+    error.prog = instructions
+    finished.append((lanes, [LaneFailure(str(error))] * len(lanes)))
+
+# Evaluates one instruction separately in every lane of the group.
+def evaluate_lanes(group, instructions, jump_table, finished):
+    regrouped = {}
+    for lane in range(len(group.lanes)):
+        stack = [lane_value(column, lane) for column in group.columns]
+        try:
+            ip = instructions[group.ip].evaluate(stack, group.ip, jump_table)
+        except vm.RuntimeException as e:
+            fail(group.lanes[lane:lane + 1], e, group.ip, instructions, jump_table, finished)
+            continue
+        except vm.OPERAND_ERRORS as e:
+            fail(group.lanes[lane:lane + 1], vm.RuntimeException(str(e)), group.ip, instructions, jump_table, finished)
+            continue
+        if ip == vm.FINISH_IP:
+            finished.append((group.lanes[lane:lane + 1], numpy.array([stack[-1]])))
+            continue
+        key = (ip, tuple([value_signature(value) for value in stack]))
+        regrouped.setdefault(key, []).append((group.lanes[lane], stack))
+    groups = []
+    for ((ip, _), entries) in regrouped.items():
+        lanes = numpy.array([lane for (lane, _) in entries])
+        stacks = [stack for (_, stack) in entries]
+        columns = [column_from_values([stack[idx] for stack in stacks]) for idx in range(len(stacks[0]))]
+        groups.append(Group(ip, lanes, columns))
+    return groups
+
+# Runs a group until it jumps, returning the groups it turned into.
+def run_block(group, instructions, jump_table, finished):
+    columns = group.columns
+    count = len(group.lanes)
+    while True:
+        instr = instructions[group.ip]
+        if isinstance(instr, vm.PushConst):
+            if instr.value == [vm.FINISH]:
+                columns.append(FINISH_COLUMN)
+            else:
+                columns.append(numpy.repeat(numpy.array([instr.value]), count))
+        elif isinstance(instr, vm.PushRel):
+            columns.append(columns[instr.offset])
+        elif isinstance(instr, vm.PushClosure):
+            columns.append(ClosureColumn(instr.label, instr.arg_count, [columns[offset] for offset in instr.offsets]))
+        elif isinstance(instr, vm.PushThunk):
+            columns.append(ClosureColumn(instr.label, instr.arg_count, []))
+        elif isinstance(instr, vm.Pop):
+            del columns[-1]
+        elif isinstance(instr, vm.JumpLabel):
+            if instr.label not in jump_table:
+                raise vm.RuntimeException("In JumpLabel: there is no entry for %s in the jump table." % str(instr.label))
+            return [Group(jump_table[instr.label], group.lanes, columns[len(columns) - instr.arg_count:])]
+        elif isinstance(instr, vm.JumpLambda) and isinstance(columns[instr.offset], ClosureColumn):
+            closure = columns[instr.offset]
+            return enter_closure(group, closure, columns[len(columns) - closure.arg_count:], jump_table, finished)
+        elif isinstance(instr, vm.ARITHMETIC_INSTRUCTIONS) and isinstance(columns[-3], ClosureColumn):
+            try:
+                result = column_arithmetic(instr, columns[-2], columns[-1])
+            except vm.OPERAND_ERRORS:
+                # find out lane by lane which ones fail, and what the others get
+                return evaluate_lanes(Group(group.ip, group.lanes, columns), instructions, jump_table, finished)
+            args = columns[:-2] + [result]
+            closure = columns[-3]
+            return enter_closure(group, closure, args[len(args) - closure.arg_count:], jump_table, finished)
+        elif isinstance(instr, vm.CondBranch) and isinstance(columns[-2], ClosureColumn) and isinstance(columns[-1], ClosureColumn):
+            test = columns[-3].astype(bool)
+            cont = columns[-4]
+            groups = []
+            for (branch, mask) in [(columns[-2], test), (columns[-1], ~test)]:
+                indices = numpy.nonzero(mask)[0]
+                if len(indices) == 0:
+                    continue
+                branch_group = Group(group.ip, group.lanes[indices], [take(column, indices) for column in columns])
+                args = [take(cont, indices)]
+                groups += enter_closure(branch_group, take(branch, indices), args[len(args) - branch.arg_count:], jump_table, finished)
+            return groups
+        else:
+            return evaluate_lanes(Group(group.ip, group.lanes, columns), instructions, jump_table, finished)
+        group.ip += 1
+
+# The groups main starts in. The rows of a numpy array all have the same types, but
+# records of python values are grouped by the types of their values, so that an int
+# argument is not turned into a float by a float in another record.
+def input_groups(inputs):
+    if isinstance(inputs, numpy.ndarray):
+        if inputs.ndim == 1:
+            inputs = inputs.reshape((len(inputs), 1))
+        columns = [FINISH_COLUMN] + [numpy.ascontiguousarray(inputs[:, idx]) for idx in range(inputs.shape[1])]
+        return [Group(0, numpy.arange(len(inputs)), columns)]
+    records = [record if isinstance(record, tuple) else (record,) for record in inputs]
+    same_types = {}
+    for (lane, record) in enumerate(records):
+        same_types.setdefault(tuple([value_signature(value) for value in record]), []).append(lane)
+    groups = []
+    for lanes in same_types.values():
+        columns = [column_from_values([records[lane][idx] for lane in lanes]) for idx in range(len(records[lanes[0]]))]
+        groups.append(Group(0, numpy.array(lanes), [FINISH_COLUMN] + columns))
+    return groups
+
+# Runs main once for every record of inputs, which is an array with one row per run or
+# a sequence of tuples, holding the arguments passed to main after the exit
+# continuation. One dimensional arrays and sequences of single values are taken as the
+# arguments of a main with a single argument. Returns an object array of results, with
+# a LaneFailure for every run that raised a runtime error.
+def run_batch(instructions, jump_table, inputs):
+    if numpy is None:
+        raise Exception("Batch execution requires numpy.")
+    count = len(inputs)
+    results = numpy.empty(count, dtype=object)
+    if count == 0:
+        return results
+    pending = input_groups(inputs)
+    # numpy only warns about a division by zero unless told to raise, see run_block
+    with numpy.errstate(divide="raise", invalid="raise"):
+        while pending:
+            finished = []
+            groups = {}
+            for group in pending:
+                try:
+                    next_groups = run_block(group, instructions, jump_table, finished)
+                except vm.RuntimeException as e:
+                    fail(group.lanes, e, group.ip, instructions, jump_table, finished)
+                    continue
+                for next_group in next_groups:
+                    groups.setdefault(next_group.signature(), []).append(next_group)
+            for (lanes, values) in finished:
+                for idx in range(len(lanes)):
+                    results[lanes[idx]] = lane_value(values, idx)
+            pending = [merge(same) for same in groups.values()]
+    return results
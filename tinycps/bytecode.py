@@ -0,0 +1,668 @@
+"""
+A compact form of the instruction stream produced by expression_tree.Prog.compile.
+
+Each instruction is an integer opcode with up to two integer operands, stored in
+parallel arrays. Labels are resolved to absolute addresses when the blocks are
+assembled, so the program runs without a jump table. Closures in the bytecode vm
+are lists of [address, arg_count] followed by the captured values.
+
+The object-per-instruction vm in vm.py remains available for debugging.
+"""
+
+import operator
+import sys
+from array import array
+
+import persistent
+import vm
+
+POP = 0
+PUSH_CONST = 1
+PUSH_REL = 2
+PUSH_CLOSURE = 3
+PUSH_THUNK = 4
+JUMP_LAMBDA = 5
+JUMP_LABEL = 6
+COND_BRANCH = 7
+ADD = 8
+SUB = 9
+MUL = 10
+LESS = 11
+EQ = 12
+MOD = 13
+# superinstructions, see peephole.py
+ARITH_CONST = 14
+ARITH_TO_LAMBDA = 15
+ARITH_TO_CLOSURE = 16
+BRANCH = 17
+# calls to memoized functions, see vm.MemoJumpLabel
+MEMO_JUMP_LABEL = 18
+MEMO_RETURN = 19
+# the div builtin
+DIV = 20
+# a primitive on lists and vectors: a is its index in persistent.PRIMITIVES, b its
+# argument count
+PRIM = 21
+
+OPCODE_NAMES = ["POP", "PUSH_CONST", "PUSH_REL", "PUSH_CLOSURE", "PUSH_THUNK", "JUMP_LAMBDA",
+                "JUMP_LABEL", "COND_BRANCH", "ADD", "SUB", "MUL", "LESS", "EQ", "MOD",
+                "ARITH_CONST", "ARITH_TO_LAMBDA", "ARITH_TO_CLOSURE", "BRANCH", "MEMO_JUMP_LABEL",
+                "MEMO_RETURN", "DIV", "PRIM"]
+
+# the operation of each arithmetic opcode, used by the fused arithmetic superinstructions
+OPERATIONS = {
+    ADD: operator.add,
+    SUB: operator.sub,
+    MUL: operator.mul,
+    LESS: operator.lt,
+    EQ: operator.eq,
+    MOD: operator.mod,
+    DIV: operator.floordiv,
+}
+
+ARITHMETIC_OPCODES = {
+    vm.AddInst: ADD,
+    vm.SubInst: SUB,
+    vm.MulInst: MUL,
+    vm.LessInst: LESS,
+    vm.EqInst: EQ,
+    vm.ModInst: MOD,
+    vm.DivInst: DIV,
+}
+
+# Opcodes that never transfer control.
+STRAIGHT_OPCODES = set([POP, PUSH_CONST, PUSH_REL, PUSH_CLOSURE, PUSH_THUNK])
+
+# the implementation of each primitive, by index
+PRIMITIVES = [function for (name, arg_count, function) in persistent.PRIMITIVES]
+
+# The exit continuation. Jumping to it ends the program.
+FINISH_CLOSURE = [vm.FINISH_IP]
+
+DEFAULT_STACK_SIZE = 256
+
+# For each address, the number of instructions run from there up to and including the
+# next jump.
+def block_costs(ops):
+    costs = array("i", [0] * len(ops))
+    cost = 0
+    for ip in range(len(ops) - 1, -1, -1):
+        if ops[ip] in STRAIGHT_OPCODES:
+            cost += 1
+        else:
+            cost = 1
+        costs[ip] = cost
+    return costs
+
+# How many values each opcode leaves on the stack, for the opcodes that do not jump.
+# Jumps push at most the values given by JUMP_PUSHES before moving their arguments.
+STACK_EFFECTS = {POP: -1, PUSH_CONST: 1, PUSH_REL: 1, PUSH_CLOSURE: 1, PUSH_THUNK: 1}
+JUMP_PUSHES = {ARITH_TO_LAMBDA: 2, COND_BRANCH: 1, MEMO_JUMP_LABEL: 1, PRIM: 1}
+
+# For each address, the most the stack grows from there up to and including the
+# next jump.
+def block_growth(ops):
+    growth = array("i", [0] * len(ops))
+    grow = 0
+    for ip in range(len(ops) - 1, -1, -1):
+        if ops[ip] in STRAIGHT_OPCODES:
+            grow = max(0, STACK_EFFECTS[ops[ip]] + grow)
+        else:
+            grow = JUMP_PUSHES.get(ops[ip], 0)
+        growth[ip] = grow
+    return growth
+
+# memo is the vm.MemoCache used by the MEMO_ opcodes, if there are any.
+class Bytecode(object):
+    def __init__(self, ops, arg_a, arg_b, consts, labels, entry=0, memo=None):
+        super(Bytecode, self).__init__()
+        self.ops = ops
+        self.arg_a = arg_a
+        self.arg_b = arg_b
+        self.consts = consts
+        self.labels = labels
+        self.entry = entry
+        self.memo = memo
+        self.costs = block_costs(ops)
+        self.growth = block_growth(ops)
+        # entry depth -> the deepest the stack can get, for the entry depths verifier.py
+        # proved this program safe to run on execute_verified with, or None if it failed
+        self.verified = {}
+
+    def __len__(self):
+        return len(self.ops)
+
+    # Indexing returns a readable form of the instruction at that address,
+    # which lets RuntimeException report bytecode the same way as vm instructions.
+    def __getitem__(self, ip):
+        return self.disassemble_instruction(ip)
+
+    def label_at(self, address):
+        for name in self.labels:
+            if self.labels[name] == address:
+                return name
+        return str(address)
+
+    def disassemble_instruction(self, ip):
+        op = self.ops[ip]
+        a = self.arg_a[ip]
+        b = self.arg_b[ip]
+        if op == PUSH_CONST:
+            operands = repr(self.consts[a])
+        elif op == PUSH_REL or op == JUMP_LAMBDA:
+            operands = str(a + 1)
+        elif op == PUSH_CLOSURE:
+            arg_count, offsets = self.consts[b]
+            operands = "%s, %i, [%s]" % (self.label_at(a), arg_count, ", ".join([str(offset + 1) for offset in offsets]))
+        elif op == PUSH_THUNK or op == JUMP_LABEL or op == MEMO_JUMP_LABEL:
+            operands = "%s, %i" % (self.label_at(a), b)
+        elif op == PRIM:
+            operands = "%s, %i" % (persistent.PRIMITIVES[a][0], b)
+        elif op == ARITH_CONST:
+            operands = "%s, %s" % (OPCODE_NAMES[a], repr(self.consts[b]))
+        elif op == ARITH_TO_LAMBDA:
+            arith, lhs, rhs = self.consts[b]
+            operands = "%i, %s, %s, %s" % (a + 1, OPCODE_NAMES[arith], repr(lhs), repr(rhs))
+        elif op == ARITH_TO_CLOSURE:
+            arith, offsets, lhs, rhs = self.consts[b]
+            operands = "%s, %s, %s, %s, %s" % (self.label_at(a), repr(offsets), OPCODE_NAMES[arith], repr(lhs), repr(rhs))
+        elif op == BRANCH:
+            true_address, true_offsets = self.consts[a]
+            false_address, false_offsets = self.consts[b]
+            operands = "%s, %s, %s, %s" % (self.label_at(true_address), repr(true_offsets), self.label_at(false_address), repr(false_offsets))
+        else:
+            operands = ""
+        return "%s(%s)" % (OPCODE_NAMES[op], operands)
+
+    def disassemble(self):
+        lines = []
+        for ip in range(len(self.ops)):
+            for name in sorted(self.labels):
+                if self.labels[name] == ip:
+                    lines.append("%s:" % name)
+            lines.append("  %4i %s" % (ip, self.disassemble_instruction(ip)))
+        return "\n".join(lines)
+
+# Converts the output of Prog.compile to Bytecode, resolving every label through the
+# jump table once, at link time.
+def assemble(instructions, jump_table):
+    ops = array("B")
+    arg_a = array("i")
+    arg_b = array("i")
+    consts = []
+    const_index = {}
+    memo = None
+
+    def add_const(value):
+        key = (type(value), repr(value))
+        if key not in const_index:
+            const_index[key] = len(consts)
+            consts.append(value)
+        return const_index[key]
+
+    def resolve(label):
+        if label not in jump_table:
+            raise Exception("There is no function named %s." % str(label))
+        return jump_table[label]
+
+    for instr in instructions:
+        a = 0
+        b = 0
+        if isinstance(instr, vm.Pop):
+            op = POP
+        elif isinstance(instr, vm.PushConst):
+            op = PUSH_CONST
+            if instr.value == [vm.FINISH]:
+                a = add_const(FINISH_CLOSURE)
+            else:
+                a = add_const(instr.value)
+        elif isinstance(instr, vm.PushRel):
+            op = PUSH_REL
+            a = instr.offset
+        elif isinstance(instr, vm.PushClosure):
+            op = PUSH_CLOSURE
+            a = resolve(instr.label)
+            b = add_const((instr.arg_count, tuple(instr.offsets)))
+        elif isinstance(instr, vm.PushThunk):
+            op = PUSH_THUNK
+            a = resolve(instr.label)
+            b = instr.arg_count
+        elif isinstance(instr, vm.JumpLambda):
+            op = JUMP_LAMBDA
+            a = instr.offset
+        elif isinstance(instr, vm.MemoJumpLabel):
+            op = MEMO_JUMP_LABEL
+            a = resolve(instr.label)
+            b = instr.arg_count
+            memo = instr.cache
+        elif isinstance(instr, vm.MemoReturn):
+            op = MEMO_RETURN
+            memo = instr.cache
+        elif isinstance(instr, vm.JumpLabel):
+            op = JUMP_LABEL
+            a = resolve(instr.label)
+            b = instr.arg_count
+        elif isinstance(instr, vm.CondBranch):
+            op = COND_BRANCH
+        elif type(instr) in ARITHMETIC_OPCODES:
+            op = ARITHMETIC_OPCODES[type(instr)]
+        elif isinstance(instr, vm.PrimInst):
+            op = PRIM
+            a = persistent.PRIMITIVE_INDEX[instr.name]
+            b = instr.arg_count
+        elif isinstance(instr, vm.ArithConst):
+            op = ARITH_CONST
+            a = ARITHMETIC_OPCODES[type(instr.arith)]
+            b = add_const(instr.value)
+        elif isinstance(instr, vm.ArithToLambda):
+            op = ARITH_TO_LAMBDA
+            a = instr.cont_offset
+            b = add_const((ARITHMETIC_OPCODES[type(instr.arith)], instr.lhs, instr.rhs))
+        elif isinstance(instr, vm.ArithToClosure):
+            op = ARITH_TO_CLOSURE
+            a = resolve(instr.label)
+            b = add_const((ARITHMETIC_OPCODES[type(instr.arith)], tuple(instr.offsets), instr.lhs, instr.rhs))
+        elif isinstance(instr, vm.Branch):
+            op = BRANCH
+            a = add_const((resolve(instr.true_label), tuple(instr.true_offsets)))
+            b = add_const((resolve(instr.false_label), tuple(instr.false_offsets)))
+        else:
+            raise Exception("The instruction %s has no bytecode form." % repr(instr))
+        ops.append(op)
+        arg_a.append(a)
+        arg_b.append(b)
+    return Bytecode(ops, arg_a, arg_b, consts, dict(jump_table), memo=memo)
+
+# The value stack of the bytecode vm. values is allocated up front and only ever grows,
+# the live entries are values[:sp]. Jumps move their arguments to the bottom of values
+# in place, so a program that loops in constant stack space runs in constant memory.
+# peak is the deepest the stack has been, to help choose size.
+class ValueStack(object):
+    def __init__(self, values=(), size=DEFAULT_STACK_SIZE):
+        super(ValueStack, self).__init__()
+        self.values = [None] * size
+        self.sp = 0
+        self.peak = 0
+        self.load(values)
+
+    def __len__(self):
+        return self.sp
+
+    def __repr__(self):
+        return "ValueStack(%s)" % repr(self.values[:self.sp])
+
+    def load(self, values):
+        self.sp = len(values)
+        self.peak = max(self.peak, self.sp)
+        if 2 * self.peak >= len(self.values):
+            self.values.extend([None] * (2 * self.peak + 1 - len(self.values)))
+        self.values[:self.sp] = values
+
+    # Makes room for depth values, for execute_verified which never grows values.
+    def reserve(self, depth):
+        if depth >= len(self.values):
+            self.values.extend([None] * (depth + 1 - len(self.values)))
+
+    def top(self):
+        return self.values[self.sp - 1]
+
+# args are passed to main after the exit continuation. A ValueStack can be passed in
+# to reuse its storage or to read its peak depth afterwards, which is only tracked when
+# the program has not been verified for this many arguments.
+def run_bytecode(bytecode, args=(), stack=None):
+    values = [FINISH_CLOSURE] + list(args)
+    if stack is None:
+        stack = ValueStack(values)
+    else:
+        stack.load(values)
+    depth = bytecode.verified.get(len(values))
+    if depth is None:
+        execute(bytecode, stack, bytecode.entry)
+    else:
+        stack.reserve(depth)
+        execute_verified(bytecode, stack, bytecode.entry)
+    return stack.top()
+
+# Runs the program from ip with the given ValueStack until it finishes or its budget of
+# instructions runs out, and returns the new (ip, stack, budget). ip is FINISH_IP once
+# the program has finished, and the result is then on top of the stack.
+# Blocks are charged against the budget as a whole when they are entered, and the first
+# block is always run, so a slice can overrun the budget by less than one block.
+# Entering a block is also when the stack is grown to fit everything the block pushes.
+def execute(bytecode, stack, ip, budget=sys.maxint):
+    ops = bytecode.ops
+    arg_a = bytecode.arg_a
+    arg_b = bytecode.arg_b
+    consts = bytecode.consts
+    costs = bytecode.costs
+    growth = bytecode.growth
+    memo = bytecode.memo
+    memo_return = bytecode.labels.get(vm.MEMO_RETURN)
+    count = len(ops)
+    values = stack.values
+    sp = stack.sp
+    peak = stack.peak
+    if ip < count:
+        budget -= costs[ip]
+        top = sp + growth[ip]
+        if top > peak:
+            peak = top
+            if 2 * top >= len(values):
+                values.extend([None] * (2 * top + 1 - len(values)))
+    try:
+        while ip < count:
+            op = ops[ip]
+            if op == PUSH_REL:
+                values[sp] = values[sp + arg_a[ip]]
+                sp += 1
+                ip += 1
+                continue
+            elif op == PUSH_CONST:
+                values[sp] = consts[arg_a[ip]]
+                sp += 1
+                ip += 1
+                continue
+            elif op == PUSH_CLOSURE:
+                arg_count, offsets = consts[arg_b[ip]]
+                closure = [arg_a[ip], arg_count]
+                for offset in offsets:
+                    closure.append(values[sp + offset])
+                values[sp] = closure
+                sp += 1
+                ip += 1
+                continue
+            elif op == JUMP_LABEL:
+                top = arg_b[ip]
+                values[:top] = values[sp - top:sp]
+                sp = top
+                ip = arg_a[ip]
+            elif op == ARITH_TO_CLOSURE:
+                arith, offsets, lhs, rhs = consts[arg_b[ip]]
+                lhs = lhs[1] if lhs[0] else values[sp + lhs[1]]
+                rhs = rhs[1] if rhs[0] else values[sp + rhs[1]]
+                result = OPERATIONS[arith](lhs, rhs)
+                top = len(offsets)
+                values[:top] = [values[sp + offset] for offset in offsets]
+                values[top] = result
+                sp = top + 1
+                ip = arg_a[ip]
+            elif op == BRANCH:
+                if values[sp - 1]:
+                    address, offsets = consts[arg_a[ip]]
+                else:
+                    address, offsets = consts[arg_b[ip]]
+                cont = values[sp - 2]
+                top = len(offsets)
+                values[:top] = [values[sp + offset] for offset in offsets]
+                values[top] = cont
+                sp = top + 1
+                ip = address
+            else:
+                if op == ARITH_TO_LAMBDA:
+                    arith, lhs, rhs = consts[arg_b[ip]]
+                    lhs = lhs[1] if lhs[0] else values[sp + lhs[1]]
+                    rhs = rhs[1] if rhs[0] else values[sp + rhs[1]]
+                    lamb = values[sp + arg_a[ip]]
+                    values[sp] = lamb
+                    values[sp + 1] = OPERATIONS[arith](lhs, rhs)
+                    sp += 2
+                elif op == ARITH_CONST:
+                    values[sp - 1] = OPERATIONS[arg_a[ip]](values[sp - 1], consts[arg_b[ip]])
+                    lamb = values[sp - 2]
+                elif op == JUMP_LAMBDA:
+                    lamb = values[sp + arg_a[ip]]
+                elif op == COND_BRANCH:
+                    if values[sp - 3]:
+                        lamb = values[sp - 2]
+                    else:
+                        lamb = values[sp - 1]
+                    values[sp] = values[sp - 4]
+                    sp += 1
+                elif ADD <= op <= MOD or op == DIV:
+                    rhs = values[sp - 1]
+                    lhs = values[sp - 2]
+                    sp -= 1
+                    if op == ADD:
+                        values[sp - 1] = lhs + rhs
+                    elif op == SUB:
+                        values[sp - 1] = lhs - rhs
+                    elif op == MUL:
+                        values[sp - 1] = lhs * rhs
+                    elif op == LESS:
+                        values[sp - 1] = lhs < rhs
+                    elif op == EQ:
+                        values[sp - 1] = lhs == rhs
+                    elif op == MOD:
+                        values[sp - 1] = lhs % rhs
+                    else:
+                        values[sp - 1] = lhs // rhs
+                    lamb = values[sp - 2]
+                elif op == PRIM:
+                    # the arguments are replaced by the result
+                    top = sp - arg_b[ip]
+                    values[top] = PRIMITIVES[arg_a[ip]](*values[top:sp])
+                    sp = top + 1
+                    lamb = values[top - 1]
+                elif op == MEMO_JUMP_LABEL:
+                    top = arg_b[ip]
+                    args = values[sp - top:sp]
+                    cont, value = memo.enter((arg_a[ip],) + tuple(args[1:]), args[0], memo_return)
+                    if value is vm.MemoCache.MISS:
+                        # entered like a closure without captured values
+                        values[sp - top] = cont
+                        lamb = [arg_a[ip], top]
+                    else:
+                        values[sp] = value
+                        sp += 1
+                        lamb = cont
+                elif op == MEMO_RETURN:
+                    # the key and continuation captured by MEMO_JUMP_LABEL, then the result
+                    memo.store(values[0], values[sp - 1])
+                    lamb = values[sp - 2]
+                elif op == PUSH_THUNK:
+                    values[sp] = [arg_a[ip], arg_b[ip]]
+                    sp += 1
+                    ip += 1
+                    continue
+                else:
+                    sp -= 1
+                    ip += 1
+                    continue
+                # all of these end by jumping to the continuation in lamb
+                if not isinstance(lamb, list):
+                    raise vm.RuntimeException("Stack value %s is not a lambda." % repr(lamb))
+                ip = lamb[0]
+                if ip == vm.FINISH_IP:
+                    break
+                # the captured values go below the arguments
+                env = len(lamb) - 2
+                top = env + lamb[1]
+                values[env:top] = values[sp - lamb[1]:sp]
+                if env:
+                    values[:env] = lamb[2:]
+                sp = top
+            # every jump lands at the start of a block, which is charged as a whole
+            budget -= costs[ip]
+            if budget < 0:
+                budget += costs[ip]
+                break
+            # values is kept over twice as long as the peak, which leaves room for the
+            # captured values and arguments that a jump moves to the bottom
+            top = sp + growth[ip]
+            if top > peak:
+                peak = top
+                if 2 * top >= len(values):
+                    values.extend([None] * (2 * top + 1 - len(values)))
+        else:
+            raise vm.RuntimeException("Program ended without calling exit continuation.")
+    except vm.RuntimeException as e:
+        e.ip = ip
+        e.prog = bytecode
+        raise e
+    except vm.OPERAND_ERRORS as e:
+        raise vm.RuntimeException(str(e), ip, None, bytecode)
+    finally:
+        stack.sp = sp
+        stack.peak = peak
+    return ip, stack, budget
+
+# The same loop as execute, for programs verifier.py has proved well formed: the stack
+# must already hold the deepest it can get (see ValueStack.reserve), and it runs until
+# the program finishes, without a budget. The jumps do not check that the continuation
+# they enter is a closure; the TypeError raised when it is not becomes the same
+# RuntimeException as in execute, and so do the vm.OPERAND_ERRORS of the operators.
+def execute_verified(bytecode, stack, ip):
+    ops = bytecode.ops
+    arg_a = bytecode.arg_a
+    arg_b = bytecode.arg_b
+    consts = bytecode.consts
+    memo = bytecode.memo
+    memo_return = bytecode.labels.get(vm.MEMO_RETURN)
+    values = stack.values
+    sp = stack.sp
+    # every jump sets lamb before entering it
+    lamb = FINISH_CLOSURE
+    try:
+        while True:
+            op = ops[ip]
+            if op == PUSH_REL:
+                values[sp] = values[sp + arg_a[ip]]
+                sp += 1
+                ip += 1
+                continue
+            elif op == PUSH_CONST:
+                values[sp] = consts[arg_a[ip]]
+                sp += 1
+                ip += 1
+                continue
+            elif op == PUSH_CLOSURE:
+                arg_count, offsets = consts[arg_b[ip]]
+                closure = [arg_a[ip], arg_count]
+                for offset in offsets:
+                    closure.append(values[sp + offset])
+                values[sp] = closure
+                sp += 1
+                ip += 1
+                continue
+            elif op == JUMP_LABEL:
+                top = arg_b[ip]
+                values[:top] = values[sp - top:sp]
+                sp = top
+                ip = arg_a[ip]
+            elif op == ARITH_TO_CLOSURE:
+                arith, offsets, lhs, rhs = consts[arg_b[ip]]
+                lhs = lhs[1] if lhs[0] else values[sp + lhs[1]]
+                rhs = rhs[1] if rhs[0] else values[sp + rhs[1]]
+                result = OPERATIONS[arith](lhs, rhs)
+                top = len(offsets)
+                values[:top] = [values[sp + offset] for offset in offsets]
+                values[top] = result
+                sp = top + 1
+                ip = arg_a[ip]
+            elif op == BRANCH:
+                if values[sp - 1]:
+                    address, offsets = consts[arg_a[ip]]
+                else:
+                    address, offsets = consts[arg_b[ip]]
+                cont = values[sp - 2]
+                top = len(offsets)
+                values[:top] = [values[sp + offset] for offset in offsets]
+                values[top] = cont
+                sp = top + 1
+                ip = address
+            else:
+                if op == ARITH_TO_LAMBDA:
+                    arith, lhs, rhs = consts[arg_b[ip]]
+                    lhs = lhs[1] if lhs[0] else values[sp + lhs[1]]
+                    rhs = rhs[1] if rhs[0] else values[sp + rhs[1]]
+                    lamb = values[sp + arg_a[ip]]
+                    values[sp] = lamb
+                    values[sp + 1] = OPERATIONS[arith](lhs, rhs)
+                    sp += 2
+                elif op == ARITH_CONST:
+                    values[sp - 1] = OPERATIONS[arg_a[ip]](values[sp - 1], consts[arg_b[ip]])
+                    lamb = values[sp - 2]
+                elif op == JUMP_LAMBDA:
+                    lamb = values[sp + arg_a[ip]]
+                elif op == COND_BRANCH:
+                    if values[sp - 3]:
+                        lamb = values[sp - 2]
+                    else:
+                        lamb = values[sp - 1]
+                    values[sp] = values[sp - 4]
+                    sp += 1
+                elif ADD <= op <= MOD or op == DIV:
+                    rhs = values[sp - 1]
+                    lhs = values[sp - 2]
+                    sp -= 1
+                    if op == ADD:
+                        values[sp - 1] = lhs + rhs
+                    elif op == SUB:
+                        values[sp - 1] = lhs - rhs
+                    elif op == MUL:
+                        values[sp - 1] = lhs * rhs
+                    elif op == LESS:
+                        values[sp - 1] = lhs < rhs
+                    elif op == EQ:
+                        values[sp - 1] = lhs == rhs
+                    elif op == MOD:
+                        values[sp - 1] = lhs % rhs
+                    else:
+                        values[sp - 1] = lhs // rhs
+                    lamb = values[sp - 2]
+                elif op == PRIM:
+                    # the arguments are replaced by the result
+                    top = sp - arg_b[ip]
+                    values[top] = PRIMITIVES[arg_a[ip]](*values[top:sp])
+                    sp = top + 1
+                    lamb = values[top - 1]
+                elif op == MEMO_JUMP_LABEL:
+                    top = arg_b[ip]
+                    args = values[sp - top:sp]
+                    cont, value = memo.enter((arg_a[ip],) + tuple(args[1:]), args[0], memo_return)
+                    if value is vm.MemoCache.MISS:
+                        # entered like a closure without captured values
+                        values[sp - top] = cont
+                        lamb = [arg_a[ip], top]
+                    else:
+                        values[sp] = value
+                        sp += 1
+                        lamb = cont
+                elif op == MEMO_RETURN:
+                    # the key and continuation captured by MEMO_JUMP_LABEL, then the result
+                    memo.store(values[0], values[sp - 1])
+                    lamb = values[sp - 2]
+                elif op == PUSH_THUNK:
+                    values[sp] = [arg_a[ip], arg_b[ip]]
+                    sp += 1
+                    ip += 1
+                    continue
+                else:
+                    sp -= 1
+                    ip += 1
+                    continue
+                # all of these end by jumping to the continuation in lamb, which
+                # raises TypeError below if it is not a closure
+                ip = lamb[0]
+                if ip == vm.FINISH_IP:
+                    break
+                # the captured values go below the arguments
+                env = len(lamb) - 2
+                top = env + lamb[1]
+                values[env:top] = values[sp - lamb[1]:sp]
+                if env:
+                    values[:env] = lamb[2:]
+                sp = top
+    except TypeError as e:
+        if isinstance(lamb, list):
+            raise vm.RuntimeException(str(e), ip, None, bytecode)
+        raise vm.RuntimeException("Stack value %s is not a lambda." % repr(lamb), ip, None, bytecode)
+    except ArithmeticError as e:
+        raise vm.RuntimeException(str(e), ip, None, bytecode)
+    except vm.RuntimeException as e:
+        e.ip = ip
+        e.prog = bytecode
+        raise e
+    finally:
+        stack.sp = sp
+    return ip, stack
@@ -0,0 +1,202 @@
+"""
+Reading and writing assembled bytecode as .tcpsc files.
+
+A .tcpsc file is laid out as follows, all integers little endian:
+
+    header      magic "TCPSC\\0", format version (u16), instruction count (u32),
+                constant count (u32), label count (u32), entry address (u32),
+                memo cache size (u32, 0 when nothing is memoized)
+    code        one opcode byte per instruction, then the a and b operands as
+                int32 arrays
+    constants   tagged values (see write_const)
+    labels      the entry points of every function: name length (u16), utf-8
+                name, address (u32)
+
+Files are loaded through mmap. The cache stores one file per source file in a
+__tcpscache__ directory next to it, named by a hash of the source and of the
+options that affect code generation.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+import bytecode
+import vm
+
+MAGIC = "TCPSC\0"
+FORMAT_VERSION = 5
+HEADER = struct.Struct("<6sHIIIII")
+CACHE_DIRECTORY = "__tcpscache__"
+EXTENSION = ".tcpsc"
+
+class BytecodeFileException(Exception):
+    pass
+
+def write_const(value, out):
+    if value is bytecode.FINISH_CLOSURE:
+        out.append("F")
+    elif isinstance(value, bool):
+        out.append(struct.pack("<cB", "b", value))
+    elif isinstance(value, (int, long)) and -1 << 63 <= value < 1 << 63:
+        out.append(struct.pack("<cq", "i", value))
+    elif isinstance(value, (int, long)):
+        # ints beyond 64 bits are written as their decimal digits
+        digits = str(value)
+        out.append(struct.pack("<cI", "I", len(digits)) + digits)
+    elif isinstance(value, float):
+        out.append(struct.pack("<cd", "f", value))
+    elif isinstance(value, tuple):
+        out.append(struct.pack("<cI", "t", len(value)))
+        for item in value:
+            write_const(item, out)
+    else:
+        raise BytecodeFileException("The constant %s cannot be written to a bytecode file." % repr(value))
+
+def read_const(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == "F":
+        return bytecode.FINISH_CLOSURE, offset
+    elif tag == "b":
+        return bool(struct.unpack_from("<B", data, offset)[0]), offset + 1
+    elif tag == "i":
+        return struct.unpack_from("<q", data, offset)[0], offset + 8
+    elif tag == "I":
+        length = struct.unpack_from("<I", data, offset)[0]
+        offset += 4
+        try:
+            return int(take(data, offset, length)), offset + length
+        except ValueError:
+            raise BytecodeFileException("The int constant at byte %i is malformed." % offset)
+    elif tag == "f":
+        return struct.unpack_from("<d", data, offset)[0], offset + 8
+    elif tag == "t":
+        count = struct.unpack_from("<I", data, offset)[0]
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = read_const(data, offset)
+            items.append(item)
+        return tuple(items), offset
+    raise BytecodeFileException("Unknown constant tag %s at byte %i." % (repr(tag), offset - 1))
+
+def int32_bytes(values):
+    values = array("i", values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tostring()
+
+def int32_array(data):
+    values = array("i")
+    values.fromstring(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+def take(data, offset, length):
+    if offset + length > len(data):
+        raise BytecodeFileException("The bytecode file is truncated.")
+    return data[offset:offset + length]
+
+def dumps(program):
+    count = len(program.ops)
+    memo_size = program.memo.size if program.memo is not None else 0
+    out = [HEADER.pack(MAGIC, FORMAT_VERSION, count, len(program.consts), len(program.labels), program.entry, memo_size)]
+    out.append(program.ops.tostring())
+    out.append(int32_bytes(program.arg_a))
+    out.append(int32_bytes(program.arg_b))
+    for value in program.consts:
+        write_const(value, out)
+    for name in sorted(program.labels):
+        encoded = name.encode("utf-8")
+        out.append(struct.pack("<H", len(encoded)) + encoded + struct.pack("<I", program.labels[name]))
+    return "".join(out)
+
+def loads(data):
+    if len(data) < HEADER.size:
+        raise BytecodeFileException("The file is too short to be a bytecode file.")
+    magic, version, count, const_count, label_count, entry, memo_size = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise BytecodeFileException("The file is not a bytecode file.")
+    if version != FORMAT_VERSION:
+        raise BytecodeFileException("The bytecode file has format version %i, expected %i." % (version, FORMAT_VERSION))
+    offset = HEADER.size
+    ops = array("B")
+    ops.fromstring(take(data, offset, count))
+    offset += count
+    arg_a = int32_array(take(data, offset, 4 * count))
+    offset += 4 * count
+    arg_b = int32_array(take(data, offset, 4 * count))
+    offset += 4 * count
+    consts = []
+    for _ in range(const_count):
+        value, offset = read_const(data, offset)
+        consts.append(value)
+    labels = {}
+    for _ in range(label_count):
+        length = struct.unpack_from("<H", data, offset)[0]
+        name = take(data, offset + 2, length).decode("utf-8")
+        offset += 2 + length
+        labels[str(name)] = struct.unpack_from("<I", data, offset)[0]
+        offset += 4
+    # the cache itself is never saved, every load starts with an empty one
+    memo = vm.MemoCache(memo_size) if memo_size else None
+    return bytecode.Bytecode(ops, arg_a, arg_b, consts, labels, entry, memo)
+
+def load(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise BytecodeFileException("The bytecode file is empty.")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return loads(data)
+        except (struct.error, IndexError):
+            raise BytecodeFileException("The bytecode file is truncated.")
+        finally:
+            data.close()
+
+# Writes to a temporary file first so that readers never see a partial file.
+def write_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+def save(program, path):
+    write_atomic(path, dumps(program))
+
+# options is a string describing anything besides the source that changes the output.
+def cache_path(source_path, source, options=""):
+    digest = hashlib.sha1("%i\0%s\0%s" % (FORMAT_VERSION, options, source)).hexdigest()
+    directory = os.path.join(os.path.dirname(os.path.abspath(source_path)), CACHE_DIRECTORY)
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(directory, "%s.%s%s" % (name, digest[:16], EXTENSION))
+
+# Returns the cached program or None if there is no usable cache entry.
+def load_cached(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        return load(path)
+    except (IOError, BytecodeFileException):
+        return None
+
+# Failing to write the cache is never an error, the program just gets compiled again.
+def store_cached(program, path):
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        save(program, path)
+    except (IOError, OSError, BytecodeFileException):
+        pass
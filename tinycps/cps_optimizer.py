@@ -0,0 +1,247 @@
+"""
+An optimizer for CPS modules, run on the output of sexp_to_cps before Prog.compile.
+
+Every lambda that survives to Prog.compile becomes a closure allocation and a jump at
+runtime, so the rules here remove lambdas and calls:
+
+- eta: (lambda (x y) (f x y)) is replaced by f.
+- inline: a named function that is referenced exactly once, by a call, is substituted
+  into that call and its definition is dropped. Lambdas passed to it end up as call
+  heads and are beta reduced in turn.
+- fold: arithmetic on two constants and 'if' on a constant test are evaluated, and the
+  result is passed straight into the continuation.
+
+Substitution renames bound variables where needed to avoid capture. The rules assume
+that every closure is called with as many arguments as it takes.
+"""
+
+import operator
+
+import expression_tree
+from expression_tree import Var, Const, Func, FuncLiteral, Call
+
+FOLDS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "<": operator.lt,
+    "=": operator.eq,
+    "%": operator.mod,
+    "div": operator.floordiv,
+}
+
+RULES = ["eta", "inline", "fold"]
+
+MAX_PASSES = 16
+
+# Raised when a substitution would need a call head that is not a symbol or a lambda.
+class NotInlinable(Exception):
+    pass
+
+def size(node):
+    if isinstance(node, FuncLiteral):
+        return 1 + size(node.func)
+    if isinstance(node, Call):
+        return 1 + sum([size(arg) for arg in node.args])
+    if isinstance(node, Func) and not isinstance(node, (expression_tree.Builtin, expression_tree.Finish)):
+        return 1 + size(node.body)
+    return 1
+
+# Counts the free occurrences of symbol in node, as an argument or as a call head.
+def references(node, symbol):
+    if isinstance(node, Var):
+        return 1 if node.symbol == symbol else 0
+    if isinstance(node, FuncLiteral):
+        if symbol in node.func.args:
+            return 0
+        return references(node.func.body, symbol)
+    if isinstance(node, Call):
+        count = 1 if node.func == symbol else 0
+        return count + sum([references(arg, symbol) for arg in node.args])
+    return 0
+
+class CPSOptimizer(object):
+    def __init__(self, module, main="main"):
+        super(CPSOptimizer, self).__init__()
+        self.module = dict(module)
+        self.main = main
+        self.report = dict([(rule, 0) for rule in RULES])
+        self.fresh = 0
+        self.changed = False
+        self.inlined = set()
+
+    def removed(self, rule, before, after):
+        self.report[rule] += size(before) - size(after)
+        self.changed = True
+
+    def fresh_symbol(self, symbol):
+        self.fresh += 1
+        return "%s'%i" % (symbol.split("'")[0], self.fresh)
+
+    # Replaces the free variables in node by the nodes in mapping. Call heads mapped to
+    # lambdas are beta reduced.
+    def substitute(self, node, mapping):
+        if isinstance(node, Var):
+            return mapping.get(node.symbol, node)
+        if isinstance(node, FuncLiteral):
+            func = node.func
+            inner = dict([(symbol, value) for (symbol, value) in mapping.items() if symbol not in func.args])
+            captured = set()
+            for value in inner.values():
+                captured |= value.free_vars()
+            args = []
+            for arg in func.args:
+                if arg in captured:
+                    inner[arg] = Var(self.fresh_symbol(arg))
+                    args.append(inner[arg].symbol)
+                else:
+                    args.append(arg)
+            return FuncLiteral(Func(args, self.substitute(func.body, inner)))
+        if isinstance(node, Call):
+            args = [self.substitute(arg, mapping) for arg in node.args]
+            if node.func not in mapping:
+                return Call(node.func, args)
+            head = mapping[node.func]
+            if isinstance(head, Var):
+                return Call(head.symbol, args)
+            if isinstance(head, FuncLiteral) and len(head.func.args) == len(args):
+                return self.substitute(head.func.body, dict(zip(head.func.args, args)))
+            raise NotInlinable()
+        return node
+
+    # (lambda (x y) (f x y)) -> f, when f means the same thing outside the lambda.
+    def eta(self, node, bound):
+        func = node.func
+        body = func.body
+        if not isinstance(body, Call) or body.func in func.args or len(body.args) != len(func.args):
+            return node
+        for (arg, param) in zip(body.args, func.args):
+            if not isinstance(arg, Var) or arg.symbol != param:
+                return node
+        if body.func not in bound:
+            target = self.module.get(body.func)
+            if body.func in expression_tree.Prog.builtins or not isinstance(target, Func) or len(target.args) != len(func.args):
+                return node
+        reduced = Var(body.func)
+        self.removed("eta", node, reduced)
+        return reduced
+
+    # Passes value to the continuation cont, as a new call or by beta reducing it.
+    def continue_with(self, cont, value):
+        if isinstance(cont, Var):
+            return Call(cont.symbol, [value])
+        if isinstance(cont, FuncLiteral) and len(cont.func.args) == 1:
+            return self.substitute(cont.func.body, {cont.func.args[0]: value})
+        raise NotInlinable()
+
+    def fold(self, call, bound):
+        if call.func in bound:
+            return call
+        args = call.args
+        try:
+            if call.func in FOLDS and len(args) == 3 and isinstance(args[1], Const) and isinstance(args[2], Const):
+                value = FOLDS[call.func](args[1].value, args[2].value)
+                folded = self.continue_with(args[0], Const(value))
+            elif call.func == "if" and len(args) == 4 and isinstance(args[1], Const):
+                branch = args[2] if args[1].value else args[3]
+                cont = args[0]
+                # the continuation may only be copied into the branch if it is small
+                if isinstance(cont, FuncLiteral) and isinstance(branch, FuncLiteral) and references(branch.func.body, branch.func.args[0]) > 1:
+                    return call
+                folded = self.continue_with(branch, cont)
+            else:
+                return call
+        except (NotInlinable, ArithmeticError, TypeError, IndexError):
+            return call
+        self.removed("fold", call, folded)
+        return folded
+
+    def functions(self):
+        return [name for name in self.module if isinstance(self.module[name], Func) and not isinstance(self.module[name], expression_tree.Builtin)]
+
+    # The number of references to each named function from the bodies of all of them.
+    def reference_counts(self):
+        counts = dict([(name, 0) for name in self.module])
+        for func in [self.module[name] for name in self.functions()]:
+            for name in counts:
+                counts[name] += references(FuncLiteral(func), name)
+        return counts
+
+    # Named functions that are referenced once, by a call from another function.
+    def inline_candidates(self):
+        counts = self.reference_counts()
+        candidates = set()
+        for name in self.functions():
+            if name != self.main and counts[name] == 1 and references(self.module[name].body, name) == 0:
+                candidates.add(name)
+        return candidates
+
+    def inline(self, call, bound, candidates):
+        if call.func in bound or call.func not in candidates:
+            return call
+        func = self.module[call.func]
+        if len(func.args) != len(call.args) or (func.free_vars() & bound):
+            return call
+        # lambdas are only moved, never copied
+        for (param, arg) in zip(func.args, call.args):
+            if isinstance(arg, FuncLiteral) and references(func.body, param) > 1:
+                return call
+        try:
+            inlined = self.substitute(func.body, dict(zip(func.args, call.args)))
+        except NotInlinable:
+            return call
+        self.removed("inline", call, inlined)
+        # a substitution may have copied a reference to another candidate, so each
+        # function is inlined at most once per pass
+        candidates.discard(call.func)
+        self.inlined.add(call.func)
+        return inlined
+
+    def rewrite(self, node, bound, candidates):
+        if isinstance(node, FuncLiteral):
+            func = node.func
+            body = self.rewrite(func.body, bound | set(func.args), candidates)
+            return self.eta(FuncLiteral(Func(func.args, body)), bound)
+        if isinstance(node, Call):
+            call = Call(node.func, [self.rewrite(arg, bound, candidates) for arg in node.args])
+            folded = self.fold(call, bound)
+            if folded is not call:
+                return folded
+            return self.inline(call, bound, candidates)
+        return node
+
+    def run_pass(self):
+        self.changed = False
+        candidates = self.inline_candidates()
+        for name in sorted(self.functions()):
+            func = self.module[name]
+            self.module[name] = Func(func.args, self.rewrite(func.body, set(func.args), candidates))
+        # drop the definitions of inlined functions once nothing refers to them
+        counts = self.reference_counts()
+        for name in sorted(self.inlined):
+            if name in self.module and counts[name] == 0:
+                self.report["inline"] += size(self.module[name])
+                del self.module[name]
+        return self.changed
+
+    def optimize(self):
+        for idx in range(MAX_PASSES):
+            if not self.run_pass():
+                break
+        return self.module
+
+# Returns the optimized module and a report mapping each rule to the number of nodes
+# it removed.
+def optimize(module, main="main"):
+    optimizer = CPSOptimizer(module, main)
+    return optimizer.optimize(), optimizer.report
+
+def format_report(report, before, after):
+    lines = ["CPS optimizations (nodes removed):"]
+    for rule in RULES:
+        lines.append("  %-8s %i" % (rule, report[rule]))
+    lines.append("  nodes: %i -> %i" % (before, after))
+    return "\n".join(lines)
+
+def module_size(module):
+    return sum([size(func) for func in module.values() if isinstance(func, Func)])
@@ -1,6 +1,7 @@
 from copy import copy
 
 import vm
+import persistent
 
 class Node(object):
     def __init__(self):
@@ -9,6 +10,10 @@ class Node(object):
     def apply(self, env):
         raise Exception("Cannot call apply on abstract Node. Did you forget to override?")
 
+    # the set of symbols referenced by this node that it does not bind itself
+    def free_vars(self):
+        return set()
+
 class Var(Node):
     def __init__(self, symbol):
         super(Var, self).__init__()
@@ -23,6 +28,9 @@ class Var(Node):
         else:
             raise Exception("The symbol %s is not in the current scope." % self.symbol)
 
+    def free_vars(self):
+        return set([self.symbol])
+
     def instructions(self, name, funcs_list, scope, offset):
         if not self.symbol in scope:
             if self.symbol in funcs_list:
@@ -56,6 +64,9 @@ class Func(Node):
     
     def apply(self, env):
         self.body.apply(env)
+
+    def free_vars(self):
+        return self.body.free_vars() - set(self.args)
     
     def compile(self, name, funcs_list, scope={}, offset=0):
         if not isinstance(self.body, Call):
@@ -82,12 +93,23 @@ class FuncLiteral(Node):
         new_func = copy(self.func)
         new_func.scope = copy(env)
         return new_func
+
+    def free_vars(self):
+        return self.func.free_vars()
     
+    # Lambdas are compiled to flat closures: only the free variables of the lambda that
+    # are bound in the enclosing scope are captured. Inside the lambda they sit below
+    # its arguments in the order they were captured.
     def instructions(self, name, funcs_list, scope, offset):
         lambda_name = name + "_lambda_" + str(offset)
-        new_functions, instructions = self.func.compile(lambda_name, funcs_list, scope, offset=offset)
+        captured = sorted([var for var in self.func.free_vars() if var in scope])
+        closure_scope = {}
+        for (idx, var) in enumerate(captured):
+            closure_scope[var] = idx - len(captured) + 1
+        new_functions, instructions = self.func.compile(lambda_name, funcs_list, closure_scope)
         new_functions[lambda_name] = instructions
-        return new_functions, [vm.PushLambda(lambda_name, len(self.func.args))]
+        offsets = [scope[var] - offset for var in captured]
+        return new_functions, [vm.PushClosure(lambda_name, len(self.func.args), offsets)]
 
 class Call(Node):
     def __init__(self, func, args):
@@ -109,6 +131,12 @@ class Call(Node):
         for (idx, arg) in enumerate(self.args):
             new_env[to_call.args[idx]] = arg.apply(env)
         to_call.apply(new_env)
+
+    def free_vars(self):
+        free = set([self.func])
+        for arg in self.args:
+            free |= arg.free_vars()
+        return free
     
     def compile(self, name, funcs_list, scope):
         instructions = []
@@ -139,6 +167,9 @@ class Builtin(Func):
     
     def apply(self, env):
         self.impl(env)
+
+    def free_vars(self):
+        return set()
     
     def instructions(self, name, funcs_list, scope, offset):
         return {}, self.instrs(name, scope, offset)
@@ -152,10 +183,55 @@ class Finish(Func):
     
     def apply(self, env):
         print "The result of the program was: %s." % str(env["__final"])
+
+    def free_vars(self):
+        return set()
     
     def instructions(self, name, funcs_list, scope, offset):
         return {}, [vm.PushConst([vm.FINISH])]
 
+# A named function whose results are kept in a vm.MemoCache when Prog.run walks the tree.
+# Only calls whose arguments after the continuation are all constants are cached.
+class MemoFunc(Func):
+    def __init__(self, name, func, cache):
+        super(MemoFunc, self).__init__(func.args, func.body)
+        self.name = name
+        self.cache = cache
+
+    def apply(self, env):
+        args = [env[arg] for arg in self.args[1:]]
+        if all([isinstance(arg, Const) for arg in args]):
+            key = (self.name,) + tuple([arg.value for arg in args])
+            value = self.cache.lookup(key)
+            if value is not vm.MemoCache.MISS:
+                Call(self.args[0], [Const(value)]).apply(env)
+                return
+            env[self.args[0]] = MemoReturn(key, env[self.args[0]], self.cache)
+        else:
+            self.cache.uncacheable += 1
+        self.body.apply(env)
+
+# The continuation a MemoFunc passes on a miss, recording the result before calling ret.
+class MemoReturn(Func):
+    def __init__(self, key, ret, cache):
+        super(MemoReturn, self).__init__(["__result"], self)
+        self.key = key
+        self.ret = ret
+        self.cache = cache
+
+    def __repr__(self):
+        return "<memo %s>" % self.key[0]
+
+    def apply(self, env):
+        if isinstance(env["__result"], Const):
+            self.cache.store(self.key, env["__result"].value)
+        new_env = copy(env)
+        new_env["__ret"] = self.ret
+        Call("__ret", [Var("__result")]).apply(new_env)
+
+    def free_vars(self):
+        return set()
+
 class Prog(object):
     builtins = {}
     
@@ -163,9 +239,15 @@ class Prog(object):
     def register_builtin(self, name, func):
         Prog.builtins[name] = func
     
-    def __init__(self, module, main="main"):
+    # memo is a vm.MemoCache for the results of the named functions it memoizes.
+    def __init__(self, module, main="main", memo=None):
         self.module = module
         self.main = main
+        self.memo = memo
+
+    def memoized(self, name):
+        return (self.memo is not None and name != self.main and name in self.module and
+                isinstance(self.module[name], Func) and self.memo.memoizes(name))
     
     def run(self):
         if self.main not in self.module:
@@ -175,6 +257,9 @@ class Prog(object):
             raise Exception("Invalid module: main is not a function.")
         new_module = copy(Prog.builtins)
         new_module.update(self.module)
+        for name in self.module:
+            if self.memoized(name):
+                new_module[name] = MemoFunc(name, self.module[name], self.memo)
         new_module[main.args[0]] = Finish()
         main.apply(new_module)
     
@@ -192,6 +277,8 @@ class Prog(object):
                 other_funcs, instructions = self.module[func_name].compile(func_name, self.module)
                 func_instr_blocks.update(other_funcs)
                 func_instr_blocks[func_name] = instructions
+        if self.memo is not None:
+            self.memoize(func_instr_blocks)
         # stitch the blocks together and generate the jump table
         instrs = func_instr_blocks[self.main]
         del func_instr_blocks[self.main]
@@ -205,6 +292,19 @@ class Prog(object):
             idx += len(func)
         return instrs, jump_table
 
+    # Turns direct calls to memoized functions into MemoJumpLabels and adds the block
+    # they return through.
+    def memoize(self, func_instr_blocks):
+        memoized = False
+        for func_name in func_instr_blocks:
+            instructions = func_instr_blocks[func_name]
+            for (idx, instr) in enumerate(instructions):
+                if type(instr) is vm.JumpLabel and self.memoized(instr.label):
+                    instructions[idx] = vm.MemoJumpLabel(instr.label, instr.arg_count, self.memo)
+                    memoized = True
+        if memoized:
+            func_instr_blocks[vm.MEMO_RETURN] = [vm.MemoReturn(self.memo)]
+
 add_node = Builtin( ["a", "b"], 
                     lambda env: Call("ret", [Const(env["a"].value + env["b"].value)]).apply(env),
                     lambda name, scope, offset: [vm.AddInst()])
@@ -235,6 +335,26 @@ mod_node = Builtin(  ["a", "b"],
                     lambda name, scope, offset: [vm.ModInst()])
 Prog.register_builtin("%", mod_node)
 
+div_node = Builtin(  ["a", "b"],
+                    lambda env: Call("ret", [Const(env["a"].value // env["b"].value)]).apply(env),
+                    lambda name, scope, offset: [vm.DivInst()])
+Prog.register_builtin("div", div_node)
+
+# Registers the primitives on lists and vectors. Under Prog.run closures are Funcs
+# rather than Consts, and are stored in collections as they are.
+def primitive_node(name, arg_count, function):
+    args = ["x%i" % idx for idx in range(arg_count)]
+    def impl(env):
+        values = [env[arg].value if isinstance(env[arg], Const) else env[arg] for arg in args]
+        result = function(*values)
+        new_env = copy(env)
+        new_env["__result"] = result if isinstance(result, Func) else Const(result)
+        Call("ret", [Var("__result")]).apply(new_env)
+    return Builtin(args, impl, lambda name_, scope, offset: [vm.PrimInst(name, arg_count, function)])
+
+for (name, arg_count, function) in persistent.PRIMITIVES:
+    Prog.register_builtin(name, primitive_node(name, arg_count, function))
+
 def if_func(env):
     res = bool(env["cond"].value)
     if res:
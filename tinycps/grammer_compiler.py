@@ -0,0 +1,218 @@
+"""
+Compiles a Grammer into a specialized recursive descent parser in python source.
+
+Every rule reachable from start becomes one function taking the input string and a
+position and returning (matched, end, production). The combinators of a rule are
+inlined into its function: Seq and Or become runs of statements guarded by whether
+everything so far matched, Star and Plus become while loops, Charsets become
+compiled regular expressions and Refs become direct calls to the rule functions.
+Postprocessors are called only where they are not the identity.
+
+The generated source is written to a module in the user's cache directory
+($XDG_CACHE_HOME/tinycps, or ~/.cache/tinycps), named by its hash, so python caches its
+bytecode like any other module. The file is written atomically, and one that does not
+hold the generated source (cut short by a crash, say) is written again. The
+postprocessors and charsets that cannot be written as source are bound into the
+module when it is loaded.
+
+A CompiledGrammer parses exactly like the grammer it was compiled from, without the
+packrat table and the parse stats.
+"""
+
+import hashlib
+import imp
+import os
+import re
+import sys
+
+import bytecode_file
+import parser_combinator
+from parser_combinator import Ref, Word, Opt, Charset, Seq, Or, Star, Plus, Stream
+
+CACHE_DIRECTORY = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "tinycps")
+
+class GrammerCompiler(object):
+    def __init__(self, grammer):
+        super(GrammerCompiler, self).__init__()
+        self.grammer = grammer
+        # name -> object, for everything the generated code refers to but cannot spell
+        self.values = {}
+        self.regexes = []
+        self.rules = []
+        self.count = 0
+
+    def fresh(self):
+        self.count += 1
+        return self.count
+
+    def value(self, prefix, obj):
+        name = "%s_%i" % (prefix, len(self.values))
+        self.values[name] = obj
+        return name
+
+    # The expression applying node's postprocessor to expr.
+    def post(self, node, expr):
+        if node.postprocessor is parser_combinator.identity:
+            return expr
+        return "%s(%s)" % (self.value("post", node.postprocessor), expr)
+
+    def regex(self, charset):
+        if isinstance(charset, basestring):
+            pattern = "[%s]+" % re.escape(charset)
+        else:
+            pattern = "%s+" % charset.pattern
+        self.regexes.append(pattern)
+        return "regex_%i" % (len(self.regexes) - 1)
+
+    # Appends to lines the statements that match node at the position in the variable
+    # pos and leave the outcome in ok_N, end_N and val_N. Returns N.
+    def emit(self, node, pos, lines, indent):
+        n = self.fresh()
+        pad = "    " * indent
+        result = "ok_%i, end_%i, val_%i = " % (n, n, n)
+        fail = pad + result + "False, %s, None" % pos
+        if isinstance(node, Ref):
+            if node.reference not in self.rules:
+                self.rules.append(node.reference)
+            lines.append(pad + result + "rule_%s(string, %s)" % (node.reference, pos))
+        elif isinstance(node, Word):
+            lines.append(pad + "if string.startswith(%s, %s):" % (repr(node.symbol), pos))
+            lines.append(pad + "    " + result + "True, %s + %i, %s" % (pos, len(node.symbol), self.post(node, "None")))
+            lines.append(pad + "else:")
+            lines.append("    " + fail)
+        elif isinstance(node, Charset) and node.regex is not None:
+            lines.append(pad + "match = %s.match(string, %s)" % (self.regex(node.charset), pos))
+            lines.append(pad + "if match:")
+            lines.append(pad + "    " + result + "True, match.end(), %s" % self.post(node, "match.group()"))
+            lines.append(pad + "else:")
+            lines.append("    " + fail)
+        elif isinstance(node, Charset):
+            charset = self.value("charset", node.charset)
+            lines.append(pad + "end_%i = %s" % (n, pos))
+            lines.append(pad + "while end_%i < len(string) and string[end_%i] in %s:" % (n, n, charset))
+            lines.append(pad + "    end_%i += 1" % n)
+            lines.append(pad + "if end_%i > %s:" % (n, pos))
+            lines.append(pad + "    " + result + "True, end_%i, %s" % (n, self.post(node, "string[%s:end_%i]" % (pos, n))))
+            lines.append(pad + "else:")
+            lines.append("    " + fail)
+        elif isinstance(node, Opt):
+            sub = self.emit(node.subparser, pos, lines, indent)
+            lines.append(pad + "if ok_%i:" % sub)
+            lines.append(pad + "    " + result + "True, end_%i, %s" % (sub, self.post(node, "val_%i" % sub)))
+            lines.append(pad + "else:")
+            lines.append(pad + "    " + result + "True, %s, None" % pos)
+        elif isinstance(node, Seq):
+            lines.append(pad + "ok_%i, end_%i, vals_%i = True, %s, []" % (n, n, n, pos))
+            for parser in node.subparsers:
+                lines.append(pad + "if ok_%i:" % n)
+                sub = self.emit(parser, "end_%i" % n, lines, indent + 1)
+                lines.append(pad + "    if ok_%i:" % sub)
+                lines.append(pad + "        end_%i = end_%i" % (n, sub))
+                lines.append(pad + "        if val_%i is not None:" % sub)
+                lines.append(pad + "            vals_%i.append(val_%i)" % (n, sub))
+                lines.append(pad + "    else:")
+                lines.append(pad + "        ok_%i = False" % n)
+            lines.append(pad + "if ok_%i:" % n)
+            lines.append(pad + "    val_%i = %s" % (n, self.post(node, "vals_%i" % n)))
+            lines.append(pad + "else:")
+            lines.append("    " + fail)
+        elif isinstance(node, Or):
+            lines.append(fail)
+            for parser in node.subparsers:
+                lines.append(pad + "if not ok_%i:" % n)
+                sub = self.emit(parser, pos, lines, indent + 1)
+                lines.append(pad + "    if ok_%i:" % sub)
+                lines.append(pad + "        " + result + "True, end_%i, %s" % (sub, self.post(node, "val_%i" % sub)))
+        elif isinstance(node, (Star, Plus)):
+            lines.append(pad + "end_%i, vals_%i = %s, []" % (n, n, pos))
+            lines.append(pad + "while True:")
+            sub = self.emit(node.subparser, "end_%i" % n, lines, indent + 1)
+            lines.append(pad + "    if not ok_%i:" % sub)
+            lines.append(pad + "        break")
+            lines.append(pad + "    if val_%i is not None:" % sub)
+            lines.append(pad + "        vals_%i.append(val_%i)" % (n, sub))
+            lines.append(pad + "    end_%i = end_%i" % (n, sub))
+            if isinstance(node, Plus):
+                # like Plus.apply, this counts productions rather than matches
+                lines.append(pad + "if vals_%i:" % n)
+                lines.append(pad + "    " + result + "True, end_%i, %s" % (n, self.post(node, "vals_%i" % n)))
+                lines.append(pad + "else:")
+                lines.append("    " + fail)
+            else:
+                lines.append(pad + result + "True, end_%i, %s" % (n, self.post(node, "vals_%i" % n)))
+        else:
+            raise Exception("The parser %s cannot be compiled." % repr(node))
+        return n
+
+    def rule(self, name):
+        lines = ["def rule_%s(string, pos):" % name]
+        n = self.emit(self.grammer.resolve(name), "pos", lines, 1)
+        lines.append("    return ok_%i, end_%i, val_%i" % (n, n, n))
+        return lines
+
+    def source(self):
+        self.rules = ["start"]
+        functions = []
+        idx = 0
+        # compiling a rule adds the rules it refers to
+        while idx < len(self.rules):
+            functions += self.rule(self.rules[idx]) + [""]
+            idx += 1
+        header = ['"""Generated by grammer_compiler from %s."""' % type(self.grammer).__name__, "", "import re", ""]
+        header += ["regex_%i = re.compile(%s)" % (idx, repr(pattern)) for (idx, pattern) in enumerate(self.regexes)]
+        return "\n".join(header + [""] + functions)
+
+# A parser generated from a Grammer, with the same parse method.
+class CompiledGrammer(object):
+    def __init__(self, module):
+        super(CompiledGrammer, self).__init__()
+        self.module = module
+
+    def parse(self, s):
+        if isinstance(s, Stream):
+            string, position = s.string, s.position
+        else:
+            string, position = s, 0
+        ok, end, production = self.module.rule_start(string, position)
+        if not ok:
+            return Stream(string, position), False, None
+        return Stream(string, end), True, production
+
+# Returns whether the file at path holds exactly source.
+def holds(path, source):
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read() == source
+
+def load_module(name, source, cache_directory):
+    if cache_directory is not None:
+        path = os.path.join(cache_directory, name + ".py")
+        try:
+            if not holds(path, source):
+                if not os.path.isdir(cache_directory):
+                    os.makedirs(cache_directory)
+                bytecode_file.write_atomic(path, source)
+            module = imp.load_source(name, path)
+            # every load gets its own module, because the values bound into it belong
+            # to one grammer instance
+            del sys.modules[name]
+            return module
+        except (IOError, OSError, SyntaxError, EOFError, ValueError, ImportError):
+            # the cached .pyc can still be broken, which is no reason to fail the parse
+            sys.modules.pop(name, None)
+    # without a usable cache directory the module only lives in memory
+    module = imp.new_module(name)
+    exec compile(source, "<%s>" % name, "exec") in module.__dict__
+    return module
+
+# Compiles grammer (an instance of a Grammer subclass) and returns a CompiledGrammer.
+# cache_directory may be None to never write the generated module.
+def compile_grammer(grammer, cache_directory=CACHE_DIRECTORY):
+    compiler = GrammerCompiler(grammer)
+    source = compiler.source()
+    name = "grammer_%s_%s" % (type(grammer).__name__.lower(), hashlib.sha1(source).hexdigest()[:16])
+    module = load_module(name, source, cache_directory)
+    for value_name in compiler.values:
+        setattr(module, value_name, compiler.values[value_name])
+    return CompiledGrammer(module)
@@ -0,0 +1,116 @@
+"""
+Evaluates one compiled program over many argument tuples on a pool of worker processes.
+
+The assembled program is serialized once (in the .tcpsc format of bytecode_file) and
+handed to every worker when the pool starts, so jobs only carry their arguments.
+Inputs are sent to the workers in chunks and results come back in input order. Only a
+few chunks per worker are taken from the inputs at a time, so the inputs can be an
+iterator over more arguments than fit in memory.
+"""
+
+import itertools
+import multiprocessing
+import os
+import time
+
+import bytecode
+import bytecode_file
+import verifier
+import vm
+
+# The chunks per worker that are handed to the pool at a time.
+CHUNKS_IN_FLIGHT = 4
+
+# A job whose run raised a runtime error. It takes the place of the result.
+class JobFailure(object):
+    def __init__(self, description):
+        super(JobFailure, self).__init__()
+        self.description = description
+
+    def __repr__(self):
+        return "JobFailure(%s)" % repr(self.description)
+
+    def __str__(self):
+        return "Runtime error: " + self.description
+
+# The program of the current worker process, set once by init_worker, and whether to
+# verify it for the number of arguments of each job.
+worker_program = None
+worker_verify = True
+
+def init_worker(data, verify=True):
+    global worker_program, worker_verify
+    worker_program = bytecode_file.loads(data)
+    worker_verify = verify
+
+def run_chunk(chunk):
+    start = time.time()
+    results = []
+    stack = bytecode.ValueStack()
+    for args in chunk:
+        if worker_verify:
+            verifier.try_verify(worker_program, len(args) + 1)
+        try:
+            results.append(bytecode.run_bytecode(worker_program, args, stack))
+        except vm.RuntimeException as e:
+            results.append(JobFailure(str(e)))
+    return os.getpid(), len(chunk), time.time() - start, results
+
+def chunks(inputs, size):
+    chunk = []
+    for args in inputs:
+        chunk.append(tuple(args))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class JobRunner(object):
+    def __init__(self, program, workers=None, chunk_size=256, verify=True):
+        super(JobRunner, self).__init__()
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.Pool(self.workers, init_worker, (bytecode_file.dumps(program), verify))
+        # pid -> [jobs, busy seconds]
+        self.worker_stats = {}
+        self.jobs = 0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    # Yields the result of main for every tuple of arguments in inputs, in order. Pool.imap
+    # would read all of inputs up front, so it is given a window of chunks at a time.
+    def map(self, inputs):
+        start = time.time()
+        pending = chunks(inputs, self.chunk_size)
+        try:
+            while True:
+                window = list(itertools.islice(pending, CHUNKS_IN_FLIGHT * self.workers))
+                if not window:
+                    break
+                for (pid, count, busy, results) in self.pool.imap(run_chunk, window):
+                    stats = self.worker_stats.setdefault(pid, [0, 0.0])
+                    stats[0] += count
+                    stats[1] += busy
+                    self.jobs += count
+                    for result in results:
+                        yield result
+        finally:
+            self.elapsed += time.time() - start
+
+    def format_stats(self):
+        lines = ["Workers: %i, jobs: %i, wall time: %.3fs, %.1f jobs/s" %
+                 (self.workers, self.jobs, self.elapsed, self.jobs / self.elapsed if self.elapsed else 0.0)]
+        for pid in sorted(self.worker_stats):
+            count, busy = self.worker_stats[pid]
+            lines.append("  worker %6i: %8i jobs %8.3fs busy %10.1f jobs/s" % (pid, count, busy, count / busy if busy else 0.0))
+        return "\n".join(lines)
@@ -0,0 +1,121 @@
+"""
+An incremental linker for the REPL, so that each prompt only compiles what changed.
+
+Compiled blocks refer to each other by label through the jump table, never by address,
+so a block can be placed anywhere. The linker keeps one growing instruction list and
+jump table for the whole session. Each definition is compiled once, appended, and its
+labels pointed at the new code. It is only recompiled when it is redefined, or when a
+definition it refers to changes (the compiled code embeds the arity of the functions
+it passes around as values). The entry function is compiled into a scratch area after
+the definitions, which is cut off again once it has run.
+
+Replaced blocks are left behind as dead code until there is more dead code than live
+code, at which point the live blocks are copied down into a fresh list.
+"""
+
+import expression_tree
+import vm
+
+class IncrementalLinker(object):
+    def __init__(self):
+        super(IncrementalLinker, self).__init__()
+        self.instructions = []
+        self.jump_table = {}
+        # definition name -> the Func it was compiled from
+        self.compiled = {}
+        # definition name -> the labels of the blocks compiled from it
+        self.labels = {}
+        # label -> block length
+        self.lengths = {}
+        # name -> the definitions that refer to it
+        self.dependents = {}
+        self.dead = 0
+        self.compiles = 0
+        # the address and labels of the last entry function
+        self.scratch = None
+
+    def __len__(self):
+        return len(self.instructions)
+
+    # The definitions that have to be compiled (again) to link module.
+    def stale(self, module, main):
+        changed = set()
+        for name in module:
+            func = module[name]
+            if name != main and not isinstance(func, expression_tree.Builtin) and self.compiled.get(name) is not func:
+                changed.add(name)
+        removed = set([name for name in self.compiled if name not in module])
+        stale = set(changed)
+        for name in changed | removed:
+            stale |= set([dependent for dependent in self.dependents.get(name, ()) if dependent in module])
+        return stale, removed
+
+    def drop(self, name):
+        for label in self.labels.pop(name, ()):
+            self.dead += self.lengths.pop(label)
+            del self.jump_table[label]
+        func = self.compiled.pop(name, None)
+        if func is not None:
+            for symbol in func.free_vars():
+                self.dependents[symbol].discard(name)
+
+    def append(self, blocks):
+        for label in blocks:
+            self.jump_table[label] = len(self.instructions)
+            self.lengths[label] = len(blocks[label])
+            self.instructions += blocks[label]
+
+    # Copies the live blocks into a new instruction list, dropping the dead ones.
+    def compact(self):
+        instructions = []
+        for label in sorted(self.jump_table, key=self.jump_table.get):
+            start = self.jump_table[label]
+            self.jump_table[label] = len(instructions)
+            instructions += self.instructions[start:start + self.lengths[label]]
+        self.instructions = instructions
+        self.dead = 0
+
+    # Compiles the definitions of module that changed since the last call and the entry
+    # function main, and returns the address of main. Nothing is linked if any of them
+    # fails to compile.
+    def link(self, module, main):
+        if main not in module or not isinstance(module[main], expression_tree.Func):
+            raise Exception("Invalid module: missing entry: %s." % main)
+        stale, removed = self.stale(module, main)
+        compiled = {}
+        for name in stale:
+            other_funcs, instructions = module[name].compile(name, module)
+            other_funcs[name] = instructions
+            compiled[name] = other_funcs
+        main_blocks, instructions = module[main].compile(main, module)
+        main_blocks[main] = instructions
+        for name in stale | removed:
+            self.drop(name)
+        for name in compiled:
+            self.append(compiled[name])
+            self.compiled[name] = module[name]
+            self.labels[name] = compiled[name].keys()
+            for symbol in module[name].free_vars():
+                self.dependents.setdefault(symbol, set()).add(name)
+        self.compiles += len(compiled)
+        if self.dead > len(self.instructions) - self.dead:
+            self.compact()
+        entry = len(self.instructions)
+        self.append(main_blocks)
+        self.scratch = (entry, main_blocks.keys())
+        return entry
+
+    # Removes the blocks of the last entry function.
+    def unlink(self):
+        entry, labels = self.scratch
+        for label in labels:
+            del self.jump_table[label]
+            del self.lengths[label]
+        del self.instructions[entry:]
+
+    def run(self, module, main, args=()):
+        entry = self.link(module, main)
+        try:
+            return vm.run_program(self.instructions, self.jump_table, args, entry)
+        finally:
+            self.unlink()
@@ -6,41 +6,121 @@ stream and a grammer and returns a modified stream, whether a match was made,
 and what was produced by the match, if anything.
 
 The basic parsers are Word, Seq, and Or, but others are provided as a convenience.
+
+Rules are resolved once per Grammer instance. With packrat parsing the result of every
+rule at every position is remembered for the duration of a parse, so backtracking never
+parses the same rule at the same position twice and the number of rule applications is
+linear in the input whatever the grammer. It is off by default, because grammers that
+rarely backtrack far (like the s-expression grammer) run faster without the table.
+Rule applications are only counted in stats with parse_stats, and with neither option
+applying a rule is just applying its parser. Grammers keep their state in the
+attributes resolved, packrat, parse_stats and stats, so rules must not use those names.
+
+Streams match in place, at their position in the input, so no token test copies the
+rest of the input.
 """
 
+import re
+
+# All the streams advanced from one share a table of the streams at each position, so
+# backtracking over the same input reuses them instead of allocating new ones. memo is
+# the packrat table for the position, rule name -> result (see Grammer.apply_rule),
+# created on first use.
 class Stream(object):
-    def __init__(self, string, position=0):
+    def __init__(self, string, position=0, streams=None):
         self.string = string
         self.position = position
+        self.streams = streams if streams is not None else {position: self}
+        self.memo = None
         
     def __repr__(self):
         return "'%s'@%i" % (self.string, self.position)
     
     def advanced(self, characters):
-        return Stream(self.string, self.position + characters)
+        position = self.position + characters
+        stream = self.streams.get(position)
+        if stream is None:
+            stream = Stream(self.string, position, self.streams)
+            self.streams[position] = stream
+        return stream
     
     def startswith(self, prefix):
-        return self.string[self.position:].startswith(prefix)
+        return self.string.startswith(prefix, self.position)
+
+# Counts how rules were applied during the last parse. A re-parse is an evaluation of a
+# rule at a position where it was evaluated before, which only happens without packrat.
+class ParseStats(object):
+    def __init__(self):
+        super(ParseStats, self).__init__()
+        self.applications = 0
+        self.hits = 0
+        self.parses = 0
+        self.reparses = 0
+
+    def __repr__(self):
+        return "%i rule applications, %i packrat hits, %i parses, %i re-parses" % (self.applications, self.hits, self.parses, self.reparses)
 
 class Grammer(object):
+    def __init__(self, packrat=False, parse_stats=False):
+        super(Grammer, self).__init__()
+        self.resolved = {}
+        self.packrat = packrat
+        self.parse_stats = parse_stats
+        self.stats = ParseStats()
+
     def __getitem__(self, name):
         return self.__getattribute__(name)
     
     def start(self):
         raise Exception("Start must be implemented to create a grammer.")
 
+    # The parser for the rule name, built the first time the rule is used.
+    def resolve(self, name):
+        if name not in self.resolved:
+            actual = self[name]
+            if callable(actual):
+                actual = actual()
+            self.resolved[name] = actual
+        return self.resolved[name]
+
+    def apply_rule(self, name, stream):
+        if not (self.packrat or self.parse_stats):
+            return self.resolve(name).apply(stream, self)
+        stats = self.stats
+        stats.applications += 1
+        memo = stream.memo
+        if memo is None:
+            memo = stream.memo = {}
+        if name in memo:
+            if self.packrat:
+                stats.hits += 1
+                return memo[name]
+            stats.reparses += 1
+        stats.parses += 1
+        res = self.resolve(name).apply(stream, self)
+        # without packrat only the rules are remembered, for the stats
+        memo[name] = res if self.packrat else None
+        return res
+
     def parse(self, s):
-        if not isinstance(s, Stream):
+        # a fresh stream, so that no results from an earlier parse are reused
+        if isinstance(s, Stream):
+            s = Stream(s.string, s.position)
+        else:
             s = Stream(s)
-        res = self.start().apply(s, self)
-        return res
+        self.stats = ParseStats()
+        return self.start().apply(s, self)
+
+# the default postprocessor
+def identity(x):
+    return x
 
 class Parser(object):
     # apply is the method which evaluates a parser with the given grammer
     # stream is the current input stream, grammer is a reference to the Grammer object being parsed
     # returns a tuple (stream, matched, production)
     def __init__(self):
-        self.postprocessor = lambda x: x
+        self.postprocessor = identity
     
     def apply(self, stream, grammer):
         raise Exception("apply called on generic Parser.");
@@ -54,11 +134,7 @@ class Ref(Parser):
         return self.reference
     
     def apply(self, stream, grammer):
-        actual = grammer[self.reference]
-        if callable(actual):
-            actual = actual()
-        res = actual.apply(stream, grammer)
-        return res
+        return grammer.apply_rule(self.reference, stream)
 
 # a Word parser matches a constant string against the head of the stream and produces None
 class Word(Parser):
@@ -100,27 +176,41 @@ class Opt(Parser):
 
 # a Charset parser matches any number of characters from the head of the stream that are in its charset
 # it produces the string that it matched
+# strings and charsets with a pattern (a regular expression character class) are matched with a
+# compiled regular expression, any other charset is tested one character at a time
 class Charset(Parser):
     def __init__(self, charset):
         super(Charset, self).__init__()
         self.charset = charset
+        if isinstance(charset, basestring):
+            self.regex = re.compile("[%s]+" % re.escape(charset))
+        elif hasattr(charset, "pattern"):
+            self.regex = re.compile("%s+" % charset.pattern)
+        else:
+            self.regex = None
     
     def __repr__(self):
         return "[%s]" % str(self.charset)
     
     def apply(self, stream, grammer):
-        adv = 0
-        rest = stream.string[stream.position:]
-        while adv < len(rest) and rest[adv] in self.charset:
-            adv += 1
-        if adv > 0:
-            ret = rest[:adv]
-            return (stream.advanced(adv), True, self.postprocessor(ret))
+        string = stream.string
+        start = stream.position
+        if self.regex is not None:
+            match = self.regex.match(string, start)
+            end = match.end() if match else start
+        else:
+            end = start
+            while end < len(string) and string[end] in self.charset:
+                end += 1
+        if end > start:
+            return (stream.advanced(end - start), True, self.postprocessor(string[start:end]))
         else:
             return (stream, False, None)
 
 # an Alpha parser is an alias for a Charset parser that accepts only characters in the range [a, z]
 class AlphaSet(object):
+    pattern = "[a-zA-Z]"
+
     def __repr__(self):
         return "a-zA-z"
     
@@ -132,6 +222,8 @@ def Alpha():
 
 # a Num parser is an alias for a Charset parser that accepts only characters in the range [0, 9]
 class NumSet(object):
+    pattern = "[0-9]"
+
     def __repr__(self):
         return "0-9"
     
@@ -0,0 +1,71 @@
+"""
+A peephole optimizer for the instruction stream produced by expression_tree.Prog.compile.
+
+Each function block is scanned for common instruction sequences, which are replaced by
+the superinstructions defined in vm.py. Rewrites never cross block boundaries, and the
+jump table is rebuilt for the shortened blocks.
+"""
+
+import vm
+
+def is_operand(instr):
+    return isinstance(instr, vm.PushRel) or isinstance(instr, vm.PushConst)
+
+def is_arith(instr):
+    return isinstance(instr, vm.ARITHMETIC_INSTRUCTIONS)
+
+def is_branch_target(instr):
+    return (isinstance(instr, vm.PushClosure) or isinstance(instr, vm.PushThunk)) and instr.arg_count == 1
+
+# Each rule is (name, length, test, rewrite). test and rewrite take the window of
+# instructions the rule looks at. Rules are tried in order at every position.
+RULES = [
+    ("arith-to-closure", 4,
+        lambda w: isinstance(w[0], vm.PushClosure) and w[0].arg_count == 1 and is_operand(w[1]) and is_operand(w[2]) and is_arith(w[3]),
+        lambda w: vm.ArithToClosure(*w)),
+    ("arith-to-lambda", 4,
+        lambda w: isinstance(w[0], vm.PushRel) and is_operand(w[1]) and is_operand(w[2]) and is_arith(w[3]),
+        lambda w: vm.ArithToLambda(*w)),
+    ("arith-const", 2,
+        lambda w: isinstance(w[0], vm.PushConst) and is_arith(w[1]),
+        lambda w: vm.ArithConst(*w)),
+    ("branch", 3,
+        lambda w: is_branch_target(w[0]) and is_branch_target(w[1]) and isinstance(w[2], vm.CondBranch),
+        lambda w: vm.Branch(w[0], w[1])),
+]
+
+def optimize_block(block, report):
+    optimized = []
+    idx = 0
+    while idx < len(block):
+        for (name, length, test, rewrite) in RULES:
+            window = block[idx:idx + length]
+            if len(window) == length and test(window):
+                optimized.append(rewrite(window))
+                report[name] = report.get(name, 0) + 1
+                idx += length
+                break
+        else:
+            optimized.append(block[idx])
+            idx += 1
+    return optimized
+
+# Returns the optimized instructions, the new jump table and a report mapping the name
+# of each rule to the number of times it fired.
+def optimize(instructions, jump_table):
+    report = {}
+    new_instructions = []
+    new_jump_table = {}
+    for (name, block) in vm.split_blocks(instructions, jump_table):
+        new_jump_table[name] = len(new_instructions)
+        new_instructions += optimize_block(block, report)
+    return new_instructions, new_jump_table, report
+
+def format_report(report, before, after):
+    lines = ["Peephole rewrites:"]
+    for name in sorted(report, key=lambda name: -report[name]):
+        lines.append("  %-18s %i" % (name, report[name]))
+    if not report:
+        lines.append("  (none)")
+    lines.append("  instructions: %i -> %i" % (before, after))
+    return "\n".join(lines)
@@ -0,0 +1,263 @@
+"""
+Immutable lists and vectors, the collection values of tinycps programs.
+
+Neither is ever changed in place: every update returns a new value that shares all but
+the changed path with the old one, so keeping old versions around is cheap and values
+can be passed between continuations without copying.
+
+- A List is a chain of cons cells ending in NIL. cons, head and tail are O(1), and
+  every cell knows the length of its list.
+- A Vector is a trie of 32 wide nodes over its elements (like Clojure's vectors), with
+  the last up to 32 elements kept in a separate tail node. nth and assoc follow one
+  path from the root and copy it, which is O(log n) with a base of 32; push usually
+  only copies the tail.
+
+The primitives at the end are the builtins that programs use them through (see
+PRIMITIVES). They raise vm.RuntimeException when they get a value of the wrong kind.
+"""
+
+import vm
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+# Cells and vectors use __slots__ because programs build a lot of them.
+class List(object):
+    __slots__ = ["head", "tail", "length"]
+
+    def __init__(self, head, tail):
+        super(List, self).__init__()
+        self.head = head
+        self.tail = tail
+        self.length = tail.length + 1 if tail is not None else 0
+
+    def items(self):
+        cell = self
+        while cell.length:
+            yield cell.head
+            cell = cell.tail
+
+    def __repr__(self):
+        return "(%s)" % " ".join([str(item) for item in self.items()])
+
+    def __eq__(self, other):
+        if not isinstance(other, List) or self.length != other.length:
+            return False
+        lhs = self
+        rhs = other
+        while lhs is not rhs and lhs.length:
+            if lhs.head != rhs.head:
+                return False
+            lhs = lhs.tail
+            rhs = rhs.tail
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    # equal values can be different objects, and MemoCache must not use them as keys
+    __hash__ = None
+
+    # pickled as a flat tuple, the chain of cells would recurse once per cell
+    def __reduce__(self):
+        return (make_list, (tuple(self.items()),))
+
+NIL = List(None, None)
+
+def make_list(items):
+    value = NIL
+    for item in reversed(items):
+        value = List(item, value)
+    return value
+
+class Vector(object):
+    __slots__ = ["count", "shift", "root", "tail"]
+
+    # root is a tuple of child nodes, shift the number of index bits below it. The leaves
+    # are tuples of WIDTH elements and tail holds the elements after the last leaf.
+    def __init__(self, count, shift, root, tail):
+        super(Vector, self).__init__()
+        self.count = count
+        self.shift = shift
+        self.root = root
+        self.tail = tail
+
+    # the index of the first element in the tail
+    def tail_offset(self):
+        if self.count < WIDTH:
+            return 0
+        return ((self.count - 1) >> BITS) << BITS
+
+    def nth(self, idx):
+        if idx >= self.tail_offset():
+            return self.tail[idx & MASK]
+        node = self.root
+        level = self.shift
+        while level > 0:
+            node = node[(idx >> level) & MASK]
+            level -= BITS
+        return node[idx & MASK]
+
+    def push(self, value):
+        if self.count - self.tail_offset() < WIDTH:
+            return Vector(self.count + 1, self.shift, self.root, self.tail + (value,))
+        # the tail is full and becomes the next leaf
+        if (self.count >> BITS) > (1 << self.shift):
+            root = (self.root, new_path(self.shift, self.tail))
+            shift = self.shift + BITS
+        else:
+            root = self.push_tail(self.shift, self.root)
+            shift = self.shift
+        return Vector(self.count + 1, shift, root, (value,))
+
+    def push_tail(self, level, node):
+        idx = ((self.count - 1) >> level) & MASK
+        if level == BITS:
+            child = self.tail
+        elif idx < len(node):
+            child = self.push_tail(level - BITS, node[idx])
+        else:
+            child = new_path(level - BITS, self.tail)
+        return node[:idx] + (child,) + node[idx + 1:]
+
+    def assoc(self, idx, value):
+        if idx == self.count:
+            return self.push(value)
+        offset = self.tail_offset()
+        if idx >= offset:
+            idx -= offset
+            return Vector(self.count, self.shift, self.root, self.tail[:idx] + (value,) + self.tail[idx + 1:])
+        return Vector(self.count, self.shift, assoc_path(self.shift, self.root, idx, value), self.tail)
+
+    def items(self):
+        for idx in range(0, self.tail_offset(), WIDTH):
+            for item in self.leaf(idx):
+                yield item
+        for item in self.tail:
+            yield item
+
+    def leaf(self, idx):
+        node = self.root
+        level = self.shift
+        while level > 0:
+            node = node[(idx >> level) & MASK]
+            level -= BITS
+        return node
+
+    def __repr__(self):
+        return "[%s]" % " ".join([str(item) for item in self.items()])
+
+    def __eq__(self, other):
+        if not isinstance(other, Vector) or self.count != other.count:
+            return False
+        if self.root is other.root and self.tail is other.tail:
+            return True
+        for (lhs, rhs) in zip(self.items(), other.items()):
+            if lhs != rhs:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (make_vector, (tuple(self.items()),))
+
+EMPTY_VECTOR = Vector(0, BITS, (), ())
+
+def make_vector(items):
+    value = EMPTY_VECTOR
+    for item in items:
+        value = value.push(item)
+    return value
+
+# A node holding only node, level bits above the leaves.
+def new_path(level, node):
+    if level == 0:
+        return node
+    return (new_path(level - BITS, node),)
+
+def assoc_path(level, node, idx, value):
+    sub = (idx >> level) & MASK
+    if level == 0:
+        return node[:sub] + (value,) + node[sub + 1:]
+    return node[:sub] + (assoc_path(level - BITS, node[sub], idx, value),) + node[sub + 1:]
+
+def as_list(value, name):
+    if not isinstance(value, List):
+        raise vm.RuntimeException("The argument %s of %s is not a list" % (repr(value), name))
+    return value
+
+def as_vector(value, name):
+    if not isinstance(value, Vector):
+        raise vm.RuntimeException("The argument %s of %s is not a vector" % (repr(value), name))
+    return value
+
+def as_index(vector, value, name, limit):
+    if isinstance(value, bool) or not isinstance(value, (int, long)):
+        raise vm.RuntimeException("The index %s of %s is not an integer" % (repr(value), name))
+    if not 0 <= value < limit:
+        raise vm.RuntimeException("The index %i of %s is out of range for a vector of %i elements" % (value, name, vector.count))
+    return value
+
+def nil():
+    return NIL
+
+def cons(value, rest):
+    return List(value, as_list(rest, "cons"))
+
+def head(value):
+    if not as_list(value, "head").length:
+        raise vm.RuntimeException("head of an empty list")
+    return value.head
+
+def tail(value):
+    if not as_list(value, "tail").length:
+        raise vm.RuntimeException("tail of an empty list")
+    return value.tail
+
+def vector():
+    return EMPTY_VECTOR
+
+def push(value, item):
+    return as_vector(value, "push").push(item)
+
+def nth(value, idx):
+    value = as_vector(value, "nth")
+    return value.nth(as_index(value, idx, "nth", value.count))
+
+# idx may be the length of the vector, which appends value.
+def assoc(value, idx, item):
+    value = as_vector(value, "assoc")
+    return value.assoc(as_index(value, idx, "assoc", value.count + 1), item)
+
+def length(value):
+    if isinstance(value, List):
+        return value.length
+    if isinstance(value, Vector):
+        return value.count
+    raise vm.RuntimeException("The argument %s of length is not a list or vector" % repr(value))
+
+def empty(value):
+    return length(value) == 0
+
+# (name, argument count, implementation) of every primitive. Each is called with its
+# arguments after the continuation and returns the value passed to the continuation.
+# The bytecode refers to primitives by their index in this list, so new ones go at the end.
+PRIMITIVES = [
+    ("nil", 0, nil),
+    ("cons", 2, cons),
+    ("head", 1, head),
+    ("tail", 1, tail),
+    ("vector", 0, vector),
+    ("push", 2, push),
+    ("nth", 2, nth),
+    ("assoc", 3, assoc),
+    ("length", 1, length),
+    ("empty", 1, empty),
+]
+
+PRIMITIVE_INDEX = dict([(name, idx) for (idx, (name, arg_count, function)) in enumerate(PRIMITIVES)])
@@ -0,0 +1,189 @@
+"""
+Ahead-of-time translation of compiled programs into python functions.
+
+Every block produced by expression_tree.Prog.compile (named functions and their
+lambdas) becomes one python function. The stack of a block is known statically, so
+the instructions are executed symbolically and each stack slot becomes a python
+expression. A block's function takes its stack on entry as parameters and returns
+the next function and its arguments, which a trampoline calls in turn. Each CPS
+jump is then a single python call.
+
+Closures are tuples of (function, captured values, argument count). Like the vm, a
+closure takes the last argument count values of the stack, whatever the call pushed.
+The exit continuation has no function, which is how the trampoline knows the
+program has finished.
+"""
+
+import persistent
+import vm
+
+FINISH_CLOSURE = (None, (), 1)
+
+OPERATORS = {
+    vm.AddInst: "+",
+    vm.SubInst: "-",
+    vm.MulInst: "*",
+    vm.LessInst: "<",
+    vm.EqInst: "==",
+    vm.ModInst: "%",
+    vm.DivInst: "//",
+}
+
+class PyProgram(object):
+    def __init__(self, source, namespace, labels, entry):
+        super(PyProgram, self).__init__()
+        self.source = source
+        self.namespace = namespace
+        self.labels = labels
+        self.entry = entry
+
+    def run(self):
+        func = self.namespace[self.entry]
+        args = (FINISH_CLOSURE,)
+        while func is not None:
+            current = func
+            try:
+                func, args = current(*args)
+            except vm.OPERAND_ERRORS + (IndexError,) as e:
+                raise vm.RuntimeException("In %s: %s" % (self.labels[current.__name__], str(e)))
+        return args[-1]
+
+def tuple_source(items):
+    if len(items) == 1:
+        return "(%s,)" % items[0]
+    return "(%s)" % ", ".join(items)
+
+def const_source(value):
+    if value == [vm.FINISH]:
+        return "FINISH"
+    return repr(value)
+
+def operand_source(stack, operand):
+    if operand[0]:
+        return const_source(operand[1])
+    return stack[operand[1]]
+
+def binop_source(arith, lhs, rhs):
+    return "(%s %s %s)" % (lhs, OPERATORS[type(arith)], rhs)
+
+# stack is the whole stack at the jump, the arguments pushed by the call are on top.
+# known_arity is the argument count of the closure when it was built in the same block.
+def call_closure_source(closure, stack, arg_count, known_arity=None):
+    if known_arity is not None:
+        return ["return %s[0], %s[1] + %s" % (closure, closure, tuple_source(stack[len(stack) - known_arity:]))]
+    args = tuple_source(stack[len(stack) - arg_count:])
+    return ["if %s[2] == %i:" % (closure, arg_count),
+            "    return %s[0], %s[1] + %s" % (closure, closure, args),
+            "return %s[0], %s[1] + %s[%i - %s[2]:]" % (closure, closure, tuple_source(stack), len(stack), closure)]
+
+def call_label_source(name, values):
+    return "return %s, %s" % (name, tuple_source(values))
+
+# Translates one block to the source of a python function. depth is the number of
+# values on the stack when the block is entered and names maps labels to function names.
+def translate_block(label, block, depth, names):
+    params = ["s%i" % idx for idx in range(depth)]
+    lines = ["def %s(%s):" % (names[label], ", ".join(params)), "    # %s" % label]
+    stack = list(params)
+    temporaries = [0]
+    arities = {}
+
+    def emit(*new_lines):
+        for line in new_lines:
+            lines.append("    " + line)
+
+    def temporary(expression):
+        name = "t%i" % temporaries[0]
+        temporaries[0] += 1
+        emit("%s = %s" % (name, expression))
+        return name
+
+    for instr in block:
+        if isinstance(instr, vm.PushConst):
+            stack.append(const_source(instr.value))
+        elif isinstance(instr, vm.PushRel):
+            stack.append(stack[instr.offset])
+        elif isinstance(instr, vm.Pop):
+            stack.pop()
+        elif isinstance(instr, vm.PushClosure):
+            env = [stack[offset] for offset in instr.offsets]
+            stack.append(temporary("(%s, %s, %i)" % (names[instr.label], tuple_source(env), instr.arg_count)))
+            arities[stack[-1]] = instr.arg_count
+        elif isinstance(instr, vm.PushThunk):
+            stack.append(temporary("(%s, (), %i)" % (names[instr.label], instr.arg_count)))
+            arities[stack[-1]] = instr.arg_count
+        elif isinstance(instr, vm.JumpLabel):
+            emit(call_label_source(names[instr.label], stack[len(stack) - instr.arg_count:]))
+            return "\n".join(lines)
+        elif isinstance(instr, vm.JumpLambda):
+            emit(*call_closure_source(stack[instr.offset], stack, len(stack) - depth, arities.get(stack[instr.offset])))
+            return "\n".join(lines)
+        elif isinstance(instr, vm.CondBranch):
+            cont, test, iftrue, iffalse = stack[-4:]
+            branch = temporary("%s if %s else %s" % (iftrue, test, iffalse))
+            emit(*call_closure_source(branch, stack + [cont], 1))
+            return "\n".join(lines)
+        elif isinstance(instr, vm.ARITHMETIC_INSTRUCTIONS):
+            cont, lhs, rhs = stack[-3:]
+            emit(*call_closure_source(cont, stack[:-2] + [temporary(binop_source(instr, lhs, rhs))], 1, arities.get(cont)))
+            return "\n".join(lines)
+        elif isinstance(instr, vm.PrimInst):
+            top = len(stack) - instr.arg_count
+            result = temporary("prim_%s(%s)" % (instr.name, ", ".join(stack[top:])))
+            emit(*call_closure_source(stack[top - 1], stack[:top] + [result], 1, arities.get(stack[top - 1])))
+            return "\n".join(lines)
+        elif isinstance(instr, vm.ArithConst):
+            cont, lhs = stack[-2:]
+            result = binop_source(instr.arith, lhs, const_source(instr.value))
+            emit(*call_closure_source(cont, stack[:-1] + [temporary(result)], 1, arities.get(cont)))
+            return "\n".join(lines)
+        elif isinstance(instr, vm.ArithToLambda):
+            result = binop_source(instr.arith, operand_source(stack, instr.lhs), operand_source(stack, instr.rhs))
+            cont = stack[instr.cont_offset]
+            emit(*call_closure_source(cont, stack + [cont, temporary(result)], 1))
+            return "\n".join(lines)
+        elif isinstance(instr, vm.ArithToClosure):
+            result = binop_source(instr.arith, operand_source(stack, instr.lhs), operand_source(stack, instr.rhs))
+            emit(call_label_source(names[instr.label], [stack[offset] for offset in instr.offsets] + [result]))
+            return "\n".join(lines)
+        elif isinstance(instr, vm.Branch):
+            cont, test = stack[-2:]
+            emit("if %s:" % test)
+            emit("    " + call_label_source(names[instr.true_label], [stack[offset] for offset in instr.true_offsets] + [cont]))
+            emit(call_label_source(names[instr.false_label], [stack[offset] for offset in instr.false_offsets] + [cont]))
+            return "\n".join(lines)
+        else:
+            raise Exception("The instruction %s cannot be translated to python." % repr(instr))
+    raise Exception("The function %s does not end with a jump." % label)
+
+# Translates the output of Prog.compile (optionally after peephole.optimize) into a
+# PyProgram. The generated source is compiled once.
+def translate(instructions, jump_table):
+    blocks = vm.split_blocks(instructions, jump_table)
+    depths = vm.entry_depths(instructions, jump_table)
+    names = {}
+    labels = {}
+    for (idx, (label, block)) in enumerate(blocks):
+        names[label] = "f%i" % idx
+        labels[names[label]] = label
+    entry = blocks[0][0]
+    # the entry block is called with just the exit continuation
+    depths.setdefault(entry, 1)
+    for instr in instructions:
+        for label in [getattr(instr, "label", None), getattr(instr, "true_label", None), getattr(instr, "false_label", None)]:
+            if label is not None and label not in names:
+                raise Exception("There is no function named %s." % str(label))
+    sources = []
+    for (label, block) in blocks:
+        if label not in depths:
+            continue
+        try:
+            sources.append(translate_block(label, block, depths[label], names))
+        except IndexError:
+            raise Exception("The function %s reads below the values it was entered with." % label)
+    source = "\n\n".join(sources) + "\n"
+    namespace = {"FINISH": FINISH_CLOSURE}
+    for (name, arg_count, function) in persistent.PRIMITIVES:
+        namespace["prim_" + name] = function
+    exec compile(source, "<tinycps>", "exec") in namespace
+    return PyProgram(source, namespace, labels, names[entry])
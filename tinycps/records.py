@@ -0,0 +1,120 @@
+"""
+Reads the inputs of a --batch run lazily, one record of arguments for main at a time.
+
+Three formats are read, chosen by the extension of the file:
+
+- .npy: a numpy array, memory mapped, so only the rows being run are read from disk.
+  Every row of a two dimensional array is a record, and every element of a one
+  dimensional array a record with a single argument.
+- .csv: comma separated fields, one record per row.
+- anything else: whitespace separated fields, one record per line.
+
+Fields of text files written without a decimal point are read as ints, like number
+literals, and all others as floats. Blank lines are skipped. Every record must
+have as many fields as the first, since they all run the same main.
+
+records() yields one tuple per record, and blocks() yields lists of up to size records
+(slices of the memory map for .npy files), so a run over a file of any size only holds
+one block of inputs at a time.
+"""
+
+import csv
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class RecordException(Exception):
+    def __init__(self, description, line=None):
+        super(RecordException, self).__init__()
+        self.description = description
+        self.line = line
+
+    def __str__(self):
+        if self.line is None:
+            return self.description
+        return "line %i: %s" % (self.line, self.description)
+
+def parse_field(field):
+    try:
+        return int(field)
+    except ValueError:
+        return float(field)
+
+def parse_fields(fields, line):
+    try:
+        return tuple([parse_field(field) for field in fields])
+    except ValueError as e:
+        raise RecordException(str(e), line)
+
+def open_input(path, mode="r"):
+    try:
+        return open(path, mode)
+    except IOError as e:
+        raise RecordException(str(e))
+
+def text_records(path):
+    with open_input(path) as f:
+        for (idx, line) in enumerate(f):
+            fields = line.split()
+            if fields:
+                yield parse_fields(fields, idx + 1)
+
+def csv_records(path):
+    with open_input(path, "rb") as f:
+        reader = csv.reader(f)
+        for row in reader:
+            fields = [field.strip() for field in row]
+            if any(fields):
+                yield parse_fields(fields, reader.line_num)
+
+def load_npy(path):
+    if numpy is None:
+        raise RecordException("Reading .npy inputs requires numpy.")
+    try:
+        array = numpy.load(path, mmap_mode="r")
+    except (IOError, ValueError) as e:
+        raise RecordException(str(e))
+    if array.ndim not in [1, 2]:
+        raise RecordException("%s holds a %i dimensional array, inputs need one or two dimensions" % (path, array.ndim))
+    if array.ndim == 1:
+        array = array.reshape((len(array), 1))
+    return array
+
+# Checks that every record of pending has as many fields as the first.
+def same_width(pending):
+    width = None
+    for (idx, record) in enumerate(pending):
+        if width is None:
+            width = len(record)
+        elif len(record) != width:
+            raise RecordException("record %i has %i fields, but the first has %i" % (idx + 1, len(record), width))
+        yield record
+
+def records(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        pending = (tuple(row.tolist()) for row in load_npy(path))
+    elif extension == ".csv":
+        pending = same_width(csv_records(path))
+    else:
+        pending = same_width(text_records(path))
+    for record in pending:
+        yield record
+
+def blocks(path, size):
+    if os.path.splitext(path)[1].lower() == ".npy":
+        array = load_npy(path)
+        for start in range(0, len(array), size):
+            yield array[start:start + size]
+        return
+    block = []
+    for record in records(path):
+        block.append(record)
+        if len(block) == size:
+            yield block
+            block = []
+    if block:
+        yield block
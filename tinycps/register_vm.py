@@ -0,0 +1,401 @@
+"""
+A register machine backend for the output of expression_tree.Prog.compile.
+
+Each function or lambda block is translated once by running its stack instructions
+symbolically: the values a block is entered with and the closures it builds are
+numbered registers, and pushes of variables and constants disappear into the
+operands of the instructions that use them. A block becomes its closure
+constructions followed by a single jump, so a CPS call costs one instruction plus
+one per lambda it builds. When the jump goes to a closure built in the same block
+(or to a named function) its code is known, so the jump goes there directly and the
+closure is only built if something else uses it.
+
+An operand is a register number, or the bitwise complement of an index into the
+constant pool. Jumps carry the operands of the whole stack the stack machine would
+have had at that point, so that like the vm a closure takes the last arg_count of
+them, whatever the call passed.
+"""
+
+import vm
+
+CLOSURE = 0
+JUMP = 1
+CALL = 2
+ARITH = 3
+BRANCH = 4
+# jumps to a lambda whose code is known while translating
+ARITH_JUMP = 5
+BRANCH_JUMP = 6
+# the primitives on lists and vectors, see persistent.py
+PRIM = 7
+PRIM_JUMP = 8
+
+OPCODE_NAMES = ["CLOSURE", "JUMP", "CALL", "ARITH", "BRANCH", "ARITH_JUMP", "BRANCH_JUMP", "PRIM", "PRIM_JUMP"]
+
+# Closures are lists of [address, arg_count] followed by the captured values.
+FINISH_CLOSURE = [vm.FINISH_IP, 1]
+
+class RegisterProgram(object):
+    def __init__(self, code, consts, labels, entry):
+        super(RegisterProgram, self).__init__()
+        self.code = code
+        self.consts = consts
+        self.labels = labels
+        self.entry = entry
+
+    def __len__(self):
+        return len(self.code)
+
+    # Indexing returns a readable form of the instruction at that address for
+    # RuntimeException.
+    def __getitem__(self, ip):
+        return self.disassemble_instruction(ip)
+
+    def operand(self, op):
+        if op >= 0:
+            return "r%i" % op
+        value = self.consts[~op]
+        if value is FINISH_CLOSURE:
+            return "FINISH"
+        if isinstance(value, list):
+            return "<%s>" % self.label_at(value[0])
+        return repr(value)
+
+    def operands(self, ops):
+        return "[%s]" % ", ".join([self.operand(op) for op in ops])
+
+    def label_at(self, address):
+        for name in self.labels:
+            if self.labels[name] == address:
+                return name
+        return str(address)
+
+    def disassemble_instruction(self, ip):
+        instr = self.code[ip]
+        op = instr[0]
+        if op == CLOSURE:
+            args = "%s, %i, %s" % (self.label_at(instr[1]), instr[2], self.operands(instr[3]))
+        elif op == JUMP:
+            args = "%s, %s" % (self.label_at(instr[1]), self.operands(instr[2]))
+        elif op == CALL:
+            args = "%s, %s" % (self.operand(instr[1]), self.operands(instr[2]))
+        elif op == ARITH:
+            args = "%s, %s, %s, %s" % (instr[1].__name__, self.operand(instr[2]), self.operand(instr[3]), self.operands(instr[4]))
+        elif op == ARITH_JUMP:
+            args = "%s, %s, %s, %s, %s" % (instr[1].__name__, self.operand(instr[2]), self.operand(instr[3]), self.label_at(instr[4]), self.operands(instr[5]))
+        elif op == BRANCH_JUMP:
+            args = "%s, %s, %s, %s, %s" % (self.operand(instr[1]), self.label_at(instr[2]), self.operands(instr[3]), self.label_at(instr[4]), self.operands(instr[5]))
+        elif op == PRIM:
+            args = "%s, %s, %s" % (instr[1].__name__, self.operands(instr[2]), self.operands(instr[3]))
+        elif op == PRIM_JUMP:
+            args = "%s, %s, %s, %s" % (instr[1].__name__, self.operands(instr[2]), self.label_at(instr[3]), self.operands(instr[4]))
+        else:
+            args = "%s, %s, %s, %s" % (self.operand(instr[1]), self.operand(instr[2]), self.operand(instr[3]), self.operands(instr[4]))
+        return "%s(%s)" % (OPCODE_NAMES[op], args)
+
+    def disassemble(self):
+        lines = []
+        for ip in range(len(self.code)):
+            for name in sorted(self.labels):
+                if self.labels[name] == ip:
+                    lines.append("%s:" % name)
+            lines.append("  %4i %s" % (ip, self.disassemble_instruction(ip)))
+        return "\n".join(lines)
+
+    # args are passed to main after the exit continuation.
+    def run(self, args=()):
+        return run_registers(self, args)
+
+# Collects the constants of a program, each stored once.
+class ConstPool(object):
+    def __init__(self):
+        super(ConstPool, self).__init__()
+        self.values = []
+        self.indices = {}
+
+    def operand(self, key, value):
+        if key not in self.indices:
+            self.indices[key] = len(self.values)
+            self.values.append(value)
+        return ~self.indices[key]
+
+    def const(self, value):
+        if value == [vm.FINISH]:
+            return self.operand(("finish",), FINISH_CLOSURE)
+        return self.operand((type(value), value), value)
+
+    # The closure of a named function, which captures nothing. Its address is filled
+    # in once the blocks are laid out.
+    def thunk(self, label, arg_count):
+        return self.operand(("thunk", label, arg_count), [label, arg_count])
+
+# The label, argument count and captured operands of the closure an operand holds, when
+# that is known while translating: closures built in the same block, and thunks.
+def static_closure(op, depth, closures, pool):
+    if op >= depth:
+        return closures[op - depth]
+    if op < 0:
+        value = pool.values[~op]
+        if isinstance(value, list) and value is not FINISH_CLOSURE:
+            return (value[0], value[1], ())
+    return None
+
+# Builds the operands of a call to a closure known while translating, or returns None
+# when the stack is too short to pass it the same values the vm would.
+def static_args(closure, stack, arg_count):
+    if closure is None or arg_count < 0 or arg_count > len(stack):
+        return None
+    return closure[2] + tuple(stack[len(stack) - arg_count:])
+
+# The jump that ends a block. Jumps to closures known while translating go straight to
+# the lambda's code.
+def terminal(instr, stack, depth, closures, pool):
+    if isinstance(instr, vm.JumpLabel):
+        return (JUMP, instr.label, tuple(stack[len(stack) - instr.arg_count:]))
+    if isinstance(instr, vm.JumpLambda):
+        closure = static_closure(stack[instr.offset], depth, closures, pool)
+        args = static_args(closure, stack, closure and closure[1])
+        if args is not None:
+            return (JUMP, closure[0], args)
+        return (CALL, stack[instr.offset], tuple(stack))
+    if isinstance(instr, vm.ARITHMETIC_INSTRUCTIONS):
+        prefix = stack[:-2]
+        closure = static_closure(prefix[-1], depth, closures, pool)
+        args = static_args(closure, prefix, closure and closure[1] - 1)
+        if args is not None:
+            return (ARITH_JUMP, instr.operation, stack[-2], stack[-1], closure[0], args)
+        return (ARITH, instr.operation, stack[-2], stack[-1], tuple(prefix))
+    if isinstance(instr, vm.PrimInst):
+        top = len(stack) - instr.arg_count
+        prefix = stack[:top]
+        closure = static_closure(prefix[-1], depth, closures, pool)
+        args = static_args(closure, prefix, closure and closure[1] - 1)
+        if args is not None:
+            return (PRIM_JUMP, instr.function, tuple(stack[top:]), closure[0], args)
+        return (PRIM, instr.function, tuple(stack[top:]), tuple(prefix))
+    if isinstance(instr, vm.CondBranch):
+        prefix = stack[:-2] + [stack[-4]]
+        iftrue = static_closure(stack[-2], depth, closures, pool)
+        iffalse = static_closure(stack[-1], depth, closures, pool)
+        true_args = static_args(iftrue, prefix, iftrue and iftrue[1])
+        false_args = static_args(iffalse, prefix, iffalse and iffalse[1])
+        if true_args is not None and false_args is not None:
+            return (BRANCH_JUMP, stack[-3], iftrue[0], true_args, iffalse[0], false_args)
+        return (BRANCH, stack[-3], stack[-2], stack[-1], tuple(prefix))
+    return None
+
+# The operands read by an instruction.
+def operands_of(instr):
+    op = instr[0]
+    if op == CLOSURE:
+        return instr[3]
+    if op == JUMP:
+        return instr[2]
+    if op == CALL:
+        return (instr[1],) + instr[2]
+    if op == ARITH:
+        return (instr[2], instr[3]) + instr[4]
+    if op == ARITH_JUMP:
+        return (instr[2], instr[3]) + instr[5]
+    if op == BRANCH:
+        return instr[1:4] + instr[4]
+    if op == PRIM:
+        return instr[2] + instr[3]
+    if op == PRIM_JUMP:
+        return instr[2] + instr[4]
+    return (instr[1],) + instr[3] + instr[5]
+
+def renumber(instr, registers):
+    def operand(op):
+        return registers.get(op, op)
+    def operands(ops):
+        return tuple([operand(op) for op in ops])
+    op = instr[0]
+    if op == CLOSURE:
+        return instr[:3] + (operands(instr[3]),)
+    if op == JUMP:
+        return (op, instr[1], operands(instr[2]))
+    if op == CALL:
+        return (op, operand(instr[1]), operands(instr[2]))
+    if op == ARITH:
+        return (op, instr[1], operand(instr[2]), operand(instr[3]), operands(instr[4]))
+    if op == ARITH_JUMP:
+        return (op, instr[1], operand(instr[2]), operand(instr[3]), instr[4], operands(instr[5]))
+    if op == BRANCH:
+        return (op, operand(instr[1]), operand(instr[2]), operand(instr[3]), operands(instr[4]))
+    if op == PRIM:
+        return (op, instr[1], operands(instr[2]), operands(instr[3]))
+    if op == PRIM_JUMP:
+        return (op, instr[1], operands(instr[2]), instr[3], operands(instr[4]))
+    return (op, operand(instr[1]), instr[2], operands(instr[3]), instr[4], operands(instr[5]))
+
+# Translates one block. depth is the number of values the block is entered with.
+# Returns the instructions with labels still unresolved.
+def translate_block(label, block, depth, pool):
+    stack = range(depth)
+    closures = []
+    for instr in block:
+        if isinstance(instr, vm.PushConst):
+            stack.append(pool.const(instr.value))
+        elif isinstance(instr, vm.PushRel):
+            stack.append(stack[instr.offset])
+        elif isinstance(instr, vm.Pop):
+            stack.pop()
+        elif isinstance(instr, vm.PushThunk):
+            stack.append(pool.thunk(instr.label, instr.arg_count))
+        elif isinstance(instr, vm.PushClosure):
+            closures.append((instr.label, instr.arg_count, tuple([stack[offset] for offset in instr.offsets])))
+            stack.append(depth + len(closures) - 1)
+        else:
+            last = terminal(instr, stack, depth, closures, pool)
+            if last is None:
+                raise Exception("The instruction %s has no register form. Superinstructions are for the stack vm only." % repr(instr))
+            break
+    else:
+        raise Exception("The function %s does not end with a jump." % label)
+    # only build the closures that are still used, numbering their registers afresh
+    used = set(operands_of(last))
+    live = []
+    for idx in range(len(closures) - 1, -1, -1):
+        if depth + idx in used:
+            live.insert(0, idx)
+            used |= set(closures[idx][2])
+    registers = {}
+    for (number, idx) in enumerate(live):
+        registers[depth + idx] = depth + number
+    code = [renumber((CLOSURE,) + closures[idx], registers) for idx in live]
+    code.append(renumber(last, registers))
+    return code
+
+# Translates the output of Prog.compile into a RegisterProgram. entry_depth is the
+# number of values main is entered with: the exit continuation and its arguments.
+def translate(instructions, jump_table, entry_depth=1):
+    blocks = vm.split_blocks(instructions, jump_table)
+    depths = vm.entry_depths(instructions, jump_table)
+    entry = blocks[0][0]
+    depths.setdefault(entry, entry_depth)
+    pool = ConstPool()
+    code = []
+    labels = {}
+    for (label, block) in blocks:
+        if label not in depths:
+            continue
+        try:
+            translated = translate_block(label, block, depths[label], pool)
+        except IndexError:
+            raise Exception("The function %s reads below the values it was entered with." % label)
+        labels[label] = len(code)
+        code += translated
+
+    def resolve(label):
+        if label not in labels:
+            raise Exception("There is no function named %s." % str(label))
+        return labels[label]
+
+    for (ip, instr) in enumerate(code):
+        if instr[0] == CLOSURE or instr[0] == JUMP:
+            code[ip] = (instr[0], resolve(instr[1])) + instr[2:]
+        elif instr[0] == ARITH_JUMP:
+            code[ip] = instr[:4] + (resolve(instr[4]), instr[5])
+        elif instr[0] == BRANCH_JUMP:
+            code[ip] = (instr[0], instr[1], resolve(instr[2]), instr[3], resolve(instr[4]), instr[5])
+        elif instr[0] == PRIM_JUMP:
+            code[ip] = instr[:3] + (resolve(instr[3]), instr[4])
+    for value in pool.values:
+        if isinstance(value, list) and value is not FINISH_CLOSURE:
+            value[0] = resolve(value[0])
+    return RegisterProgram(code, pool.values, labels, labels[entry])
+
+def run_registers(program, args=()):
+    code = program.code
+    consts = program.consts
+    regs = [FINISH_CLOSURE] + list(args)
+    ip = program.entry
+    try:
+        while True:
+            instr = code[ip]
+            op = instr[0]
+            if op == CLOSURE:
+                closure = [instr[1], instr[2]]
+                for env in instr[3]:
+                    closure.append(regs[env] if env >= 0 else consts[~env])
+                regs.append(closure)
+                ip += 1
+                continue
+            elif op == JUMP:
+                regs = [regs[arg] if arg >= 0 else consts[~arg] for arg in instr[2]]
+                ip = instr[1]
+                continue
+            elif op == ARITH_JUMP:
+                lhs = instr[2]
+                rhs = instr[3]
+                result = instr[1](regs[lhs] if lhs >= 0 else consts[~lhs], regs[rhs] if rhs >= 0 else consts[~rhs])
+                regs = [regs[arg] if arg >= 0 else consts[~arg] for arg in instr[5]]
+                regs.append(result)
+                ip = instr[4]
+                continue
+            elif op == BRANCH_JUMP:
+                test = instr[1]
+                if regs[test] if test >= 0 else consts[~test]:
+                    ip = instr[2]
+                    args = instr[3]
+                else:
+                    ip = instr[4]
+                    args = instr[5]
+                regs = [regs[arg] if arg >= 0 else consts[~arg] for arg in args]
+                continue
+            elif op == PRIM_JUMP:
+                result = instr[1](*[regs[arg] if arg >= 0 else consts[~arg] for arg in instr[2]])
+                regs = [regs[arg] if arg >= 0 else consts[~arg] for arg in instr[4]]
+                regs.append(result)
+                ip = instr[3]
+                continue
+            elif op == ARITH:
+                lhs = instr[2]
+                rhs = instr[3]
+                result = instr[1](regs[lhs] if lhs >= 0 else consts[~lhs], regs[rhs] if rhs >= 0 else consts[~rhs])
+                stack = instr[4]
+                cont = stack[-1]
+                closure = regs[cont] if cont >= 0 else consts[~cont]
+                if not isinstance(closure, list):
+                    raise vm.RuntimeException("Register value %s is not a lambda." % repr(closure))
+                if closure[1] == 1:
+                    args = [result]
+                else:
+                    args = [regs[arg] if arg >= 0 else consts[~arg] for arg in stack]
+                    args.append(result)
+                    args = args[len(args) - closure[1]:]
+            elif op == PRIM:
+                result = instr[1](*[regs[arg] if arg >= 0 else consts[~arg] for arg in instr[2]])
+                stack = instr[3]
+                cont = stack[-1]
+                closure = regs[cont] if cont >= 0 else consts[~cont]
+                if not isinstance(closure, list):
+                    raise vm.RuntimeException("Register value %s is not a lambda." % repr(closure))
+                args = [regs[arg] if arg >= 0 else consts[~arg] for arg in stack]
+                args.append(result)
+                args = args[len(args) - closure[1]:]
+            else:
+                if op == CALL:
+                    target = instr[1]
+                else:
+                    test = instr[1]
+                    target = instr[2] if (regs[test] if test >= 0 else consts[~test]) else instr[3]
+                closure = regs[target] if target >= 0 else consts[~target]
+                if not isinstance(closure, list):
+                    raise vm.RuntimeException("Register value %s is not a lambda." % repr(closure))
+                stack = instr[4] if op == BRANCH else instr[2]
+                args = [regs[arg] if arg >= 0 else consts[~arg] for arg in stack[len(stack) - closure[1]:]]
+            ip = closure[0]
+            if ip == vm.FINISH_IP:
+                return args[-1]
+            regs = closure[2:] + args
+    except vm.RuntimeException as e:
+        e.ip = ip
+        e.prog = program
+        raise e
+    except vm.OPERAND_ERRORS as e:
+        error = vm.RuntimeException(str(e))
+        error.ip = ip
+        error.prog = program
+        raise error
@@ -0,0 +1,138 @@
+"""
+A cooperative scheduler that interleaves many bytecode programs.
+
+Each program runs as a Task holding its own vm state (stack and ip). The scheduler
+runs the ready tasks round robin, each for a time slice measured in instructions
+(see bytecode.execute), so no program can starve the others. A task may also have a
+limit on the total number of instructions it is allowed to run.
+
+The scheduler can be driven directly with run(), or attached to an asyncio event
+loop with submit(), which returns a future for the program's result. Slices are
+then run from loop callbacks, so the host loop is never blocked for more than one
+slice.
+"""
+
+from collections import deque
+
+import bytecode
+import vm
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+DEFAULT_SLICE = 1000
+
+class QuotaExceeded(vm.RuntimeException):
+    def __init__(self, limit):
+        super(QuotaExceeded, self).__init__("The program ran out of its quota of %i instructions" % limit)
+        self.limit = limit
+
+class Task(object):
+    def __init__(self, program, args=(), time_slice=DEFAULT_SLICE, limit=None):
+        super(Task, self).__init__()
+        self.program = program
+        self.stack = bytecode.ValueStack([bytecode.FINISH_CLOSURE] + list(args))
+        self.ip = program.entry
+        self.time_slice = time_slice
+        self.limit = limit
+        self.executed = 0
+        self.slices = 0
+        self.done = False
+        self.result = None
+        self.error = None
+        self.future = None
+
+    def __repr__(self):
+        state = "done" if self.done else "at %i" % self.ip
+        return "Task(%s, %i instructions)" % (state, self.executed)
+
+    # Runs one time slice. Returns True once the task has finished or failed. Any error
+    # the program raises fails only this task, so the others keep running.
+    def step(self):
+        budget = self.time_slice
+        if self.limit is not None:
+            budget = min(budget, self.limit - self.executed)
+        try:
+            self.ip, self.stack, left = bytecode.execute(self.program, self.stack, self.ip, budget)
+        except Exception as e:
+            self.finish(error=e)
+            return True
+        self.executed += budget - left
+        self.slices += 1
+        if self.ip == vm.FINISH_IP:
+            self.finish(result=self.stack.top())
+        elif self.limit is not None and self.executed >= self.limit:
+            self.finish(error=QuotaExceeded(self.limit))
+        return self.done
+
+    def finish(self, result=None, error=None):
+        self.done = True
+        self.result = result
+        self.error = error
+        self.stack = None
+        if self.future is not None and not self.future.cancelled():
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+
+class Scheduler(object):
+    def __init__(self, time_slice=DEFAULT_SLICE, loop=None):
+        super(Scheduler, self).__init__()
+        self.time_slice = time_slice
+        self.ready = deque()
+        self.loop = loop
+        self.scheduled = False
+
+    # Adds a program to the run queue. time_slice defaults to the scheduler's and limit
+    # bounds the total instructions the program may run.
+    def spawn(self, program, args=(), time_slice=None, limit=None):
+        task = Task(program, args, time_slice or self.time_slice, limit)
+        self.ready.append(task)
+        return task
+
+    # Runs one slice of the task at the front of the queue. Returns whether any tasks
+    # are left.
+    def step(self):
+        if not self.ready:
+            return False
+        task = self.ready.popleft()
+        if task.future is not None and task.future.cancelled():
+            task.finish()
+        elif not task.step():
+            self.ready.append(task)
+        return len(self.ready) > 0
+
+    def run(self):
+        while self.step():
+            pass
+
+    # Like spawn, but returns an asyncio future for the result and runs the task from
+    # callbacks on the event loop.
+    def submit(self, program, args=(), time_slice=None, limit=None):
+        if asyncio is None:
+            raise Exception("The asyncio interface requires asyncio (or trollius on python 2).")
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        task = self.spawn(program, args, time_slice, limit)
+        task.future = asyncio.Future(loop=self.loop)
+        self.schedule()
+        return task.future
+
+    def schedule(self):
+        if not self.scheduled and self.ready:
+            self.scheduled = True
+            self.loop.call_soon(self.tick)
+
+    # One slice per callback, yielding to the event loop in between.
+    def tick(self):
+        self.scheduled = False
+        try:
+            self.step()
+        finally:
+            self.schedule()
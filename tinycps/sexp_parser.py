@@ -9,7 +9,8 @@ class SExpGrammer(Grammer):
     strip = lambda self, x: x[0] if len(x) == 1 else x
     reducer = lambda self, x: "".join(x)
     var = lambda self, x: self.reducer(x)
-    parse_float = lambda self, x: float(self.reducer(x))
+    # numbers with a decimal point are floats, others ints
+    parse_number = lambda self, x: float(self.reducer(x)) if len(x) > 1 else int(x[0])
     
     def identifier(self):
         return Seq(Alpha(), Star(Or(Alpha(), Num()), post=self.reducer), post=self.var)
@@ -18,7 +19,7 @@ class SExpGrammer(Grammer):
         return Plus(Num(), post=self.reducer)
     
     def decimal(self):
-        return Seq(Ref("number"), Opt(Seq(Symbol("."), Ref("number"), post=self.reducer)), post=self.parse_float)
+        return Seq(Ref("number"), Opt(Seq(Symbol("."), Ref("number"), post=self.reducer)), post=self.parse_number)
     
     def operator(self):
         return Or(Symbol("+"), Symbol("-"), Symbol("*"), Symbol("/"), Symbol("^"), Symbol("!"), Symbol("="), Symbol("<"), Symbol("_"), Symbol("%"))
@@ -0,0 +1,138 @@
+"""
+A streaming front end for large modules.
+
+The source is read in chunks and cut into top level forms by counting parentheses
+(the language has no strings or comments, so this is exact). Each form is parsed,
+converted and compiled as soon as its closing parenthesis has been read, and only
+its instructions are kept, so memory is bounded by the largest definition rather
+than by the whole file. The stages are generators, and link pulls definitions
+through all of them.
+
+A definition may refer to functions that have not been read yet. It is compiled as
+if every name was a function, and the argument counts of the PushThunks it contains
+are filled in (or found missing) at link time.
+"""
+
+import re
+
+import expression_tree
+import sexp_parser
+import sexp_to_cps
+import vm
+
+CHUNK_SIZE = 1 << 16
+
+PARENS = re.compile(r"[()]")
+
+class ParseException(Exception):
+    def __init__(self, position):
+        super(ParseException, self).__init__("Parse error at position: %i" % position)
+        self.position = position
+
+class SyntaxException(Exception):
+    pass
+
+def leading_space(text):
+    return len(text) - len(text.lstrip())
+
+def read_chunks(f, size=CHUNK_SIZE):
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+# Yields (position, text) for every top level form in the chunks. Only whitespace may
+# come between forms.
+def top_level_forms(chunks):
+    pending = []
+    position = 0
+    start = 0
+    depth = 0
+    for chunk in chunks:
+        begin = 0
+        for match in PARENS.finditer(chunk):
+            idx = match.start()
+            if depth == 0:
+                if chunk[begin:idx].strip() or match.group() == ")":
+                    raise ParseException(position + begin + leading_space(chunk[begin:idx]))
+                start = position + idx
+                begin = idx
+            depth += 1 if match.group() == "(" else -1
+            if depth == 0:
+                pending.append(chunk[begin:idx + 1])
+                yield start, "".join(pending)
+                pending = []
+                begin = idx + 1
+        if depth > 0:
+            pending.append(chunk[begin:])
+        elif chunk[begin:].strip():
+            raise ParseException(position + begin + leading_space(chunk[begin:]))
+        position += len(chunk)
+    if depth > 0:
+        raise ParseException(position)
+
+# Yields (name, Func) for every definition in the chunks. grammer is the s-expression
+# parser to use, a new SExpGrammer by default.
+def read_definitions(chunks, transform_finish=False, grammer=None):
+    if grammer is None:
+        grammer = sexp_parser.SExpGrammer()
+    for (position, text) in top_level_forms(chunks):
+        stream, result, parse = grammer.parse(text)
+        if not result or stream.position != len(text):
+            raise ParseException(position + stream.position)
+        func = parse[0]
+        if not isinstance(func, list) or len(func) != 4 or func[0] != "def":
+            raise SyntaxException("Top level definitions must be 'def'.")
+        try:
+            yield sexp_to_cps.convert_def(func, transform_finish)
+        except Exception as e:
+            raise SyntaxException(str(e))
+
+# Stands in for the module while definitions are compiled one at a time: every name is
+# taken to be a function, and PushThunks get a placeholder argument count.
+class ForwardDefinitions(object):
+    placeholder = expression_tree.Func([], None)
+
+    def __contains__(self, name):
+        return True
+
+    def __getitem__(self, name):
+        return ForwardDefinitions.placeholder
+
+# Yields (name, arg_count, blocks) for every definition, where blocks maps the labels of
+# the function and its lambdas to their instructions.
+def compile_definitions(definitions):
+    forward = ForwardDefinitions()
+    for (name, func) in definitions:
+        blocks, instructions = func.compile(name, forward)
+        blocks[name] = instructions
+        yield name, len(func.args), blocks
+
+# Stitches compiled definitions together like Prog.compile, with main first, and returns
+# the instructions and the jump table. A later definition of a name replaces earlier ones.
+def link(compiled, main="main"):
+    arg_counts = {}
+    functions = {}
+    for (name, arg_count, blocks) in compiled:
+        arg_counts[name] = arg_count
+        functions[name] = blocks
+    if main not in functions:
+        raise Exception("Invalid module: missing entry: %s." % main)
+    instrs = []
+    jump_table = {}
+    for name in [main] + [name for name in functions if name != main]:
+        blocks = functions[name]
+        for label in [name] + [label for label in blocks if label != name]:
+            jump_table[label] = len(instrs)
+            instrs += blocks[label]
+    for instr in instrs:
+        if isinstance(instr, vm.PushThunk):
+            if instr.label not in arg_counts:
+                raise Exception("The symbol %s is not in the current scope." % instr.label)
+            instr.arg_count = arg_counts[instr.label]
+    return instrs, jump_table
+
+# Reads, compiles and links the module in the file f.
+def compile_file(f, main="main", chunk_size=CHUNK_SIZE, grammer=None):
+    return link(compile_definitions(read_definitions(read_chunks(f, chunk_size), grammer=grammer)), main)
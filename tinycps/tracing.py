@@ -0,0 +1,108 @@
+"""
+Spans for following a run of the interpreter through its stages.
+
+The driver wraps each stage (parsing, conversion, compilation, linking, execution,
+REPL evaluations) in a span:
+
+    with tracing.span("parse"):
+        ...
+
+Spans are handed to the installed sink when they end. The default sink records
+nothing, and span then returns a shared do-nothing span, so tracing costs one global
+lookup and a comparison per stage when it is off. MemorySink keeps the spans in a
+list, and ChromeTraceSink writes them in the Chrome trace event format, which
+chrome://tracing and Perfetto load.
+"""
+
+import json
+import os
+import thread
+import time
+
+class NullSink(object):
+    def record(self, name, category, start, end, args):
+        pass
+
+    def close(self):
+        pass
+
+# Collects the spans as (name, category, start, end, args), times in seconds.
+class MemorySink(NullSink):
+    def __init__(self):
+        super(MemorySink, self).__init__()
+        self.spans = []
+
+    def record(self, name, category, start, end, args):
+        self.spans.append((name, category, start, end, args))
+
+    # name -> total seconds spent in spans of that name
+    def totals(self):
+        totals = {}
+        for (name, category, start, end, args) in self.spans:
+            totals[name] = totals.get(name, 0.0) + end - start
+        return totals
+
+# Writes the spans to path as complete ("X") events when closed.
+class ChromeTraceSink(MemorySink):
+    def __init__(self, path):
+        super(ChromeTraceSink, self).__init__()
+        self.path = path
+        self.pid = os.getpid()
+
+    def events(self):
+        events = []
+        for (name, category, start, end, args) in self.spans:
+            # the recorded spans keep their thread id for the next call
+            args = dict(args)
+            events.append({"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": args.pop("tid", 0),
+                           "ts": int(start * 1e6), "dur": int((end - start) * 1e6), "args": args})
+        return events
+
+    def close(self):
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, f)
+
+NULL_SINK = NullSink()
+sink = NULL_SINK
+
+# Installs a sink and returns the one it replaces.
+def install(new_sink):
+    global sink
+    previous = sink
+    sink = new_sink if new_sink is not None else NULL_SINK
+    return previous
+
+class Span(object):
+    def __init__(self, name, category, args):
+        super(Span, self).__init__()
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        end = time.time()
+        if kind is not None:
+            self.args["error"] = kind.__name__
+        self.args["tid"] = thread.get_ident()
+        sink.record(self.name, self.category, self.start, end, self.args)
+        return False
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+# A span around a stage. args are shown with the span in a trace viewer.
+def span(name, category="tinycps", **args):
+    if sink is NULL_SINK:
+        return NULL_SPAN
+    return Span(name, category, args)
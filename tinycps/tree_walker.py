@@ -0,0 +1,172 @@
+"""
+A tree walking engine that runs a CPS module without compiling it to instructions.
+
+Before running, every function body is resolved once: variables become (depth, index)
+addresses into a chain of frames, names of top level functions become their closures
+and calls to builtins become python operators, or calls to the primitives of
+persistent.py. Each resolved body is turned into one python function (see Code.step).
+A frame is a list holding the enclosing frame followed by the arguments, and a closure
+is a (Code, frame) pair.
+
+Every call in CPS is a tail call, so calls are run by a trampoline: evaluating a
+body produces the next closure and its arguments instead of calling it, and the
+python stack never grows.
+
+A closure called with a different number of arguments than it takes gets the last ones
+of the values the stack machines would have on their stack at that call, as in the vm:
+the captured values and arguments of the calling function, then what the call pushed
+(see Code.spill). Direct calls to named functions must still pass at least as many
+arguments as the function takes. Arithmetic behaves as in the vm.
+"""
+
+import expression_tree
+from expression_tree import Var, Const, Func, FuncLiteral, Call
+import persistent
+import vm
+
+class Code(object):
+    def __init__(self, name, arg_count):
+        super(Code, self).__init__()
+        self.name = name
+        self.arg_count = arg_count
+        # set by TreeProgram.resolve: takes the frame of a call and returns the closure
+        # to continue with and its arguments
+        self.step = None
+        # also set by resolve: takes the same frame and returns the values a stack machine
+        # has below the arguments of the call, or None for direct calls to named functions,
+        # which only pass their arguments
+        self.spill = None
+
+    def __repr__(self):
+        return "<%s/%i>" % (self.name, self.arg_count)
+
+# The exit continuation.
+FINISH = (Code(vm.FINISH, 1), None)
+
+# builtin name -> (argument count, python operator). Builtins continue with their first
+# argument, 'if' with the branch chosen by its second.
+BUILTINS = {
+    "+": (3, "+"),
+    "-": (3, "-"),
+    "*": (3, "*"),
+    "<": (3, "<"),
+    "=": (3, "=="),
+    "%": (3, "%"),
+    "div": (3, "//"),
+    "if": (4, None),
+}
+
+class TreeProgram(object):
+    def __init__(self, module, main="main"):
+        super(TreeProgram, self).__init__()
+        if main not in module:
+            raise Exception("Invalid module: missing entry: %s." % main)
+        if not isinstance(module[main], Func):
+            raise Exception("Invalid module: main is not a function.")
+        self.main = main
+        self.closures = {}
+        # the values the step functions refer to by name
+        self.namespace = {}
+        funcs = [name for name in module if isinstance(module[name], Func) and not isinstance(module[name], expression_tree.Builtin)]
+        for name in funcs:
+            self.closures[name] = (Code(name, len(module[name].args)), None)
+        for name in funcs:
+            self.resolve(self.closures[name][0], module[name], [])
+
+    def bind(self, value):
+        name = "v%i" % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    # Returns a python expression for the value of node in the frame 'frame'. scopes are
+    # the argument lists of the enclosing functions, innermost first.
+    def expression(self, node, scopes, name):
+        if isinstance(node, Const):
+            return self.bind(node.value)
+        if isinstance(node, expression_tree.Finish):
+            return self.bind(FINISH)
+        if isinstance(node, FuncLiteral):
+            code = Code("%s_lambda" % name, len(node.func.args))
+            self.resolve(code, node.func, scopes)
+            return "(%s, frame)" % self.bind(code)
+        if isinstance(node, Var):
+            for (depth, args) in enumerate(scopes):
+                if node.symbol in args:
+                    # index 0 of a frame is the enclosing frame
+                    return "frame%s[%i]" % ("[0]" * depth, args.index(node.symbol) + 1)
+            if node.symbol in self.closures:
+                return self.bind(self.closures[node.symbol])
+            raise Exception("The symbol %s is not in the current scope." % node.symbol)
+        raise Exception("The node %s cannot be evaluated." % repr(node))
+
+    def resolve(self, code, func, scopes):
+        if not isinstance(func.body, Call):
+            raise Exception("Function body must be a call.")
+        # the values of the function on the vm stack: the free variables it captures from
+        # the enclosing functions, sorted like expression_tree.FuncLiteral, then its arguments
+        captured = sorted([var for var in func.free_vars() if any([var in names for names in scopes])])
+        scopes = [func.args] + scopes
+        below = [self.expression(Var(var), scopes, code.name) for var in captured]
+        below += ["frame[%i]" % (idx + 1) for idx in range(len(func.args))]
+        call = func.body
+        args = [self.expression(arg, scopes, code.name) for arg in call.args]
+        if any([call.func in names for names in scopes]):
+            step = "(%s, [%s])" % (self.expression(Var(call.func), scopes, code.name), ", ".join(args))
+        elif call.func in self.closures:
+            step = "(%s, [%s])" % (self.bind(self.closures[call.func]), ", ".join(args))
+            below = None
+        elif call.func in BUILTINS:
+            arg_count, operation = BUILTINS[call.func]
+            if arg_count != len(args):
+                raise Exception("The function %s cannot be called with %i arguments." % (call.func, len(args)))
+            if operation is None:
+                step = "(%s, [%s]) if %s else (%s, [%s])" % (args[2], args[0], args[1], args[3], args[0])
+                # CondBranch pushes the continuation again above all four arguments
+                below += args
+            else:
+                step = "(%s, [%s %s %s])" % (args[0], args[1], operation, args[2])
+                # the operands are replaced by the result
+                below.append(args[0])
+        elif call.func in persistent.PRIMITIVE_INDEX:
+            name, arg_count, function = persistent.PRIMITIVES[persistent.PRIMITIVE_INDEX[call.func]]
+            if arg_count + 1 != len(args):
+                raise Exception("The function %s cannot be called with %i arguments." % (call.func, len(args)))
+            step = "(%s, [%s(%s)])" % (args[0], self.bind(function), ", ".join(args[1:]))
+            below.append(args[0])
+        else:
+            raise Exception("The function %s is not in the current scope." % call.func)
+        code.step = eval("lambda frame: " + step, self.namespace)
+        if below is not None:
+            code.spill = eval("lambda frame: [%s]" % ", ".join(below), self.namespace)
+
+    # The arguments callee gets from values, passed to it by the body of caller run in
+    # frame: the last arg_count values of what a stack machine would have on its stack.
+    def arguments(self, callee, values, caller, frame):
+        if len(values) > callee.arg_count:
+            return values[len(values) - callee.arg_count:]
+        if caller is not None and caller.spill is not None:
+            stack = caller.spill(frame) + values
+            if len(stack) >= callee.arg_count:
+                return stack[len(stack) - callee.arg_count:]
+        raise vm.RuntimeException("The function %s cannot be called with %i arguments" % (callee.name, len(values)))
+
+    # args are passed to main after the exit continuation.
+    def run(self, args=()):
+        target = self.closures[self.main]
+        values = [FINISH] + list(args)
+        code = None
+        frame = None
+        while True:
+            if type(target) is not tuple:
+                raise vm.RuntimeException("The value %s is not a function" % repr(target))
+            callee, parent = target
+            if len(values) != callee.arg_count:
+                values = self.arguments(callee, values, code, frame)
+            if target is FINISH:
+                return values[0]
+            code = callee
+            frame = [parent] + values
+            try:
+                target, values = code.step(frame)
+            except vm.OPERAND_ERRORS as e:
+                raise vm.RuntimeException("In %s: %s" % (code.name, str(e)))
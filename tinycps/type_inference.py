@@ -0,0 +1,222 @@
+"""
+Infers the types of the operands of arithmetic in a CPS module, and reports which calls
+to arithmetic builtins were proven to only ever see ints or floats.
+
+The analysis follows values through the whole module (a 0-CFA): every variable gets
+the set of abstract values that can flow into it. Abstract values are the types INT,
+FLOAT and BOOL, the Funcs a closure can be made from, FINISH for the exit continuation
+and UNKNOWN for everything else, such as the arguments main is run with. A call passes
+its arguments to every function its head can hold, an arithmetic builtin passes the
+type of its result to its continuation, and this is repeated until nothing changes.
+
+Values stored in lists and vectors (see persistent.py) are not followed: what the
+primitives return is UNKNOWN, and a closure passed to a primitive, or to a call whose
+head may be UNKNOWN, escapes and gets UNKNOWN for all of its arguments.
+
+A call to an arithmetic builtin then gets the kind
+
+- INT when both operands are always ints or bools,
+- FLOAT when both are always numbers and one may be a float,
+- GUARDED when an operand may also be UNKNOWN,
+- "generic" when an operand may be a closure, and "unreached" when the call is never
+  reached.
+
+The kinds are only reported (tinycps.py --specialize-report). They do not change how
+the engines run arithmetic: the python operators already take CPython's own int fast
+paths, and checking the types again in the dispatch loop only cost time.
+
+Like the stack machines, a closure called with more arguments than it takes receives
+the last ones.
+"""
+
+import expression_tree
+import persistent
+from expression_tree import Var, Const, Func, FuncLiteral, Call
+
+INT = "int"
+FLOAT = "float"
+BOOL = "bool"
+FINISH = "finish"
+UNKNOWN = "unknown"
+# the kind of arithmetic whose operands could not be proven to be numbers
+GUARDED = "guarded"
+
+NUMBERS = set([INT, FLOAT, BOOL])
+ARITHMETIC = set(["+", "-", "*", "%", "div"])
+COMPARISONS = set(["<", "="])
+# the primitives whose result type is known
+PRIMITIVE_TYPES = {"length": INT, "empty": BOOL}
+
+KINDS = [INT, FLOAT, GUARDED, "generic", "unreached"]
+
+def const_type(value):
+    if isinstance(value, bool):
+        return BOOL
+    if isinstance(value, (int, long)):
+        return INT
+    if isinstance(value, float):
+        return FLOAT
+    return UNKNOWN
+
+# The types the result of the builtin func can have for operands of the types lhs and rhs.
+def result_types(func, lhs, rhs):
+    if func in COMPARISONS:
+        return set([BOOL])
+    types = set()
+    for left in lhs:
+        for right in rhs:
+            if left in NUMBERS and right in NUMBERS:
+                types.add(FLOAT if FLOAT in (left, right) else INT)
+            else:
+                types.add(UNKNOWN)
+    return types
+
+# The kind of arithmetic on operands of the types lhs and rhs, or None.
+def operand_kind(lhs, rhs):
+    operands = lhs | rhs
+    if not lhs or not rhs:
+        return None
+    if operands <= set([INT, BOOL]):
+        return INT
+    if operands <= NUMBERS:
+        return FLOAT
+    if operands <= NUMBERS | set([UNKNOWN]):
+        return GUARDED
+    return None
+
+class TypeInference(object):
+    def __init__(self, module, main="main"):
+        super(TypeInference, self).__init__()
+        if main not in module or not isinstance(module[main], Func):
+            raise Exception("Invalid module: missing entry: %s." % main)
+        self.functions = dict([(name, module[name]) for name in module
+                               if isinstance(module[name], Func) and not isinstance(module[name], expression_tree.Builtin)])
+        # (Func, argument name) -> the set of abstract values of that argument
+        self.values = {}
+        # every call in the module with the Funcs enclosing it, innermost first
+        self.calls = []
+        self.changed = False
+        for name in sorted(self.functions):
+            self.collect(self.functions[name], [])
+        entry = self.functions[main]
+        if entry.args:
+            self.flow(entry, [set([FINISH])] + [set([UNKNOWN])] * (len(entry.args) - 1))
+
+    def collect(self, func, scopes):
+        scopes = [func] + scopes
+        for arg in func.args:
+            self.values[(func, arg)] = set()
+        if not isinstance(func.body, Call):
+            raise Exception("Function body must be a call.")
+        self.calls.append((func.body, scopes))
+        for arg in func.body.args:
+            if isinstance(arg, FuncLiteral):
+                self.collect(arg.func, scopes)
+
+    def bound(self, symbol, scopes):
+        for func in scopes:
+            if symbol in func.args:
+                return self.values[(func, symbol)]
+        return None
+
+    def lookup(self, symbol, scopes):
+        values = self.bound(symbol, scopes)
+        if values is not None:
+            return values
+        if symbol in self.functions:
+            return set([self.functions[symbol]])
+        return set([UNKNOWN])
+
+    def value(self, node, scopes):
+        if isinstance(node, Const):
+            return set([const_type(node.value)])
+        if isinstance(node, Var):
+            return self.lookup(node.symbol, scopes)
+        if isinstance(node, FuncLiteral):
+            return set([node.func])
+        if isinstance(node, expression_tree.Finish):
+            return set([FINISH])
+        return set([UNKNOWN])
+
+    def add(self, values, new):
+        if not new <= values:
+            values |= new
+            self.changed = True
+
+    # Passes args, a list of sets of abstract values, to every function in targets.
+    def call(self, targets, args):
+        for target in list(targets):
+            if isinstance(target, Func):
+                self.flow(target, args)
+        if UNKNOWN in targets:
+            for values in args:
+                self.escape(values)
+
+    # Closures in values may be called from anywhere with anything.
+    def escape(self, values):
+        for value in list(values):
+            if isinstance(value, Func):
+                self.flow(value, [])
+
+    def flow(self, func, args):
+        if len(args) < len(func.args):
+            for arg in func.args:
+                self.add(self.values[(func, arg)], set([UNKNOWN]))
+            return
+        for (arg, values) in zip(func.args, args[len(args) - len(func.args):]):
+            self.add(self.values[(func, arg)], values)
+
+    def step(self, call, scopes):
+        args = [self.value(arg, scopes) for arg in call.args]
+        if self.bound(call.func, scopes) is not None or call.func in self.functions:
+            self.call(self.lookup(call.func, scopes), args)
+        elif call.func == "if" and len(args) == 4:
+            self.call(args[2] | args[3], [args[0]])
+        elif (call.func in ARITHMETIC or call.func in COMPARISONS) and len(args) == 3:
+            self.call(args[0], [result_types(call.func, args[1], args[2])])
+        elif call.func in persistent.PRIMITIVE_INDEX and args:
+            for values in args[1:]:
+                self.escape(values)
+            self.call(args[0], [set([PRIMITIVE_TYPES.get(call.func, UNKNOWN)])])
+
+    def run(self):
+        self.changed = True
+        while self.changed:
+            self.changed = False
+            for (call, scopes) in self.calls:
+                self.step(call, scopes)
+
+    # Returns (call, kind) for every call to an arithmetic builtin.
+    def kinds(self):
+        kinds = []
+        for (call, scopes) in self.calls:
+            if call.func not in ARITHMETIC and call.func not in COMPARISONS:
+                continue
+            if self.bound(call.func, scopes) is not None or call.func in self.functions or len(call.args) != 3:
+                continue
+            lhs = self.value(call.args[1], scopes)
+            rhs = self.value(call.args[2], scopes)
+            kind = operand_kind(lhs, rhs)
+            if kind is None:
+                kind = "generic" if lhs and rhs else "unreached"
+            kinds.append((call, kind))
+        return kinds
+
+# Returns a report mapping each of KINDS to the number of calls to an arithmetic
+# builtin in module that got it.
+def infer(module, main="main"):
+    inference = TypeInference(module, main)
+    inference.run()
+    report = dict([(kind, 0) for kind in KINDS])
+    for (call, kind) in inference.kinds():
+        report[kind] += 1
+    return report
+
+def format_report(report):
+    lines = ["Arithmetic operand types (call sites):"]
+    for kind in KINDS:
+        lines.append("  %-10s %i" % (kind, report[kind]))
+    total = sum(report.values())
+    proven = report[INT] + report[FLOAT]
+    lines.append("  proven: %i of %i" % (proven, total))
+    return "\n".join(lines)
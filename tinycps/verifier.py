@@ -0,0 +1,221 @@
+"""
+Verifies assembled bytecode once, so that it can run on bytecode.execute_verified,
+the dispatch loop without per-jump checks.
+
+Every block is entered with a fixed number of values on the stack: the captured values
+and arguments of the closures built for it, the argument count of the direct jumps to
+it, and for the entry block the exit continuation and the arguments the program is run
+with. The verifier works out these depths from every instruction that refers to a
+block, and fails if two of them disagree. It then follows each block from its entry
+depth, checking that
+
+- every opcode, constant index and jump target is valid,
+- every stack offset read by PUSH_REL, closures, jumps and fused arithmetic falls
+  within the values on the stack, and every pop has a value to pop,
+- every block ends with exactly one jump, so control never falls into the next block.
+
+The deepest the stack can get follows from the same walk. The verified loop allocates
+the stack for that depth up front. It skips the stack growth checks and the instruction
+budget, and it does not check that a jumped-to value is a closure before entering it.
+A value that turns out not to be a closure still raises the same RuntimeException,
+translated from the TypeError raised when the jump indexes it.
+
+The arguments a closure takes from the stack are only known at runtime, so jumps to
+closures are not checked against the arity of their target, in either loop.
+"""
+
+import bytecode
+from bytecode import (POP, PUSH_CONST, PUSH_REL, PUSH_CLOSURE, PUSH_THUNK, JUMP_LAMBDA, JUMP_LABEL,
+                      COND_BRANCH, ADD, MOD, DIV, ARITH_CONST, ARITH_TO_LAMBDA, ARITH_TO_CLOSURE, BRANCH,
+                      MEMO_JUMP_LABEL, MEMO_RETURN, PRIM)
+import persistent
+import vm
+
+class VerifyException(Exception):
+    def __init__(self, description, ip=None):
+        super(VerifyException, self).__init__()
+        self.description = description
+        self.ip = ip
+
+    def __str__(self):
+        if self.ip is None:
+            return "%s." % self.description
+        return "Verification failed at instruction %i: %s." % (self.ip, self.description)
+
+class Verifier(object):
+    def __init__(self, program):
+        super(Verifier, self).__init__()
+        self.program = program
+        # block address -> the stack depth it is entered with
+        self.depths = {}
+        self.ip = None
+
+    def fail(self, description):
+        raise VerifyException(description, self.ip)
+
+    def const(self, index):
+        if not 0 <= index < len(self.program.consts):
+            self.fail("there is no constant %i" % index)
+        return self.program.consts[index]
+
+    def enter(self, address, depth):
+        if not 0 <= address < len(self.program):
+            self.fail("the jump target %i is outside the program" % address)
+        if self.depths.get(address, depth) != depth:
+            self.fail("the block at %i is entered with both %i and %i values on the stack" % (address, self.depths[address], depth))
+        self.depths[address] = depth
+
+    # Checks that offset, relative to the top of a stack of depth values, is on the stack.
+    def offset(self, offset, depth):
+        if not -depth <= offset <= -1:
+            self.fail("the offset %i is outside a stack of %i values" % (offset, depth))
+
+    def operand(self, operand, depth):
+        if not isinstance(operand, tuple) or len(operand) != 2:
+            self.fail("the operand %s is malformed" % repr(operand))
+        if not operand[0]:
+            self.offset(operand[1], depth)
+
+    def arith(self, code):
+        if code not in bytecode.OPERATIONS:
+            self.fail("there is no arithmetic operation %i" % code)
+
+    # Records the entry depth of every block referred to by an instruction.
+    def collect(self, entry_depth):
+        program = self.program
+        self.enter(program.entry, entry_depth)
+        if vm.MEMO_RETURN in program.labels:
+            # the key and continuation captured by MEMO_JUMP_LABEL, then the result
+            self.enter(program.labels[vm.MEMO_RETURN], 3)
+        for ip in range(len(program)):
+            self.ip = ip
+            op = program.ops[ip]
+            a = program.arg_a[ip]
+            b = program.arg_b[ip]
+            if op == PUSH_CLOSURE:
+                arg_count, offsets = self.const(b)
+                self.enter(a, len(offsets) + arg_count)
+            elif op == PUSH_THUNK or op == JUMP_LABEL or op == MEMO_JUMP_LABEL:
+                self.enter(a, b)
+            elif op == ARITH_TO_CLOSURE:
+                self.enter(a, len(self.const(b)[1]) + 1)
+            elif op == BRANCH:
+                for (address, offsets) in [self.const(a), self.const(b)]:
+                    self.enter(address, len(offsets) + 1)
+        self.ip = None
+
+    # Follows one straight line instruction, returning the new depth.
+    def straight(self, op, a, b, depth):
+        if op == POP:
+            if depth < 1:
+                self.fail("POP on an empty stack")
+            return depth - 1
+        if op == PUSH_CONST:
+            self.const(a)
+        elif op == PUSH_REL:
+            self.offset(a, depth)
+        elif op == PUSH_CLOSURE:
+            for offset in self.const(b)[1]:
+                self.offset(offset, depth)
+        return depth + 1
+
+    # Checks the operands of a jump on a stack of depth values.
+    def jump(self, op, a, b, depth):
+        program = self.program
+        needed = 0
+        if op == JUMP_LABEL or op == MEMO_JUMP_LABEL:
+            needed = max(b, 1)
+            if op == MEMO_JUMP_LABEL and program.memo is None:
+                self.fail("MEMO_JUMP_LABEL without a memo cache")
+        elif op == JUMP_LAMBDA:
+            self.offset(a, depth)
+        elif op == COND_BRANCH:
+            needed = 4
+        elif ADD <= op <= MOD or op == DIV:
+            needed = 3
+        elif op == ARITH_CONST:
+            self.arith(a)
+            self.const(b)
+            needed = 2
+        elif op == ARITH_TO_LAMBDA:
+            arith, lhs, rhs = self.const(b)
+            self.arith(arith)
+            self.offset(a, depth)
+            self.operand(lhs, depth)
+            self.operand(rhs, depth)
+        elif op == ARITH_TO_CLOSURE:
+            arith, offsets, lhs, rhs = self.const(b)
+            self.arith(arith)
+            for offset in offsets:
+                self.offset(offset, depth)
+            self.operand(lhs, depth)
+            self.operand(rhs, depth)
+        elif op == BRANCH:
+            for (address, offsets) in [self.const(a), self.const(b)]:
+                for offset in offsets:
+                    self.offset(offset, depth)
+            needed = 2
+        elif op == PRIM:
+            if not 0 <= a < len(persistent.PRIMITIVES) or persistent.PRIMITIVES[a][1] != b:
+                self.fail("there is no primitive %i taking %i arguments" % (a, b))
+            needed = b + 1
+        elif op == MEMO_RETURN:
+            if program.memo is None:
+                self.fail("MEMO_RETURN without a memo cache")
+            needed = 2
+        else:
+            self.fail("unknown opcode %i" % op)
+        if depth < needed:
+            self.fail("%s needs %i values on the stack, but there are %i" % (bytecode.OPCODE_NAMES[op], needed, depth))
+
+    # Follows the block at start from its entry depth and returns the deepest the stack
+    # gets in it.
+    def block(self, start, end):
+        program = self.program
+        depth = self.depths[start]
+        deepest = depth
+        for ip in range(start, end):
+            self.ip = ip
+            op = program.ops[ip]
+            if op in bytecode.STRAIGHT_OPCODES:
+                depth = self.straight(op, program.arg_a[ip], program.arg_b[ip], depth)
+                deepest = max(deepest, depth)
+                continue
+            self.jump(op, program.arg_a[ip], program.arg_b[ip], depth)
+            if ip != end - 1:
+                self.fail("the block at %i continues after a jump" % start)
+            self.ip = None
+            return max(deepest, depth + bytecode.JUMP_PUSHES.get(op, 0))
+        self.ip = end - 1 if end > start else start
+        self.fail("the block at %i does not end with a jump" % start)
+
+    def verify(self, entry_depth):
+        self.collect(entry_depth)
+        starts = sorted(set(self.depths) | set(self.program.labels.values()))
+        deepest = 0
+        for (idx, start) in enumerate(starts):
+            end = starts[idx + 1] if idx + 1 < len(starts) else len(self.program)
+            # blocks that nothing refers to are never run
+            if start in self.depths:
+                deepest = max(deepest, self.block(start, end))
+        return deepest
+
+# Verifies program for a run with entry_depth values on the stack (the exit continuation
+# followed by the arguments of main). Returns the deepest the stack can get and records
+# it in program.verified, which is what makes bytecode.run_bytecode use the verified loop.
+# Raises VerifyException if the program cannot be verified.
+def verify(program, entry_depth=1):
+    if program.verified.get(entry_depth) is None:
+        program.verified[entry_depth] = Verifier(program).verify(entry_depth)
+    return program.verified[entry_depth]
+
+# Like verify, but returns None for programs that cannot be verified, which then keep
+# running on the checked loop. Failures are recorded too, so each entry depth is only
+# tried once.
+def try_verify(program, entry_depth=1):
+    if entry_depth not in program.verified:
+        try:
+            verify(program, entry_depth)
+        except VerifyException:
+            program.verified[entry_depth] = None
+    return program.verified[entry_depth]
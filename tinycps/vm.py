@@ -1,7 +1,11 @@
-from copy import copy
+import operator
+from collections import OrderedDict
 
 FINISH = "FINISH"
 FINISH_IP = -1
+# the block that records the result of a memoized call, see MemoJumpLabel
+MEMO_RETURN = "__memo_return"
+DEFAULT_MEMO_SIZE = 1024
 
 class RuntimeException(Exception):
     def __init__(self, description, ip=None, jump_table=None, prog=None):
@@ -12,8 +16,34 @@ class RuntimeException(Exception):
         self.jump_table = jump_table
     
     def __str__(self):
+        if self.ip is None or self.prog is None:
+            return "%s." % self.description
         return "Runtime error at instruction (%i: %s): %s." % (self.ip, str(self.prog[self.ip]), self.description)
 
+# What the python operators raise on operands they cannot handle, such as a division by
+# zero or a closure added to a number. The engines report them as RuntimeExceptions.
+OPERAND_ERRORS = (ArithmeticError, TypeError)
+
+# Replaces the stack with the values captured by lamb followed by args and returns
+# the address of the lambda's code.
+def enter_lambda(stack, lamb, args, jump_table):
+    if not isinstance(lamb, list):
+        raise RuntimeException("Stack value %s is not a lambda." % repr(lamb))
+    stack[:] = lamb[2:]
+    stack += args
+    if lamb[0] == FINISH:
+        return FINISH_IP
+    return jump_table[lamb[0]]
+
+# Jumps to the lambda at offset, passing it the top arg_count entries of the stack.
+def jump_to_lambda(stack, offset, jump_table):
+    lamb = stack[offset]
+    if not isinstance(lamb, list):
+        raise RuntimeException("In JumpLambda stack value %s at offset %i is not a lambda." % (repr(lamb), offset + 1))
+    if lamb[0] == FINISH:
+        return FINISH_IP
+    return enter_lambda(stack, lamb, stack[len(stack) - lamb[1]:], jump_table)
+
 # The abstract superclass for vm instructions.
 class Instruction(object):
     def __init__(self):
@@ -61,18 +91,20 @@ class PushRel(Instruction):
         stack.append(stack[self.offset])
         return ip + 1
 
-# Pushes a lambda to the stack bound to the current scope.
-class PushLambda(Instruction):
-    def __init__(self, label, arg_count):
-        super(PushLambda, self).__init__()
+# Pushes a flat closure to the stack. Only the values at the given offsets
+# (the lambda's free variables, in the same convention as PushRel) are captured.
+class PushClosure(Instruction):
+    def __init__(self, label, arg_count, offsets):
+        super(PushClosure, self).__init__()
         self.label = label
         self.arg_count = arg_count
+        self.offsets = [offset - 1 for offset in offsets]
 
     def __repr__(self):
-        return "PushLambda(%s, %i)" % (self.label, self.arg_count)
+        return "PushClosure(%s, %i, [%s])" % (self.label, self.arg_count, ", ".join([str(offset + 1) for offset in self.offsets]))
 
     def evaluate(self, stack, ip, jump_table):
-        stack.append([self.label, self.arg_count] + copy(stack))
+        stack.append([self.label, self.arg_count] + [stack[offset] for offset in self.offsets])
         return ip + 1
 
 # Pushes a continuation to the top of the stack corresponding to a named function
@@ -90,7 +122,8 @@ class PushThunk(Instruction):
         stack.append([self.label, self.arg_count])
         return ip + 1
 
-# Jumps to the continuation at the given offset on the stack.
+# Jumps to the continuation at the given offset on the stack. The stack is replaced
+# by the values captured in the closure followed by the arguments.
 class JumpLambda(Instruction):
     def __init__(self, offset):
         super(JumpLambda, self).__init__()
@@ -100,17 +133,7 @@ class JumpLambda(Instruction):
         return "JumpLambda(%i)" % (self.offset + 1)
     
     def evaluate(self, stack, ip, jump_table):
-        lamb = stack[self.offset]
-        if not isinstance(lamb, list):
-            print stack
-            raise RuntimeException("In JumpLambda stack value %s at offset %i is not a lambda." % (repr(lamb), self.offset + 1))
-        if lamb[0] == FINISH:
-            return FINISH_IP
-        arg_count = lamb[1]
-        args = stack[(-arg_count):]
-        stack[:] = lamb[2:]
-        stack += args
-        return jump_table[lamb[0]]
+        return jump_to_lambda(stack, self.offset, jump_table)
 
 # Jumps to the named function, clearing everything but the last arg_count entries from the stack.
 class JumpLabel(Instruction):
@@ -129,6 +152,106 @@ class JumpLabel(Instruction):
             raise RuntimeException("In JumpLabel: there is no entry for %s in the jump table." % str(self.label))
         return jump_table[self.label]
 
+# The results of memoized functions, keyed by the function and its arguments after the
+# continuation. Holds at most size entries, evicting the least recently used. functions
+# names the functions to memoize, or None for all of them. Keys are whatever the engine
+# calls functions by (labels or addresses), which is also how hits and misses are counted.
+class MemoCache(object):
+    MISS = object()
+
+    def __init__(self, size=DEFAULT_MEMO_SIZE, functions=None):
+        super(MemoCache, self).__init__()
+        self.size = size
+        self.functions = functions
+        self.entries = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+        self.uncacheable = 0
+
+    def memoizes(self, name):
+        return self.functions is None or name in self.functions
+
+    # Returns the cached value for key, or MISS. Raises TypeError when key is not hashable.
+    def lookup(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses[key[0]] = self.misses.get(key[0], 0) + 1
+            return MemoCache.MISS
+        self.entries[key] = value
+        self.hits[key[0]] = self.hits.get(key[0], 0) + 1
+        return value
+
+    # Called by the stack machines on entry to a memoized function with continuation
+    # ret. Returns (ret, value) on a hit. Otherwise returns MISS and the continuation to
+    # call the function with, a closure of the memo_return block over key and ret.
+    def enter(self, key, ret, memo_return):
+        try:
+            value = self.lookup(key)
+        except TypeError:
+            # closures cannot be part of a key
+            self.uncacheable += 1
+            return ret, MemoCache.MISS
+        if value is MemoCache.MISS:
+            return [memo_return, 1, key, ret], value
+        return ret, value
+
+    def store(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    # name maps the keys of functions to the names shown.
+    def format_stats(self, name=str):
+        lines = ["Memo cache: %i of %i entries, %i evictions, %i uncacheable calls" %
+                 (len(self.entries), self.size, self.evictions, self.uncacheable)]
+        for function in sorted(set(self.hits) | set(self.misses), key=name):
+            hits = self.hits.get(function, 0)
+            misses = self.misses.get(function, 0)
+            lines.append("  %-20s %10i hits %10i misses %6.1f%%" % (name(function), hits, misses, 100.0 * hits / (hits + misses)))
+        return "\n".join(lines)
+
+# A JumpLabel to a memoized function. On a hit the continuation is called with the
+# cached result instead, and on a miss the function gets a continuation that records
+# the result in the cache before passing it on.
+class MemoJumpLabel(JumpLabel):
+    def __init__(self, label, arg_count, cache):
+        super(MemoJumpLabel, self).__init__(label, arg_count)
+        self.cache = cache
+
+    def __repr__(self):
+        return "MemoJumpLabel(%s, %i)" % (self.label, self.arg_count)
+
+    def evaluate(self, stack, ip, jump_table):
+        del stack[:-self.arg_count]
+        cont, value = self.cache.enter((self.label,) + tuple(stack[1:]), stack[0], MEMO_RETURN)
+        if value is not MemoCache.MISS:
+            stack[:] = [cont, value]
+            return jump_to_lambda(stack, -2, jump_table)
+        stack[0] = cont
+        if not self.label in jump_table:
+            raise RuntimeException("In MemoJumpLabel: there is no entry for %s in the jump table." % str(self.label))
+        return jump_table[self.label]
+
+# The only instruction of the MEMO_RETURN block. The stack holds the key and the
+# continuation captured by MemoJumpLabel followed by the result.
+class MemoReturn(Instruction):
+    def __init__(self, cache):
+        super(MemoReturn, self).__init__()
+        self.cache = cache
+
+    def __repr__(self):
+        return "MemoReturn()"
+
+    def evaluate(self, stack, ip, jump_table):
+        self.cache.store(stack[0], stack[-1])
+        return jump_to_lambda(stack, -2, jump_table)
+
 # Implements 'if'. Jumps to iftrue if test or iffalse otherwise, passing continuation as
 # the only argument.
 # The last four elements of the stack should be [continuation, test, iftrue, iffalse]
@@ -145,11 +268,13 @@ class CondBranch(Instruction):
         else:
             branch_offset = -1
         stack.append(stack[-4])
-        return JumpLambda(branch_offset).evaluate(stack, ip, jump_table)
+        return jump_to_lambda(stack, branch_offset - 1, jump_table)
         
 # Pops the last two entries off the stack, adds them, and pushes the value.
 # Jumps to the continuation given.
 class AddInst(Instruction):
+    operation = staticmethod(operator.add)
+
     def __init__(self):
         super(AddInst, self).__init__()
     
@@ -160,11 +285,13 @@ class AddInst(Instruction):
         rhs = stack.pop()
         lhs = stack.pop()
         stack.append(lhs + rhs)
-        return JumpLambda(-1).evaluate(stack, ip, jump_table)
+        return jump_to_lambda(stack, -2, jump_table)
 
 # Pops the last two entries off the stack, subtracts them, and pushes the value.
 # Jumps to the continuation given.
 class SubInst(Instruction):
+    operation = staticmethod(operator.sub)
+
     def __init__(self):
         super(SubInst, self).__init__()
 
@@ -175,11 +302,13 @@ class SubInst(Instruction):
         rhs = stack.pop()
         lhs = stack.pop()
         stack.append(lhs - rhs)
-        return JumpLambda(-1).evaluate(stack, ip, jump_table)
+        return jump_to_lambda(stack, -2, jump_table)
 
 # Pops the last two entries off the stack, multiplies them, and pushes the value.
 # Jumps to the continuation given.
 class MulInst(Instruction):
+    operation = staticmethod(operator.mul)
+
     def __init__(self):
         super(MulInst, self).__init__()
 
@@ -190,9 +319,11 @@ class MulInst(Instruction):
         rhs = stack.pop()
         lhs = stack.pop()
         stack.append(lhs * rhs)
-        return JumpLambda(-1).evaluate(stack, ip, jump_table)
+        return jump_to_lambda(stack, -2, jump_table)
 
 class LessInst(Instruction):
+    operation = staticmethod(operator.lt)
+
     def __init__(self):
         super(LessInst, self).__init__()
 
@@ -203,9 +334,11 @@ class LessInst(Instruction):
         rhs = stack.pop()
         lhs = stack.pop()
         stack.append(lhs < rhs)
-        return JumpLambda(-1).evaluate(stack, ip, jump_table)
+        return jump_to_lambda(stack, -2, jump_table)
 
 class EqInst(Instruction):
+    operation = staticmethod(operator.eq)
+
     def __init__(self):
         super(EqInst, self).__init__()
 
@@ -216,24 +349,192 @@ class EqInst(Instruction):
         rhs = stack.pop()
         lhs = stack.pop()
         stack.append(lhs == rhs)
-        return JumpLambda(-1).evaluate(stack, ip, jump_table)
+        return jump_to_lambda(stack, -2, jump_table)
 
 class ModInst(Instruction):
+    operation = staticmethod(operator.mod)
+
     def __init__(self):
         super(ModInst, self).__init__()
 
     def __repr__(self):
-        return "EqInst()"
+        return "ModInst()"
 
     def evaluate(self, stack, ip, jump_table):
         rhs = stack.pop()
         lhs = stack.pop()
         stack.append(lhs % rhs)
-        return JumpLambda(-1).evaluate(stack, ip, jump_table)
+        return jump_to_lambda(stack, -2, jump_table)
+
+# Pops the last two entries off the stack, divides them rounding down, and pushes the
+# value. Jumps to the continuation given.
+class DivInst(Instruction):
+    operation = staticmethod(operator.floordiv)
+
+    def __init__(self):
+        super(DivInst, self).__init__()
+
+    def __repr__(self):
+        return "DivInst()"
+
+    def evaluate(self, stack, ip, jump_table):
+        rhs = stack.pop()
+        lhs = stack.pop()
+        stack.append(lhs // rhs)
+        return jump_to_lambda(stack, -2, jump_table)
+
+ARITHMETIC_INSTRUCTIONS = (AddInst, SubInst, MulInst, LessInst, EqInst, ModInst, DivInst)
+
+# Calls one of the primitives on lists and vectors (see persistent.py) with the last
+# arg_count entries of the stack, replaces them by the result and jumps to the
+# continuation below them.
+class PrimInst(Instruction):
+    def __init__(self, name, arg_count, function):
+        super(PrimInst, self).__init__()
+        self.name = name
+        self.arg_count = arg_count
+        self.function = function
+
+    def __repr__(self):
+        return "PrimInst(%s)" % self.name
+
+    def evaluate(self, stack, ip, jump_table):
+        top = len(stack) - self.arg_count
+        result = self.function(*stack[top:])
+        del stack[top:]
+        stack.append(result)
+        return jump_to_lambda(stack, -2, jump_table)
+
+# Superinstructions are produced by the peephole optimizer in peephole.py. Each one is
+# built from the instructions of the sequence it replaces and behaves exactly like it.
+
+# Operands of fused arithmetic are (True, constant) or (False, stack offset). pushed is
+# the number of stack entries the original sequence had pushed before the operand.
+def fused_operand(instr, pushed):
+    if isinstance(instr, PushConst):
+        return (True, instr.value)
+    return (False, instr.offset + pushed)
+
+def read_operand(stack, operand):
+    if operand[0]:
+        return operand[1]
+    return stack[operand[1]]
+
+# Replaces PushConst(value) followed by arithmetic: the constant is used as the right
+# hand side without going through the stack.
+class ArithConst(Instruction):
+    def __init__(self, const, arith):
+        super(ArithConst, self).__init__()
+        self.const = const
+        self.arith = arith
+        self.value = const.value
+        self.operation = arith.operation
+
+    def __repr__(self):
+        return "ArithConst(%s, %s)" % (repr(self.const), repr(self.arith))
+
+    def evaluate(self, stack, ip, jump_table):
+        stack[-1] = self.operation(stack[-1], self.value)
+        return jump_to_lambda(stack, -2, jump_table)
+
+# Replaces PushRel(cont), two operand pushes and arithmetic: the operands are read
+# in place and only the continuation and the result are pushed before jumping.
+class ArithToLambda(Instruction):
+    def __init__(self, cont, lhs, rhs, arith):
+        super(ArithToLambda, self).__init__()
+        self.sequence = [cont, lhs, rhs, arith]
+        self.cont_offset = cont.offset
+        self.lhs = fused_operand(lhs, 1)
+        self.rhs = fused_operand(rhs, 2)
+        self.arith = arith
+        self.operation = arith.operation
 
-def run_program(instructions, jump_table):
-    stack = [[FINISH]]
-    ip = 0
+    def __repr__(self):
+        return "ArithToLambda(%s)" % ", ".join([repr(instr) for instr in self.sequence])
+
+    def evaluate(self, stack, ip, jump_table):
+        result = self.operation(read_operand(stack, self.lhs), read_operand(stack, self.rhs))
+        stack.append(stack[self.cont_offset])
+        stack.append(result)
+        return jump_to_lambda(stack, -2, jump_table)
+
+# Replaces PushClosure(label, 1, ...), two operand pushes and arithmetic: the closure is
+# never built, its captured values and the result become the new stack.
+class ArithToClosure(Instruction):
+    def __init__(self, closure, lhs, rhs, arith):
+        super(ArithToClosure, self).__init__()
+        self.sequence = [closure, lhs, rhs, arith]
+        self.label = closure.label
+        self.offsets = closure.offsets
+        self.lhs = fused_operand(lhs, 1)
+        self.rhs = fused_operand(rhs, 2)
+        self.arith = arith
+        self.operation = arith.operation
+
+    def __repr__(self):
+        return "ArithToClosure(%s)" % ", ".join([repr(instr) for instr in self.sequence])
+
+    def evaluate(self, stack, ip, jump_table):
+        result = self.operation(read_operand(stack, self.lhs), read_operand(stack, self.rhs))
+        stack[:] = [stack[offset] for offset in self.offsets] + [result]
+        return jump_table[self.label]
+
+# Replaces two single argument closure or thunk pushes followed by CondBranch: only the
+# branch that is taken is entered and neither closure is built.
+# The last two elements of the stack should be [continuation, test]
+class Branch(Instruction):
+    def __init__(self, iftrue, iffalse):
+        super(Branch, self).__init__()
+        self.sequence = [iftrue, iffalse, CondBranch()]
+        self.true_label = iftrue.label
+        self.true_offsets = getattr(iftrue, "offsets", [])
+        self.false_label = iffalse.label
+        self.false_offsets = [offset + 1 for offset in getattr(iffalse, "offsets", [])]
+
+    def __repr__(self):
+        return "Branch(%s)" % ", ".join([repr(instr) for instr in self.sequence])
+
+    def evaluate(self, stack, ip, jump_table):
+        if stack[-1]:
+            label, offsets = self.true_label, self.true_offsets
+        else:
+            label, offsets = self.false_label, self.false_offsets
+        stack[:] = [stack[offset] for offset in offsets] + [stack[-2]]
+        return jump_table[label]
+
+# Splits a linked program back into its blocks, in address order.
+def split_blocks(instructions, jump_table):
+    starts = sorted([(jump_table[name], name) for name in jump_table])
+    blocks = []
+    for (idx, (start, name)) in enumerate(starts):
+        end = starts[idx + 1][0] if idx + 1 < len(starts) else len(instructions)
+        blocks.append((name, instructions[start:end]))
+    return blocks
+
+# Returns the number of values on the stack when each block is entered: the captured
+# values and arguments of a lambda, or the arguments of a named function.
+def entry_depths(instructions, jump_table):
+    depths = {}
+    def record(label, depth):
+        if depths.get(label, depth) != depth:
+            raise Exception("The function %s is entered with both %i and %i values on the stack." % (label, depths[label], depth))
+        depths[label] = depth
+    for instr in instructions:
+        if isinstance(instr, PushClosure):
+            record(instr.label, len(instr.offsets) + instr.arg_count)
+        elif isinstance(instr, PushThunk) or isinstance(instr, JumpLabel):
+            record(instr.label, instr.arg_count)
+        elif isinstance(instr, ArithToClosure):
+            record(instr.label, len(instr.offsets) + 1)
+        elif isinstance(instr, Branch):
+            record(instr.true_label, len(instr.true_offsets) + 1)
+            record(instr.false_label, len(instr.false_offsets) + 1)
+    return depths
+
+# args are passed to main after the exit continuation. entry is the address of main.
+def run_program(instructions, jump_table, args=(), entry=0):
+    stack = [[FINISH]] + list(args)
+    ip = entry
     while ip < len(instructions):
         try:
             ip = instructions[ip].evaluate(stack, ip, jump_table)
@@ -242,6 +543,8 @@ def run_program(instructions, jump_table):
             e.jump_table = jump_table
             e.prog = instructions
             raise e
+        except OPERAND_ERRORS as e:
+            raise RuntimeException(str(e), ip, jump_table, instructions)
         if ip is FINISH_IP:
             return stack[-1]
     raise RuntimeException("Program ended without calling exit continuation.", ip, jump_table, instructions)